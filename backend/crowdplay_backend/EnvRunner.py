@@ -1,13 +1,8 @@
-import bz2
-import copy
 import json
 import multiprocessing
-import os
-import pickle
-import queue
 import threading
 import time
-from base64 import b64encode
+import zlib
 from datetime import datetime
 from uuid import uuid4
 
@@ -15,16 +10,23 @@ import cv2
 import numpy as np
 from flask import current_app
 from gym import Space, spaces
-from mysql import connector
 
 from .ai_policy import (
     MaxAndSkipAndWarpAndScaleAndStackFrameBuffer,
     registered_ai_framebuffers,
     registered_ai_policies,
 )
+from .completion_counts import completion_counts
 from .config import Config
 from .db import db
-from .db_models import EnvModel, GameModel, SessionModel
+from .db_models import (
+    EnvModel,
+    GameModel,
+    SessionModel,
+    callable_value_to_number,
+    stored_callable_value,
+)
+from .db_writer import TrajectoryEncoder
 from .environment_callables import ConstantCallable, ScoreCallable, TimeCallable
 from .environments import (
     CROWDPLAY_REALTIME_REALTIME,
@@ -33,12 +35,36 @@ from .environments import (
     crowdplay_environments,
 )
 from .exceptions import AiPolicyError
+from .frame_buffer import SharedFrameBuffer
+from .frame_codec import DeltaFrameEncoder, PaletteEncoder
+from .frame_scheduler import FrameScheduler
+from .inference_server import RemotePolicy
 from .logger import getLogger
+from .score_index import score_index
 from .socketio import socketio
-from .utils import noop, observation_to_serializable
+from .stream_controller import StreamController
+from .trajectory_recorder import TrajectoryRecorder
+from .utils import (
+    IMAGE_FORMATS,
+    PALETTE_FORMAT,
+    EnvSpaces,
+    noop,
+    observation_to_binary,
+    observation_to_serializable,
+    rgb_array_to_bytes,
+    scale_image,
+    split_observation_image,
+)
 
 logger = getLogger(__name__)
 
+# How long EnvProcess blocks waiting for commands or players' actions before checking for stop and exit events.
+WAIT_TIMEOUT = 0.1
+
+# States yielded by EnvProcess.episode_frames().
+EPISODE_FRAME = "frame"
+EPISODE_WAITING = "waiting"
+
 
 #########
 # Utils #
@@ -72,120 +98,6 @@ def get_noop_for_space(space):
     return 0
 
 
-def rgb_array_to_bytes(rgb_array, ext=".jpg"):
-    _, buffer = cv2.imencode(ext, rgb_array[:, :, [2, 1, 0]])
-    return buffer.tobytes()
-
-
-def rgb_array_to_image_data(rgb_array, encoding="utf-8"):
-    b_frame = rgb_array_to_bytes(rgb_array)
-    b64_frame = b64encode(b_frame).decode(encoding)
-    return "data:image/jpeg;base64," + b64_frame
-
-
-def episode_to_db(trajectory, episode_id, conn):
-    """Inserts as bzipped pickled trajectory into the DB."""
-
-    insert_episode_query = """
-    INSERT INTO episode_trajectories (
-        episode_id,
-        trajectory
-    )
-    VALUES ( %s, %s )
-    """
-
-    bzipped_trajectory = bz2.compress(pickle.dumps(trajectory))
-
-    with conn.cursor() as cursor:
-        cursor.execute(insert_episode_query, (episode_id, bzipped_trajectory))
-        conn.commit()
-        cursor.close()
-
-
-def mark_db_process_status_code(instance_id, status_code, conn):
-    logger.info(f"DB process {instance_id} updating status code to {status_code}.")
-    updatequery = """
-    UPDATE crowdplaydb.envs SET crowdplaydb.envs.dbprocess_status_code = %s WHERE crowdplaydb.envs.instance_id=%s;
-    """
-    data = (status_code, instance_id)
-    with conn.cursor() as cursor:
-        cursor.execute(updatequery, data)
-        conn.commit()
-        cursor.close()
-    logger.info(f"DB process {instance_id} updated status code to {status_code}.")
-
-
-def task_completion_to_db(instance_id, completion_value, bonus_value, agent_id, conn):
-    """Update task completion into database."""
-    insert_episode_query = """
-        UPDATE sessions SET completed=%s, bonus=%s
-        WHERE env_instance_id=%s AND agent_key=%s
-        """
-    data = (completion_value, bonus_value, instance_id, agent_id)
-    with conn.cursor() as cursor:
-        cursor.execute(insert_episode_query, data)
-        conn.commit()
-        cursor.close()
-
-
-def step_enqueue_process_fn(
-    input_queue,
-    input_queue_priority,
-    list_of_agents,
-    instance_id,
-    database_exit_event,
-    database_process_is_finished_event,
-):
-    def process_data(data):
-        if data[0] == "episode_to_db":
-            logger.info(f"Enqueueing episode data for game id {data[1]}")
-            episode_to_db(data[2], data[1], conn)
-            logger.info(f"Done enqueueing episode data for game id {data[1]}")
-        elif data[0] == "completion_to_db":
-            logger.info(f"Enqueueing completion data for instance id {data[1]} agent id {data[4]}")
-            task_completion_to_db(data[1], data[2], data[3], data[4], conn)
-            logger.info(f"Done enqueueing completion data for instance id {data[1]} agent id {data[4]}")
-
-    logger.info(f"DB process {instance_id} started.")
-    #################
-    # DB connection #
-    #################
-
-    MYSQL_USER = os.environ.get("MYSQL_USER")
-    MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD")
-    MYSQL_HOST = os.environ.get("MYSQL_HOST")
-    MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE")
-
-    # TODO: Shouldn't we try-catch?
-    conn = connector.connect(user=MYSQL_USER, password=MYSQL_PASSWORD, host=MYSQL_HOST, database=MYSQL_DATABASE)
-
-    i = 0
-
-    while not (database_exit_event.is_set() and input_queue.empty() and input_queue_priority.empty() and i > 10):
-        try:
-            if not input_queue_priority.empty():
-                data = input_queue_priority.get()
-                process_data(data)
-            if input_queue_priority.empty() and not input_queue.empty():
-                data = input_queue.get()
-                process_data(data)
-        except ValueError:
-            print("Excepted ValueError on input_queue.get()")
-            # return 0
-        except OSError:
-            print("Excepted OSError on input_queue.get()")
-            # return 0
-        except queue.Empty:
-            print("Excepted queue.Empty on input_queue.get()")
-        if database_exit_event.is_set():
-            i += 1
-        time.sleep(0.1)
-
-    logger.info(f"DB process {instance_id} exiting.")
-    mark_db_process_status_code(instance_id, 1, conn)
-    database_process_is_finished_event.set()
-
-
 class EnvProcess:
     def __init__(
         self,
@@ -193,20 +105,40 @@ class EnvProcess:
         task_id,
         command_child,
         action_recv,
-        step_info_send,
+        frame_buffer,
         env_process_exit_event,
         env_process_episode_running_event,
         env_process_stop_episode_event,
         env_process_is_finished_event,
         database_queue,
-        database_queue_priority,
+        database_event_index,
         fps=60,
+        worker_slot_index=None,
+        inference_queues=None,
+        env_process_ready_event=None,
     ):
+        """
+        Args:
+            database_queue: Queue of the DBWriter (see db_writer.py), which writes everything we send to the DB.
+            database_event_index: Index of the DBWriter event to set once all our data is written, or None.
+            worker_slot_index: Set when hosted in an EnvWorker (see env_worker.py). Episodes are then run by the
+                worker instead of in a thread.
+            inference_queues: Queues and ready events of InferenceServers (see inference_server.py) by AI policy
+                id. Policies without one are loaded in this process.
+            env_process_ready_event: Set once the environment and AI policies are loaded, see warm_pool.py.
+        """
         self.instance_id = instance_id
+        self.worker_slot_index = worker_slot_index
+        # The running episode, when hosted in an EnvWorker, see episode_frames().
+        self.episode = None
+        # Episode to start once the running one, if any, has finished.
+        self.pending_game_id = None
         self.task_id = task_id
         self.command_child = command_child
+        # The episode thread and the command loop both send to the EnvRunner.
+        self.command_lock = threading.Lock()
         self.action_recv = action_recv
-        self.step_info_send = step_info_send
+        self.frame_buffer = frame_buffer
         self.env_process_exit_event = env_process_exit_event
         self.env_process_episode_running_event = env_process_episode_running_event
         self.env_process_stop_episode_event = env_process_stop_episode_event
@@ -243,16 +175,17 @@ class EnvProcess:
 
         # Keep list of recent steps
         # self.step_infos_for_db = []
-        self.trajectory = []
+        # Buffers start small and grow as needed, up to Config.TRAJECTORY_CHUNK_STEPS steps.
+        self.trajectory = TrajectoryRecorder()
+        self.trajectory_chunk_index = 0
 
-        # Start DB queue process
-        # TODO Does a thread make more sense here?
+        # All DB writes go through the DBWriter, which is shared with all other instances.
         self.database_queue = database_queue
-        self.database_queue_priority = database_queue_priority
-        # Notice: We use the same exit event for EnvProcess and database process termination.
-        self.database_exit_event = self.env_process_exit_event
+        self.database_event_index = database_event_index
+        self.trajectory_encoder = TrajectoryEncoder(database_queue)
 
         # Set up AI policies if not existing already
+        self.inference_queues = inference_queues or {}
         self.ai_policies = {}
         for agent_id in crowdplay_environments[self.task_id]["ai_agent_map_always"]:
             if agent_id in self.env.list_of_agents:
@@ -260,7 +193,7 @@ class EnvProcess:
                 # policy_id_string = f"{checkpoint_file}_{checkpoint_agent_id}"
                 try:
                     if agent_id not in self.ai_policies:
-                        self.ai_policies[agent_id] = registered_ai_policies[ai_policy_id]()
+                        self.ai_policies[agent_id] = self.make_ai_policy(ai_policy_id)
                 except Exception:
                     logger.error(f"Error: cannot create or find AI policy {ai_policy_id}")
                     raise AiPolicyError()
@@ -274,44 +207,41 @@ class EnvProcess:
                 # policy_id_string = f"{checkpoint_file}_{checkpoint_agent_id}"
                 try:
                     if agent_id not in self.ai_policies:
-                        self.ai_policies[agent_id] = registered_ai_policies[ai_policy_id]()
+                        self.ai_policies[agent_id] = self.make_ai_policy(ai_policy_id)
                 except Exception:
                     logger.error(f"Error: cannot create or find AI policy {ai_policy_id}")
                     raise AiPolicyError()
             else:
                 logger.warn(f"Agent ID {agent_id} in AI policy map, but not in environmnent list of agents.")
-        self.setup_sql()
-
-    def setup_sql(self):
-        MYSQL_USER = os.environ.get("MYSQL_USER")
-        MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD")
-        MYSQL_HOST = os.environ.get("MYSQL_HOST")
-        MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE")
-        self.conn = connector.connect(
-            user=MYSQL_USER, password=MYSQL_PASSWORD, host=MYSQL_HOST, database=MYSQL_DATABASE
-        )
 
-        pass
+        if env_process_ready_event is not None:
+            env_process_ready_event.set()
+
+    def make_ai_policy(self, ai_policy_id):
+        """Returns a RemotePolicy if the AI policy has an InferenceServer, and loads the policy otherwise."""
+        if ai_policy_id in self.inference_queues:
+            return RemotePolicy(*self.inference_queues[ai_policy_id])
+        return registered_ai_policies[ai_policy_id]()
 
-    def process_command(self):
-        if self.command_child.poll():
+    def process_command(self, timeout=0):
+        if self.command_child.poll(timeout):
             cmd, data = self.command_child.recv()
             if cmd == "start_episode":
-                game_id = data["game_id"]
-                if not self.env_process_episode_running_event.is_set():
-                    # TODO store in class?
-                    self.game_id = game_id
-                    self.episode_thread = threading.Thread(target=self.run_episode, args=(game_id,))
-                    self.episode_thread.start()
-                    # self.run_episode(game_id)
-                else:
-                    # TODO this shouldn't happen. Use multiprocessing event for EnvRunner._is_episode_running?
-                    logger.error(f"Told to start episode {game_id}, but episode already running.")
+                # The EnvRunner doesn't wait for a previous episode to finish, start this one once it has.
+                if self.episode_is_active():
+                    logger.warn(
+                        f"Told to start episode {data['game_id']} in EnvProcess {self.instance_id}, "
+                        "starting it once the running episode has finished."
+                    )
+                self.pending_game_id = data["game_id"]
+            elif cmd == "stop_episode":
+                # The EnvRunner has set the stop event already, but the episode may not have been started yet then,
+                # and starting it clears the event.
+                if self.pending_game_id == data["game_id"]:
+                    self.pending_game_id = None
+                elif self.episode_is_active() and self.game_id == data["game_id"]:
+                    self.env_process_stop_episode_event.set()
             # TODO don't seem to need these anymore thanks to Events?
-            # elif cmd == 'stop_episode':
-            #     self._stop_episode.set()
-            #     # TODO should we wait here?
-            #     # self.episode_thread.join()
             # elif cmd == 'stop_runner':
             #     self._stop_runner.set()
             #     self.close_process()
@@ -320,11 +250,32 @@ class EnvProcess:
                 self.assign_agent(data["agent_id"], data["assign_to"])
             elif cmd == "set_fps":
                 self.fps = data
+        if self.pending_game_id is not None and not self.episode_is_active():
+            self.start_episode(self.pending_game_id)
+            self.pending_game_id = None
+
+    def episode_is_active(self):
+        """Whether an episode is running, or has been started and is about to run."""
+        if self.worker_slot_index is not None:
+            return self.episode is not None
+        return hasattr(self, "episode_thread") and self.episode_thread.is_alive()
+
+    def start_episode(self, game_id):
+        """Starts running an episode, by the EnvWorker if hosted in one, and in the episode thread otherwise."""
+        # TODO store in class?
+        self.game_id = game_id
+        # Any stop was meant for a previous episode.
+        self.env_process_stop_episode_event.clear()
+        if self.worker_slot_index is not None:
+            self.episode = self.episode_frames(game_id)
+        else:
+            self.episode_thread = threading.Thread(target=self.run_episode, args=(game_id,))
+            self.episode_thread.start()
 
     def process_command_loop(self):
         while not self.env_process_exit_event.is_set():
-            self.process_command()
-            time.sleep(0.01)
+            # Block until a command arrives, instead of polling.
+            self.process_command(timeout=WAIT_TIMEOUT)
         logger.info(f"EnvProcess {self.instance_id} command loop exiting.")
         self.close_process()
 
@@ -333,6 +284,33 @@ class EnvProcess:
         self.process_command_loop()
 
     def run_episode(self, game_id):
+        """Runs an episode in real time, in the episode thread of a standalone EnvProcess."""
+        scheduler = FrameScheduler(self.fps, name=f"EnvProcess {self.instance_id}")
+        for state in self.episode_frames(game_id):
+            if state == EPISODE_WAITING:
+                # Block until the next action arrives instead of spinning, but wake up regularly to check for
+                # stop and exit events. Time spent waiting for players doesn't count towards frame timing.
+                self.action_recv.poll(WAIT_TIMEOUT)
+                scheduler.resync()
+            else:
+                # Sleep until end of regular 1/fps intervals.
+                scheduler.fps = self.fps
+                scheduler.wait()
+        scheduler.report()
+        if scheduler.overruns > 0:
+            logger.info(
+                f"Episode with id {game_id} in EnvProcess {self.instance_id}: {scheduler.overruns} of "
+                f"{scheduler.frames} frames overran, up to {scheduler.max_lateness * 1000:.1f}ms late."
+            )
+
+    def episode_frames(self, game_id):
+        """Runs an episode, one frame at a time.
+
+        This is a generator that does not wait for anything itself. After each frame it yields EPISODE_FRAME, and
+        whenever it is waiting for players' actions in turn-based environments it yields EPISODE_WAITING, and the
+        caller decides how long to wait before resuming it. This lets run_episode() run one episode in real time,
+        and an EnvWorker run the episodes of many instances on one clock (see env_worker.py).
+        """
         self.env_process_episode_running_event.set()
         self.env_process_is_finished_event.clear()
         logger.info(f"Episode with id {game_id} in EnvProcess {self.instance_id} started.")
@@ -341,7 +319,7 @@ class EnvProcess:
         # Set up basics
         episode_end = False
         step_iter = 0
-        next_frame_time = time.time() + 1 / self.fps
+        self.trajectory_chunk_index = 0
 
         # Reset environment.
         # We essentially discard the reset step,
@@ -351,8 +329,8 @@ class EnvProcess:
         # Reset AI framebuffers
         ai_framebuffers = {}
 
-        # Reset actions
-        action = {
+        # Reset actions. AI agents whose policy fails to compute an action do nothing.
+        noop_action = {
             agent_key: (
                 crowdplay_environments[self.task_id]["noop_action"]
                 if "noop_action" in crowdplay_environments[self.task_id]
@@ -366,6 +344,7 @@ class EnvProcess:
             )
             for agent_key in self.env.list_of_agents
         }
+        action = dict(noop_action)
         action_step_iter = {agent_key: -1 for agent_key in self.env.list_of_agents}
         # We keep another dict that tells us if each agent has completely lifted all keypresses since their last action.
         # In turn-based environments this tells us if the agent is ready for their next action / turn.
@@ -379,7 +358,7 @@ class EnvProcess:
                 episode_callables[callable] = crowdplay_environments[self.task_id]["task_callables"][callable]()
                 episode_callables_state[callable] = 0
 
-        self.command_child.send(("episode_starting", {"game_id": game_id}))
+        self.send_to_runner("episode_starting", {"game_id": game_id})
 
         # Send data to client and append for DB
         if hasattr(self.env, "crowdplay_render"):
@@ -444,6 +423,7 @@ class EnvProcess:
                         for agent in [a for a in self.agents if self.agents[a][0] == 1]
                     ]
                 ):
+                    yield EPISODE_WAITING
                     continue
 
             # Get AI agent actions
@@ -459,10 +439,15 @@ class EnvProcess:
                         )
                         ai_framebuffers[agent_id] = registered_ai_framebuffers[ai_policy_id]()
                     # Get AI action
-                    ac = self.ai_policies[agent_id].compute_action(ai_framebuffers[agent_id].get_obs())
-                    # Convert AI action to int insteand of numpy.int64 to be able to save to DB
-                    # TODO we need a way to serialise numpy types!!!
-                    action[agent_id] = {key: int(ac[key]) for key in ac}
+                    try:
+                        ac = self.ai_policies[agent_id].compute_action(ai_framebuffers[agent_id].get_obs())
+                    except AiPolicyError:
+                        logger.warn(f"No action from AI policy for agent {agent_id} in game {game_id}, doing nothing.")
+                        action[agent_id] = noop_action[agent_id]
+                    else:
+                        # Convert AI action to int insteand of numpy.int64 to be able to save to DB
+                        # TODO we need a way to serialise numpy types!!!
+                        action[agent_id] = {key: int(ac[key]) for key in ac}
                     action_step_iter[agent_id] = step_iter
 
             # Actual env step
@@ -499,32 +484,22 @@ class EnvProcess:
                     episode_end = "stopped"
                     break
 
+                # Callables don't modify the step, so task and episode callables all get the same one. Features of the
+                # RAM are only computed once for all of them, see environment_callables.RamFeatureCache.
+                callable_step_info = {
+                    "prev_obs": prev_obs,
+                    "action": action,
+                    "action_step_iter": action_step_iter,
+                    "obs": obs,
+                    "reward": reward,
+                    "done": done,
+                    "info": info,
+                    "step_iter": step_iter,
+                }
                 for callable in self.task_callables:
-                    self.task_callables_state[callable] = self.task_callables[callable](
-                        {
-                            "prev_obs": prev_obs,
-                            "action": action,
-                            "action_step_iter": action_step_iter,
-                            "obs": obs,
-                            "reward": reward,
-                            "done": done,
-                            "info": info,
-                            "step_iter": step_iter,
-                        }
-                    )
+                    self.task_callables_state[callable] = self.task_callables[callable](callable_step_info)
                 for callable in episode_callables:
-                    episode_callables_state[callable] = episode_callables[callable](
-                        {
-                            "prev_obs": prev_obs,
-                            "action": action,
-                            "action_step_iter": action_step_iter,
-                            "obs": obs,
-                            "reward": reward,
-                            "done": done,
-                            "info": info,
-                            "step_iter": step_iter,
-                        }
-                    )
+                    episode_callables_state[callable] = episode_callables[callable](callable_step_info)
 
                 client_task_info = {agent: [] for agent in self.agents}
                 for agent in self.agents:
@@ -587,9 +562,7 @@ class EnvProcess:
                     # TODO reimplement bonus estimate
                     # client_obs[agent]['Estimated Bonus Payment'] = f'{self.task_bonus[agent]:.2f} $'
                     if self.task_done[agent] >= 1 and not self.task_done_notified[agent] and self.agents[agent][0] == 1:
-                        self.database_queue_priority.put(
-                            ("completion_to_db", self.instance_id, self.task_done[agent], self.task_bonus[agent], agent)
-                        )
+                        self.task_completion_to_db(self.task_done[agent], self.task_bonus[agent], agent)
                         self.task_done_notified[agent] = True
 
                 user_types = {agent: self.agents[agent][0] for agent in self.agents}
@@ -619,23 +592,24 @@ class EnvProcess:
                 #     "step_iter": step_iter,
                 #     "user_type": user_types
                 # })
-                self.trajectory.append(
-                    copy.deepcopy(
-                        {
-                            "prev_obs": prev_obs,
-                            "action": action,
-                            "action_step_iter": action_step_iter,
-                            # "obs": obs,
-                            "reward": reward,
-                            "done": done,
-                            "info": info,
-                            "step_iter": step_iter,
-                            "user_type": user_types,
-                            "task_callables": self.task_callables_state,
-                            "episode_callables": episode_callables_state,
-                        }
-                    )
+                # The recorder copies all values into its own buffers, so no deepcopy is needed here.
+                self.trajectory.record(
+                    {
+                        "prev_obs": prev_obs,
+                        "action": action,
+                        "action_step_iter": action_step_iter,
+                        # "obs": obs,
+                        "reward": reward,
+                        "done": done,
+                        "info": info,
+                        "step_iter": step_iter,
+                        "user_type": user_types,
+                        "task_callables": self.task_callables_state,
+                        "episode_callables": episode_callables_state,
+                    }
                 )
+                if len(self.trajectory) >= Config.TRAJECTORY_CHUNK_STEPS:
+                    self.flush_trajectory_chunk(game_id)
 
                 # Store previous obs
                 prev_obs = obs
@@ -645,43 +619,56 @@ class EnvProcess:
                 episode_end = "done"
                 break
 
-            # Sleep until end of regular 1/fps intervals.
-            time.sleep(max(0.00001, next_frame_time - time.time()))
-            next_frame_time += 1 / self.fps
+            yield EPISODE_FRAME
 
         # Now at end of episode.
-        self.episode_end_to_db(game_id, episode_callables_state)
         if episode_end is False and (
             self.env_process_exit_event.is_set() or self.env_process_stop_episode_event.is_set()
         ):
             episode_end = "stopped"
         logger.info(f"Episode with id {game_id} in EnvProcess {self.instance_id} ended. Reason: {episode_end}")
 
-        for agent in self.agents:
-            if self.agents[agent][0] == 1:
-                self.database_queue_priority.put(
-                    ("completion_to_db", self.instance_id, self.task_done[agent], self.task_bonus[agent], agent)
-                )
-            # self.task_completion_to_db(self.task_done[agent], self.task_bonus[agent], agent)
-
+        # Tell clients first, the DB bookkeeping below doesn't need to hold up the end-of-game screen.
+        # The EnvRunner ranks the callable values among all players (see score_index.py).
+        task_callable_values, episode_callable_values = self.callable_values(episode_callables_state)
         # TODO: multiagent? might not be the end for some agents
-        self.command_child.send(("episode_end", {"reason": episode_end, "game_id": game_id}))
+        self.send_to_runner(
+            "episode_end",
+            {
+                "reason": episode_end,
+                "game_id": game_id,
+                "task_callables": task_callable_values,
+                "episode_callables": episode_callable_values,
+            },
+        )
         # for agent_key in self.agents:
         #     room = f'{self.instance_id}_{agent_key}'
         #     self.notify_client(episode_end, room)
 
-        # We put the enqueue operation into a separate thread / process
-        # so that it doesn't block the main thread.
-        self.database_queue.put(("episode_to_db", game_id, self.trajectory.copy()))
+        # All callable values go to the DB writer as one message, which writes them in one transaction.
+        self.episode_end_to_db(game_id, task_callable_values, episode_callable_values)
+        for agent in self.agents:
+            if self.agents[agent][0] == 1:
+                self.task_completion_to_db(self.task_done[agent], self.task_bonus[agent], agent)
 
-        # Empty step infos so we can start the next episode.
-        # self.step_infos_for_db = []
-        self.trajectory = []
+        # We put the enqueue operation into a separate thread / process
+        # so that it doesn't block the main thread. The remaining steps are the last chunk of the trajectory.
+        if len(self.trajectory) > 0 or self.trajectory_chunk_index == 0:
+            self.flush_trajectory_chunk(game_id)
 
         self.env_process_episode_running_event.clear()
 
         logger.info(f"Episode thread with id {game_id} in EnvProcess {self.instance_id} exiting.")
 
+    def flush_trajectory_chunk(self, game_id):
+        """Sends the steps recorded since the last chunk to the DB writer, and empties the recorder.
+
+        The recorder's buffers are handed to the TrajectoryEncoder without copying them, which encodes them in its own
+        thread."""
+        self.trajectory_encoder.put(self.instance_id, game_id, self.trajectory_chunk_index, self.trajectory.to_columns())
+        self.trajectory_chunk_index += 1
+        self.trajectory.reset()
+
     # def run_episode(self):
     #     while True:
     #         pass
@@ -689,18 +676,17 @@ class EnvProcess:
     #     pass
 
     def step_to_clients(self, step_info):
-        """Sends step data to main process to be sent to clients."""
+        """Sends step data to main process to be sent to clients.
+
+        Frames are written raw into the shared frame buffer, and only serialized in the main process,
+        for those steps that it actually sends to clients. Steps are tagged with the game id, so that the main process
+        can drop steps of an episode that it has stopped."""
         step_iter = step_info["step_iter"]
-        obs_extra_all_agents = observation_to_serializable(step_info["obs"], image_to="base64")
 
         data_to_send_all_agents = []
 
         for agent_key in self.env.list_of_agents:
-            # We send the frame separetly
-
-            # obs_image = obs_extra_all_agents[agent_key]["image"]
-            obs = obs_extra_all_agents[agent_key]
-            # del obs_extra["image"]
+            obs = step_info["obs"][agent_key]
 
             reward = float(step_info["reward"][agent_key])
             done = step_info["done"][agent_key]
@@ -728,125 +714,56 @@ class EnvProcess:
 
             data_to_send_all_agents.append((room, data_to_send))
 
-        self.step_info_send.send(data_to_send_all_agents)
+        self.frame_buffer.write((self.game_id, data_to_send_all_agents))
 
     def episode_start_to_db(self, game_id):
-        """Inserts episode start into database."""
-        insert_episode_query = """
-            INSERT INTO games (
-                id,
-                env_instance_id,
-                started_on
-            )
-            VALUES ( %s, %s, %s )
-            """
-        data = (game_id, self.instance_id, datetime.utcnow())
-        with self.conn.cursor() as cursor:
-            cursor.execute(insert_episode_query, data)
-            self.conn.commit()
-            cursor.close()
-
-    def episode_end_to_db(self, game_id, episode_callables_state):
-        """Inserts episode end into database."""
-        update_episode_query = """
-            UPDATE games SET ended_on = %s WHERE id = %s
-            """
-        data = (datetime.utcnow(), game_id)
-        with self.conn.cursor() as cursor:
-            cursor.execute(update_episode_query, data)
-            self.conn.commit()
-            cursor.close()
-        with self.conn.cursor() as cursor:
-            for callable in self.task_callables_state:
-                for agent in self.task_callables_state[callable]:
-                    # Track overall task progress.
-                    update_env_task_completion_query = """
-                        REPLACE INTO task_callable_per_env (env_instance_id, agent_key, callable_key, value_achieved,
-                        value_required) VALUES ( %s, %s, %s, %s, %s )
-                        """  # noqa: E501
-                    data = (
-                        self.instance_id,
-                        agent,
-                        callable,
-                        str(self.task_callables_state[callable][agent]),
-                        str(crowdplay_environments[self.task_id]["task_requirements"][callable])
-                        if (
-                            "task_requirements" in crowdplay_environments[self.task_id]
-                            and callable in crowdplay_environments[self.task_id]["task_requirements"]
-                        )
-                        else "",
-                    )
-                    cursor.execute(update_env_task_completion_query, data)
-                    self.conn.commit()
-                    # Track task progress at end of this episode for debugging / logging purposes.
-                    update_env_task_completion_query_episode = """
-                        REPLACE INTO task_callable_per_game (env_instance_id, episode_id, agent_key, callable_key,
-                        value_achieved, value_required) VALUES ( %s, %s, %s, %s, %s, %s )
-                        """
-                    data = (
-                        self.instance_id,
-                        game_id,
-                        agent,
-                        callable,
-                        str(self.task_callables_state[callable][agent]),
-                        str(crowdplay_environments[self.task_id]["task_requirements"][callable])
-                        if (
-                            "task_requirements" in crowdplay_environments[self.task_id]
-                            and callable in crowdplay_environments[self.task_id]["task_requirements"]
-                        )
-                        else "",
-                    )
-                    cursor.execute(update_env_task_completion_query_episode, data)
-                    self.conn.commit()
-            for callable in episode_callables_state:
-                for agent in episode_callables_state[callable]:
-                    # Track task progress for just this episode
-                    episode_callable_query = """
-                        REPLACE INTO episode_callable (env_instance_id, episode_id, agent_key, callable_key,
-                        value_achieved, value_required) VALUES ( %s, %s, %s, %s, %s, %s )
-                        """
-                    data = (
-                        self.instance_id,
-                        game_id,
-                        agent,
-                        callable,
-                        str(episode_callables_state[callable][agent]),
-                        str(crowdplay_environments[self.task_id]["task_requirements"][callable])
-                        if (
-                            "task_requirements" in crowdplay_environments[self.task_id]
-                            and callable in crowdplay_environments[self.task_id]["task_requirements"]
-                        )
-                        else "",
-                    )
-                    cursor.execute(episode_callable_query, data)
-                    self.conn.commit()
-            cursor.close()
+        """Sends episode start to the DB writer."""
+        self.database_queue.put(("episode_start", self.instance_id, game_id, datetime.utcnow()))
+
+    def callable_values(self, episode_callables_state):
+        """Returns the values of all callables at the end of an episode, as stored in the DB."""
+        task_requirements = crowdplay_environments[self.task_id]["task_requirements"]
+
+        # (agent, callable, value achieved, value required, value numeric, value kind), see
+        # db_models.callable_value_to_number().
+        def callable_value(agent, callable, value):
+            value_required = str(task_requirements[callable]) if callable in task_requirements else ""
+            return (agent, callable, str(value), value_required) + callable_value_to_number(value)
+
+        # Task callables track overall task progress, episode callables progress in just this episode.
+        task_callable_values = [
+            callable_value(agent, callable, self.task_callables_state[callable][agent])
+            for callable in self.task_callables_state
+            for agent in self.task_callables_state[callable]
+        ]
+        episode_callable_values = [
+            callable_value(agent, callable, episode_callables_state[callable][agent])
+            for callable in episode_callables_state
+            for agent in episode_callables_state[callable]
+        ]
+        return task_callable_values, episode_callable_values
+
+    def episode_end_to_db(self, game_id, task_callable_values, episode_callable_values):
+        """Sends episode end and the values of all callables to the DB writer."""
+        self.database_queue.put(
+            ("episode_end", self.instance_id, game_id, datetime.utcnow(), task_callable_values, episode_callable_values)
+        )
 
     def task_completion_to_db(self, completion_value, bonus_value, agent_id):
-        """Update task completion into database."""
-        insert_episode_query = """
-            UPDATE sessions SET completed=%s, bonus=%s
-            WHERE env_instance_id=%s AND agent_key=%s
-            """
-        data = (completion_value, bonus_value, self.instance_id, agent_id)
-        with self.conn.cursor() as cursor:
-            cursor.execute(insert_episode_query, data)
-            self.conn.commit()
-            cursor.close()
+        """Sends task completion to the DB writer, and the same value to the EnvRunner for the completion counts."""
+        self.database_queue.put(("completion_to_db", self.instance_id, completion_value, bonus_value, agent_id))
+        self.send_to_runner("completion", {"agent_id": agent_id, "completed": completion_value})
+
+    def send_to_runner(self, cmd, data):
+        """Sends a command to the EnvRunner."""
+        with self.command_lock:
+            self.command_child.send((cmd, data))
 
     def assign_agent(self, agent_id, assign_to):
         """Assigns an agent"""
         if agent_id in self.agents:
             if self.agents[agent_id][0] == 1:
-                self.database_queue_priority.put(
-                    (
-                        "completion_to_db",
-                        self.instance_id,
-                        self.task_done[agent_id],
-                        self.task_bonus[agent_id],
-                        agent_id,
-                    )
-                )
+                self.task_completion_to_db(self.task_done[agent_id], self.task_bonus[agent_id], agent_id)
             self.agents[agent_id] = assign_to
         else:
             logger.error(f"Error: agent key {agent_id} doesn't exist in instance {self.instance_id}")
@@ -859,25 +776,24 @@ class EnvProcess:
         if hasattr(self, "episode_thread"):
             logger.info(f"EnvProcess {self.instance_id} waiting for episode thread to finish.")
             self.episode_thread.join()
-        self.database_exit_event.set()
-        self.database_queue.close()
-        self.database_queue_priority.close()
         self.env_process_stop_episode_event.set()
+        for ai_policy in self.ai_policies.values():
+            if isinstance(ai_policy, RemotePolicy):
+                ai_policy.close()
+        # Trajectory chunks that are still being encoded have to be sent before the instance is closed.
+        self.trajectory_encoder.close()
         self.mark_envprocess_status_code(1)
+        # This is the last message, the DBWriter sets our event once it has written it and everything before it.
+        self.database_queue.put(("instance_closed", self.instance_id, self.database_event_index))
+        if self.worker_slot_index is None:
+            # Make sure everything has been sent before the EnvRunner may terminate this process.
+            self.database_queue.close()
+            self.database_queue.join_thread()
         self.env_process_is_finished_event.set()
         logger.info(f"EnvProcess {self.instance_id} closed.")
 
     def mark_envprocess_status_code(self, status_code):
-        logger.info(f"EnvProcess {self.instance_id} updating status code to {status_code}.")
-        updatequery = """
-        UPDATE crowdplaydb.envs SET crowdplaydb.envs.envprocess_status_code = %s WHERE crowdplaydb.envs.instance_id=%s;
-        """
-        data = (status_code, self.instance_id)
-        with self.conn.cursor() as cursor:
-            cursor.execute(updatequery, data)
-            self.conn.commit()
-            cursor.close()
-        logger.info(f"EnvProcess {self.instance_id} updated status code to {status_code}.")
+        self.database_queue.put(("envprocess_status", self.instance_id, status_code))
 
 
 def run_env_process(
@@ -885,47 +801,96 @@ def run_env_process(
     task_id,
     command_child,
     action_recv,
-    step_info_send,
+    frame_buffer,
     env_process_exit_event,
     env_process_episode_running_event,
     env_process_stop_episode_event,
     env_process_is_finished_event,
     database_queue,
-    database_queue_priority,
+    database_event_index,
     fps,
+    inference_queues,
+    env_process_ready_event,
 ):
     env_process = EnvProcess(
         instance_id,
         task_id,
         command_child,
         action_recv,
-        step_info_send,
+        frame_buffer,
         env_process_exit_event,
         env_process_episode_running_event,
         env_process_stop_episode_event,
         env_process_is_finished_event,
         database_queue,
-        database_queue_priority,
+        database_event_index,
         fps,
+        inference_queues=inference_queues,
+        env_process_ready_event=env_process_ready_event,
     )
     env_process.run()
     pass
 
 
+# EnvSpaces of each task, by task id. Only the EnvProcess needs the actual environment, so the web process makes one
+# environment per task to read its spaces, instead of one per instance.
+task_spaces = {}
+
+
+def get_task_spaces(task_id):
+    if task_id not in task_spaces:
+        env = crowdplay_environments[task_id]["make_env"]()
+        task_spaces[task_id] = EnvSpaces.from_env(env)
+        env.close()
+    return task_spaces[task_id]
+
+
 class EnvRunner:
-    def __init__(self, make_env, instance_id, task_id, fps=60, seed=None):
+    def __init__(
+        self,
+        make_env,
+        instance_id,
+        task_id,
+        db_writer,
+        database_event_index,
+        fps=60,
+        seed=None,
+        worker_slot=None,
+        warm=False,
+        inference_queues=None,
+    ):
+        """
+        Args:
+            db_writer: The DBWriter (see db_writer.py) that writes the instance's data to the DB.
+            database_event_index: Index of the DBWriter event leased for this instance, or None if none was free.
+            worker_slot: A WorkerSlot leased from an EnvWorkerPool (see env_worker.py) to run this instance on a shared
+                worker process. If None, the instance gets its own EnvProcess.
+            warm: Started ahead of time for a WarmPool (see warm_pool.py). Nobody waits for players to join until the
+                runner is claimed.
+            inference_queues: Queues and ready events of InferenceServers by AI policy id, passed on to the
+                EnvProcess.
+        """
         # TODO remove make_env, seed
         super().__init__()
+        self.worker_slot = worker_slot
+        self.inference_queues = inference_queues
+        self.db_writer = db_writer
+        self.database_event_index = database_event_index
+        if database_event_index is not None:
+            self.database_process_is_finished_event = db_writer.instance_events[database_event_index]
+        else:
+            # Don't wait for the DBWriter when stopping.
+            self.database_process_is_finished_event = multiprocessing.Event()
+            self.database_process_is_finished_event.set()
 
         # Basic info, won't change.
         self.instance_id = instance_id
         self.task_id = task_id
 
-        # Observation and action spaces
-        self.env = crowdplay_environments[task_id]["make_env"]()
-        # TODO either make and delete env, or start background process and wait for env ready state?
-        self.observation_space = self.env.observation_space
-        self.action_space = self.env.action_space
+        # Observation and action spaces, the EnvProcess has the actual environment.
+        self.spaces = get_task_spaces(task_id)
+        self.observation_space = self.spaces.observation_space
+        self.action_space = self.spaces.action_space
 
         # Data structure that maps agent_id to connected human or AI player,
         # or None if agent is available for new connection.
@@ -933,75 +898,96 @@ class EnvRunner:
         # (1, None): Human agent assigned, but pending
         # (1, sid): Human aggent, connected
         # (2, policy_id_string): AI agent with given policy
-        self.agents = {agent: (None, None) for agent in self.env.list_of_agents}
+        self.agents = {agent: (None, None) for agent in self.spaces.list_of_agents}
+        # Agents that have been played by a human, who has a session for it.
+        self.human_agents = set()
+        # Called with (instance_id, agent_id, assign_to) whenever an agent is assigned, see instance_registry.py.
+        self.on_assign_agent = None
+
+        if worker_slot is not None:
+            # Everything needed to talk to the worker was created with the slot, and the worker runs the instance.
+            self.command_parent, self.command_child = worker_slot.command_parent, worker_slot.command_child
+            self.action_recv, self.action_send = worker_slot.action_recv, worker_slot.action_send
+            self.frame_buffer = worker_slot.frame_buffer
+            self.env_process_exit_event = worker_slot.exit_event
+            self.env_process_episode_running_event = worker_slot.episode_running_event
+            self.env_process_stop_episode_event = worker_slot.stop_episode_event
+            self.env_process_is_finished_event = worker_slot.is_finished_event
+            self.env_process_ready_event = worker_slot.ready_event
+            self.env_process = None
+        else:
+            self.start_processes(fps)
+        # Skip any step the previous instance using the same frame buffer left behind.
+        self.frame_buffer_sequence = self.frame_buffer.sequence
+        # Step message format negotiated by each client, by room. Rooms not in here get the default format.
+        self.step_formats = {}
+        # Rarely changing data last sent to each client using the binary step format.
+        self.binary_step_extras = {}
+        # Delta frame encoders of clients using the binary step format with delta frames, by room.
+        self.frame_encoders = {}
+        # Palette encoders of clients using the binary step format with palette frames, by room.
+        self.palette_encoders = {}
+        # Adaptive quality and frame rate controllers of clients that acknowledge steps, by room.
+        self.stream_controllers = {}
+
+        self._episode_is_running = False
+        self._stop_runner = False
+        self.game_id = None
+        # When the current episode was requested, on the monotonic clock.
+        self.episode_start_requested = None
+
+        # Connect AI agents.
+        for agent, ai_policy_id in crowdplay_environments[self.task_id]["ai_agent_map_always"].items():
+            self.assign_agent(agent, (2, ai_policy_id))
+
+        self.fps = fps
+        if "realtime" in crowdplay_environments[task_id]:
+            self.realtime = crowdplay_environments[task_id]["realtime"]
+        else:
+            self.realtime = CROWDPLAY_REALTIME_REALTIME
+
+        # When we started waiting for players to join, or None if the runner is warm and not claimed yet.
+        self.start_time = None if warm else datetime.now()
+
+        # start main loop
+        socketio.start_background_task(self._command_loop, current_app._get_current_object())
 
+    def start_processes(self, fps):
+        """Starts a dedicated EnvProcess for this instance."""
         # Pipes for communication
         self.command_parent, self.command_child = multiprocessing.Pipe()
         self.action_recv, self.action_send = multiprocessing.Pipe(duplex=False)
-        # TODO would a queue be faster here too?! See below.
-        self.step_info_client_recv, self.step_info_client_send = multiprocessing.Pipe(duplex=False)
+        # Latest step data is shared through shared memory instead, so that we never pickle frames we don't send.
+        self.frame_buffer = SharedFrameBuffer(Config.FRAME_BUFFER_BYTES)
         # self.agent_command_parent, self.agent_comand_child = multiprocessing.Pipe()
 
         self.env_process_exit_event = multiprocessing.Event()
         self.env_process_episode_running_event = multiprocessing.Event()
         self.env_process_stop_episode_event = multiprocessing.Event()
         self.env_process_is_finished_event = multiprocessing.Event()
-
-        self.database_process_is_finished_event = multiprocessing.Event()
-        # For some reason using a Pipe instead here is really bad for performance.
-        # Leads to visible hangs in the game whenever a batch of steps is sent through the Pipe.
-        self.database_queue = multiprocessing.Queue()
-        self.database_queue_priority = multiprocessing.Queue()
-        self.database_process = multiprocessing.Process(
-            target=step_enqueue_process_fn,
-            args=(
-                self.database_queue,
-                self.database_queue_priority,
-                list(self.agents.keys()),
-                self.instance_id,
-                self.env_process_exit_event,
-                self.database_process_is_finished_event,
-            ),
-        )
-        self.database_process.start()
+        self.env_process_ready_event = multiprocessing.Event()
 
         self.env_process = multiprocessing.Process(
             target=run_env_process,
             args=(
-                instance_id,
-                task_id,
+                self.instance_id,
+                self.task_id,
                 self.command_child,
                 self.action_recv,
-                self.step_info_client_send,
+                self.frame_buffer,
                 self.env_process_exit_event,
                 self.env_process_episode_running_event,
                 self.env_process_stop_episode_event,
                 self.env_process_is_finished_event,
-                self.database_queue,
-                self.database_queue_priority,
+                self.db_writer.queue,
+                self.database_event_index,
                 fps,
+                self.inference_queues,
+                self.env_process_ready_event,
             ),
         )
         self.env_process.start()
 
-        self._episode_is_running = False
-        self._stop_runner = False
-
-        # Connect AI agents.
-        for agent, ai_policy_id in crowdplay_environments[self.task_id]["ai_agent_map_always"].items():
-            self.assign_agent(agent, (2, ai_policy_id))
-
-        self.fps = fps
-        if "realtime" in crowdplay_environments[task_id]:
-            self.realtime = crowdplay_environments[task_id]["realtime"]
-        else:
-            self.realtime = CROWDPLAY_REALTIME_REALTIME
-
-        self.start_time = datetime.now()
-
-        # start main loop
-        socketio.start_background_task(self._command_loop, current_app._get_current_object())
-
     # def __del__(self):
     #     # TODO this doesn't seem to be working / isn't called. Figure out where to do cleanup.
     #     logger.info(f'EnvRunner {self.instance_id} deleted.')
@@ -1013,13 +999,20 @@ class EnvRunner:
             if self.command_parent.poll():
                 cmd, data = self.command_parent.recv()
                 if cmd == "episode_end":
+                    self.record_scores(data["game_id"], data["task_callables"], data["episode_callables"])
                     self.on_episode_end(data["game_id"], data["reason"])
+                elif cmd == "completion":
+                    # Sent along with every completion_to_db, so the counts match the DB.
+                    completion_counts.record_completion(
+                        self.task_id, self.instance_id, data["agent_id"], data["completed"]
+                    )
                 elif cmd == "episode_starting":
                     self.mark_episode_started(data["game_id"])
             elif self._stop_runner:
                 break
             if (
                 "human_timeout" in crowdplay_environments[self.task_id]
+                and self.start_time is not None
                 and datetime.now() - self.start_time > crowdplay_environments[self.task_id]["human_timeout"]
             ):
                 for agent in self.agents:
@@ -1043,18 +1036,28 @@ class EnvRunner:
     def _step_to_client_loop(self, app):
         """Waits for step_info from EnvProcess and sends to client."""
         while self._episode_is_running:
-            if self.step_info_client_recv.poll():
-                # Receive until queue empty, send only latest data.
-                # If we're too slow, we prefer to drop frames, rather than send them slow-motion.
-                while self.step_info_client_recv.poll():
-                    step_info = self.step_info_client_recv.recv()
-                self.step_to_client(step_info)
+            # Only ever read the latest step.
+            # If we're too slow, we prefer to drop frames, rather than send them slow-motion.
+            latest = self.frame_buffer.read(since=self.frame_buffer_sequence)
+            if latest is not None:
+                self.frame_buffer_sequence, (game_id, step_info) = latest
+                # Steps of a stopped episode that is still finishing up aren't sent as the new one's.
+                if game_id == self.game_id:
+                    self.step_to_client(step_info)
             socketio.sleep(1 / (4 * self.fps))
 
+    def claim(self):
+        """Hands out a warm runner to players, see warm_pool.py."""
+        self.start_time = datetime.now()
+
     def assign_agent(self, agent_id, assign_to):
         """Assigns an agent"""
         if agent_id in self.agents:
             self.agents[agent_id] = assign_to
+            if assign_to[0] == 1:
+                self.human_agents.add(agent_id)
+            if self.on_assign_agent is not None:
+                self.on_assign_agent(self.instance_id, agent_id, assign_to)
             self.command_parent.send(("assign_agent", {"agent_id": agent_id, "assign_to": assign_to}))
         else:
             logger.error(f"Error: agent key {agent_id} doesn't exist in instance {self.instance_id}")
@@ -1069,17 +1072,153 @@ class EnvRunner:
         self.command_parent.send(("set_fps", fps))
         self.fps = fps
 
+    def set_step_format(self, agent_id, step_format):
+        """Sets the step message format for the client connected as agent_id, see utils.negotiate_step_format()."""
+        room = f"{self.instance_id}_{agent_id}"
+        self.binary_step_extras.pop(room, None)
+        self.frame_encoders.pop(room, None)
+        self.palette_encoders.pop(room, None)
+        self.stream_controllers.pop(room, None)
+        if step_format is not None and step_format.get("adaptive"):
+            self.stream_controllers[room] = StreamController()
+        if step_format is not None and step_format.get("delta"):
+            self.frame_encoders[room] = DeltaFrameEncoder()
+        if step_format is not None and step_format["image_format"] == PALETTE_FORMAT:
+            self.palette_encoders[room] = PaletteEncoder()
+        if step_format is None:
+            self.step_formats.pop(room, None)
+        else:
+            self.step_formats[room] = step_format
+
+    def ack_step(self, agent_id, step_iter):
+        """Records that the client connected as agent_id has shown step step_iter, see stream_controller.py."""
+        stream_controller = self.stream_controllers.get(f"{self.instance_id}_{agent_id}")
+        if stream_controller is not None:
+            stream_controller.on_ack(step_iter)
+
+    def stream_metrics(self):
+        """Returns the streaming decisions and measurements of all clients with adaptive streaming, by agent."""
+        prefix = f"{self.instance_id}_"
+        return {room[len(prefix) :]: controller.metrics() for room, controller in self.stream_controllers.items()}
+
     def step_to_client(self, step_info):
-        """Sends step data to clients. Takes already processed data."""
+        """Sends step data to clients. Takes already processed data, except for observations."""
+        # Encoded images of this step, shared by all rooms. Players of the same game see the same frame, which only
+        # has to be encoded once for each format.
+        encoded = {}
         for room, data_to_send in step_info:
-            self.notify_client("step", room, data=data_to_send)
+            step_format = self.step_formats.get(room)
+            stream_controller = self.stream_controllers.get(room)
+            if stream_controller is not None:
+                if not stream_controller.should_send():
+                    continue
+                start = time.perf_counter()
+                self.notify_client("step_binary", room, data=self.binary_step(room, data_to_send, step_format, encoded))
+                stream_controller.on_sent(data_to_send["step_iter"], time.perf_counter() - start)
+            elif step_format is not None and step_format["binary"]:
+                self.notify_client("step_binary", room, data=self.binary_step(room, data_to_send, step_format, encoded))
+            else:
+                data_to_send["obs"] = observation_to_serializable(
+                    data_to_send["obs"], image_to="base64", encoded=encoded
+                )
+                self.notify_client("step", room, data=data_to_send)
+
+    def binary_step(self, room, data_to_send, step_format, encoded=None):
+        """Builds a binary step message.
+
+        The message has a compact header [step_iter, reward, done, score] under "h", and the encoded image as a binary
+        attachment under "i". All other step data is only sent under "x" when it has changed since the last message.
+        With delta frames, "i" is only the changed tiles of the image, whose positions are sent under "t"
+        (None for keyframes), see frame_codec.DeltaFrameEncoder.encode().
+        With palette frames, "i" is the zlib compressed palette indices of the image, whose [height, width] is sent
+        under "p", and the palette is sent with the other step data under "x".
+        Delta and palette frames depend on what was sent to the room before, so only other images are shared between
+        rooms through encoded, see utils.encode_image_once().
+        Images are downscaled by the room's StreamController in all formats. Palette frames are scaled by dropping
+        pixels, which keeps them in the palette, and a delta frame of a different size is always a keyframe.
+        """
+        message = {
+            "h": [data_to_send["step_iter"], data_to_send["reward"], data_to_send["done"], data_to_send["score"]],
+        }
+        stream_controller = self.stream_controllers.get(room)
+        quality = stream_controller.quality if stream_controller is not None else None
+        scale = stream_controller.scale if stream_controller is not None else 1.0
+        palette = None
+        if room in self.palette_encoders:
+            image, image_key, obs = split_observation_image(data_to_send["obs"])
+            message["i"] = None
+            if image is not None:
+                try:
+                    indices = self.palette_encoders[room].encode(scale_image(image, scale, cv2.INTER_NEAREST))
+                    message["i"] = zlib.compress(indices.tobytes(), 1)
+                    message["p"] = list(indices.shape)
+                    palette = self.palette_encoders[room].palette.tolist()
+                except ValueError:
+                    # Not a palette-based game. Switch the client to JPEG frames for good.
+                    logger.warning(f"Frames for {room} can't be palette encoded, sending JPEG frames instead.")
+                    del self.palette_encoders[room]
+                    step_format = dict(step_format, image_format="jpeg")
+                    self.step_formats[room] = step_format
+                    self.notify_client("step_format", room, data=step_format)
+                    message["i"] = rgb_array_to_bytes(scale_image(image, scale), IMAGE_FORMATS["jpeg"], quality)
+        elif room in self.frame_encoders:
+            image, image_key, obs = split_observation_image(data_to_send["obs"])
+            message["i"] = None
+            if image is not None:
+                message["i"], message["t"] = self.frame_encoders[room].encode(
+                    scale_image(image, scale), IMAGE_FORMATS[step_format["image_format"]], quality
+                )
+        else:
+            message["i"], image_key, obs = observation_to_binary(
+                data_to_send["obs"], step_format["image_format"], quality, scale, encoded
+            )
+        extra = {
+            "obs": obs,
+            "image_key": image_key,
+            "task_info": data_to_send["task_info"],
+            "task_complete": data_to_send["task_complete"],
+            "task_bonus": data_to_send["task_bonus"],
+        }
+        if palette is not None:
+            extra["palette"] = palette
+        if extra != self.binary_step_extras.get(room):
+            self.binary_step_extras[room] = extra
+            message["x"] = extra
+        return message
+
+    def record_scores(self, game_id, task_callable_values, episode_callable_values):
+        """Adds the callable values of human players at the end of a game to the score index."""
+        episode_values = {
+            (agent, callable): stored_callable_value(value_numeric, value_kind, value)
+            for agent, callable, value, _, value_numeric, value_kind in episode_callable_values
+        }
+        for agent, callable, value, _, value_numeric, value_kind in task_callable_values:
+            # Only human players have sessions, and only sessions are ranked.
+            if agent in self.human_agents and (agent, callable) in episode_values:
+                score_index.record_episode(
+                    self.task_id,
+                    callable,
+                    self.instance_id,
+                    game_id,
+                    agent,
+                    stored_callable_value(value_numeric, value_kind, value),
+                    episode_values[(agent, callable)],
+                )
 
     def on_episode_end(self, game_id, reason):
         """Sets episode running state to False and notifies clients of episode end."""
+        if game_id != self.game_id:
+            # A previous episode that was stopped has finished, the current one is already running.
+            return
         self._episode_is_running = False
         for agent_key in self.agents:
             room = f"{self.instance_id}_{agent_key}"
             self.notify_client(reason, room)
+        # Start the next episode with full frames.
+        for frame_encoder in self.frame_encoders.values():
+            frame_encoder.request_keyframe()
+        for stream_controller in self.stream_controllers.values():
+            stream_controller.reset()
 
     def start_episode(self):
         """Starts an episode, if there is not already one running"""
@@ -1093,9 +1232,12 @@ class EnvRunner:
 
             self.broadcast("starting", self.game_id)
 
+            # Don't wait for the EnvProcess to confirm, clients get steps as soon as it writes them. Steps left in the
+            # frame buffer from the previous episode are skipped.
             self.command_parent.send(("start_episode", {"game_id": self.game_id}))
-            while not self._episode_is_running:
-                socketio.sleep(0.001)
+            self.episode_start_requested = time.monotonic()
+            self.frame_buffer_sequence = self.frame_buffer.sequence
+            self._episode_is_running = True
             socketio.start_background_task(self._step_to_client_loop, current_app._get_current_object())
 
             self.broadcast("started", self.game_id)
@@ -1103,13 +1245,20 @@ class EnvRunner:
         return self.game_id
 
     def mark_episode_started(self, game_id):
-        self._episode_is_running = True
+        """Called when the EnvProcess confirms it has started the episode."""
+        if game_id == self.game_id:
+            logger.debug(
+                f"Episode {game_id} in instance {self.instance_id} started "
+                f"{(time.monotonic() - self.episode_start_requested) * 1000:.0f}ms after it was requested."
+            )
 
     def stop_episode(self):
         """Stops the current episode, if there is one running."""
         # Stopping episode by setting this flag
         self._episode_is_running = False
-        self.command_parent.send(("stop_episode", None))
+        self.env_process_stop_episode_event.set()
+        # In case the EnvProcess hasn't started the episode yet, see EnvProcess.process_command().
+        self.command_parent.send(("stop_episode", {"game_id": self.game_id}))
         # TODO should we wait for episode to finish?
 
     def stop_runner(self):
@@ -1117,10 +1266,8 @@ class EnvRunner:
         # TODO Implement properly
         logger.info(f"EnvRunner {self.instance_id} stopping.")
         self.env_process_exit_event.set()
-        while self.step_info_client_recv.poll():
-            self.step_info_client_recv.recv()
-            socketio.sleep(0.01)
         self._stop_runner = True
+        completion_counts.forget_instance(self.instance_id, self.agents)
         # socketio.sleep(1)
         # TODO why does nothing else work?!
         # Not even waiting for an event seems to work. Main process doesn't hang, but EnvProcess persists if we wait.
@@ -1138,13 +1285,23 @@ class EnvRunner:
             logger.warn(f"EnvProcess with ID {self.instance_id} did not exit in time and will be killed.")
             self.set_envprocess_exit_status()
         if not self.database_process_is_finished_event.is_set():
-            logger.warn(f"DB process with ID {self.instance_id} did not exit in time and will be killed.")
+            logger.warn(f"DBWriter did not write all data of instance {self.instance_id} in time.")
             self.set_dbprocess_exit_status()
-        self.env_process.terminate()
-        self.env_process.kill()
-        # TODO now not killing DB process, check that this always exits properly!
-        # self.database_process.terminate()
-        # self.database_process.kill()
+        elif self.database_event_index is not None:
+            # Only reuse the event once it is set, otherwise the instance's last message could set it for the next.
+            self.db_writer.release_event(self.database_event_index)
+        if self.worker_slot is not None:
+            # The worker keeps running, only reuse the slot once the instance on it is gone.
+            if self.env_process_is_finished_event.is_set():
+                self.worker_slot.release()
+            else:
+                logger.error(
+                    f"Instance {self.instance_id} did not exit, not reusing slot {self.worker_slot.index} "
+                    f"on env worker {self.worker_slot.worker_index}."
+                )
+        else:
+            self.env_process.terminate()
+            self.env_process.kill()
         # self.command_parent.send(('stop_runner', None))
         # self.env_process.join()
         # self.env_process.close()
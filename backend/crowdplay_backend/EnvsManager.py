@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from functools import partial
 from re import I
 from uuid import uuid4
 
@@ -8,10 +9,13 @@ import gym
 from .ai_policy import (
     MaxAndSkipAndWarpAndScaleAndStackFrameBuffer,
     PretrainedRLLibA2CPolicyCustomModel,
+    registered_ai_policies,
 )
 from .config import Config
 from .db import db
 from .db_models import EnvModel, GameModel
+from .db_writer import DBWriter
+from .env_worker import EnvWorkerPool
 from .environments import crowdplay_environments
 from .EnvRunner import EnvRunner
 from .exceptions import (
@@ -24,7 +28,11 @@ from .exceptions import (
     NoMoreAgents,
     SingletonClass,
 )
+from .inference_server import InferenceServer
+from .instance_registry import InstanceRegistry
 from .logger import getLogger
+from .socketio import socketio
+from .warm_pool import WarmPool
 
 logger = getLogger("EnvsManager")
 
@@ -41,6 +49,16 @@ class EnvsManager:
         return EnvsManager.__instance
 
     env_runners = {}
+    # Indexes of the agents of all env_runners, for matching players to instances.
+    registry = InstanceRegistry()
+    # The process that writes game data of all instances to the DB, started on first use.
+    db_writer = None
+    # Shared worker processes to place instances on, started on first use if Config.ENV_WORKERS is set.
+    worker_pool = None
+    # Instances started ahead of time for new players.
+    warm_pool = None
+    # InferenceServers by AI policy id, started on first use if Config.AI_INFERENCE_SERVERS is set.
+    inference_servers = None
 
     def __init__(self):
         if EnvsManager.__instance is not None:
@@ -57,35 +75,21 @@ class EnvsManager:
         logger.info(f"EnvModel stored: {env_model}")
 
     def _agents_to_assign(self, instance_id):
-        return [
-            agent
-            for agent in self.env_runners[instance_id].agents
-            if self.env_runners[instance_id].agents[agent][0] is None
-        ]
+        return self.registry.agents_to_assign(instance_id)
+
+    def open_instance_ids(self, task_id):
+        """Instances of a task that have an agent available for a new player, oldest first."""
+        return self.registry.open_instance_ids(task_id)
 
     def assign_agent(self, instance_id, agent, assign_to):
         self.get_runner(instance_id).assign_agent(agent, assign_to)
 
     def get_instance_ids_for_sid(self, sid):
-        instances = []
-        for instance_id in self.env_runners:
-            # if (1, sid) in self.env_runners[instance_id].agents.values():
-            for agent in self.env_runners[instance_id].agents.values():
-                if len(agent) >= 2 and agent[1] == sid:
-                    instances.append(instance_id)
-        return instances
+        return self.registry.instance_ids_for_sid(sid)
 
     def get_agent_for_sid(self, instance_id, sid):
-        if instance_id in self.env_runners:
-            # TODO could there ever be two agents with the same sid?
-            agent_keys = list(
-                (
-                    agent
-                    for agent in self.env_runners[instance_id].agents
-                    if self.env_runners[instance_id].agents[agent][1] == sid
-                )
-            )
-            return agent_keys[0]
+        # TODO could there ever be two agents with the same sid?
+        return self.registry.agent_for_sid(instance_id, sid)
 
     def num_total_agents_in_instance(self, instance_id):
         runner = self.get_runner(instance_id)
@@ -120,21 +124,11 @@ class EnvsManager:
         # Reconnect agent to their existing session.
         if assignment_id is not None:
             # Find agent's instance, if any:
-            agents_to_disconnect = []
-            for instance_id in (
-                instance_id for instance_id in self.env_runners if self.env_runners[instance_id].task_id == task_id
-            ):
-                for agent_id in self.env_runners[instance_id].agents:
-                    if (
-                        self.env_runners[instance_id].agents[agent_id][0] == 1
-                        and len(self.env_runners[instance_id].agents[agent_id]) >= 3
-                        and str(self.env_runners[instance_id].agents[agent_id][2]) == str(assignment_id)
-                    ):
-                        agents_to_disconnect.append((instance_id, agent_id))
-                        # Previous logic for connecting user to existing session:
-                        # if self.env_runners[instance_id]._stop_runner == False
-                        #   and not self.env_runners[instance_id].env_process_exit_event.is_set():
-                        #     return instance_id, agent_id
+            agents_to_disconnect = self.registry.agents_for_assignment_id(task_id, assignment_id)
+            # Previous logic for connecting user to existing session:
+            # if self.env_runners[instance_id]._stop_runner == False
+            #   and not self.env_runners[instance_id].env_process_exit_event.is_set():
+            #     return instance_id, agent_id
             # First notify all clients, then disconnect agents.
             for instance_id, agent_id in agents_to_disconnect:
                 room = f"{instance_id}_{agent_id}"
@@ -154,22 +148,17 @@ class EnvsManager:
         # Use task_id to find available envs.
         # Check if any envs for this task have available agent slots.
         # If yes, connect agent to first free agent slot.
-        for instance_id in (
-            instance_id for instance_id in self.env_runners if self.env_runners[instance_id].task_id == task_id
-        ):
-            if len(self._agents_to_assign(instance_id)) > 0:
-                logger.info(f"Returning instance {instance_id} for hit {hit_id}")
-                # Get next available agent
-                agent_key = self._agents_to_assign(instance_id)[0]
-                # Set this agent to human, assigned but not connected yet
-                self.assign_agent(instance_id, agent_key, (1, None, assignment_id))
-                # Return instance_id and agent key
-                return instance_id, agent_key
+        for instance_id in self.open_instance_ids(task_id):
+            logger.info(f"Returning instance {instance_id} for hit {hit_id}")
+            # Get next available agent
+            agent_key = self._agents_to_assign(instance_id)[0]
+            # Set this agent to human, assigned but not connected yet
+            self.assign_agent(instance_id, agent_key, (1, None, assignment_id))
+            # Return instance_id and agent key
+            return instance_id, agent_key
 
         # If no, create new env for this hit.
-        instance_id = uuid4().hex
-
-        self.make_runner(instance_id, task_id, hit_id=hit_id)
+        instance_id = self.make_runner(uuid4().hex, task_id, hit_id=hit_id).instance_id
 
         logger.info(f"Instance {instance_id} on hold with id {hit_id}")
 
@@ -269,24 +258,89 @@ class EnvsManager:
         hit_id=Config.NO_HIT,
         seed=None,
     ):
-        fps = crowdplay_environments[task_id]["fps"] if "fps" in crowdplay_environments[task_id] else 60
-        env_runner = EnvRunner(
-            crowdplay_environments[task_id]["make_env"], instance_id, task_id=task_id, fps=fps, seed=seed
-        )
-
-        self.env_runners[instance_id] = env_runner
+        """Claims a warm runner for the task (see warm_pool.py) if there is one, or starts a new one with instance_id.
+        Use the instance_id of the returned runner, claimed runners have their own."""
+        if self.warm_pool is None:
+            EnvsManager.warm_pool = WarmPool(partial(self.start_runner, warm=True))
+        env_runner = self.warm_pool.claim(task_id) if seed is None else None
+        if env_runner is None:
+            env_runner = self.start_runner(task_id, instance_id, seed=seed)
+
+        self.env_runners[env_runner.instance_id] = env_runner
+        self.registry.add_instance(env_runner.instance_id, task_id, env_runner.agents)
+        env_runner.on_assign_agent = self.registry.set_agent
 
         # logger.info(f'Runner for {env.spec.id} with id {instance_id} created')
 
         return env_runner
 
+    def start_runner(self, task_id, instance_id=None, seed=None, warm=False):
+        """Starts a new EnvRunner, with its EnvProcess or on an env worker."""
+        if instance_id is None:
+            instance_id = uuid4().hex
+        fps = crowdplay_environments[task_id]["fps"] if "fps" in crowdplay_environments[task_id] else 60
+        if self.db_writer is None:
+            EnvsManager.db_writer = DBWriter(
+                Config.DB_WRITER_CONNECTIONS, Config.DB_WRITER_MAX_INSTANCES, Config.DB_WRITER_BATCH_SIZE
+            )
+        database_event_index = self.db_writer.lease_event(instance_id)
+        # Servers have to be started before any process that uses them.
+        if self.inference_servers is None:
+            EnvsManager.inference_servers = self.start_inference_servers() if Config.AI_INFERENCE_SERVERS else {}
+        inference_queues = {
+            policy_id: (server.queue, server.ready_event) for policy_id, server in self.inference_servers.items()
+        }
+        worker_slot = None
+        if Config.ENV_WORKERS > 0:
+            if self.worker_pool is None:
+                EnvsManager.worker_pool = EnvWorkerPool(
+                    Config.ENV_WORKERS, Config.ENV_WORKER_SLOTS, self.db_writer.queue, inference_queues
+                )
+                socketio.start_background_task(self.worker_pool.monitor)
+            # Places the instance on the least-loaded worker.
+            worker_slot = self.worker_pool.place(instance_id, task_id, fps, database_event_index)
+            if worker_slot is None:
+                logger.warn(f"All env workers are full, starting instance {instance_id} in its own processes.")
+        env_runner = EnvRunner(
+            crowdplay_environments[task_id]["make_env"],
+            instance_id,
+            task_id=task_id,
+            db_writer=self.db_writer,
+            database_event_index=database_event_index,
+            fps=fps,
+            seed=seed,
+            worker_slot=worker_slot,
+            warm=warm,
+            inference_queues=inference_queues,
+        )
+        return env_runner
+
+    def start_inference_servers(self):
+        """Starts an InferenceServer for each AI policy used by any task, see inference_server.py."""
+        policy_ids = {
+            policy_id
+            for task in crowdplay_environments.values()
+            for ai_agent_map in (task.get("ai_agent_map_always", {}), task.get("ai_agent_map_fallback", {}))
+            for policy_id in ai_agent_map.values()
+            if policy_id in registered_ai_policies
+        }
+        return {
+            policy_id: InferenceServer(
+                policy_id,
+                registered_ai_policies[policy_id],
+                Config.AI_INFERENCE_BATCH_SIZE,
+            )
+            for policy_id in sorted(policy_ids)
+        }
+
     def stop_runner(self, instance_id):
         try:
             # Stop only if there is a runner
             env_runner = self.get_runner(instance_id)
             del self.env_runners[instance_id]
+            self.registry.remove_instance(instance_id)
 
-            logger.info(f"Stopping env {id(env_runner.env)} with id {instance_id}...")
+            logger.info(f"Stopping env of task {env_runner.task_id} with id {instance_id}...")
 
             env_runner.stop_episode()
             env_runner.stop_runner()
@@ -294,6 +348,20 @@ class EnvsManager:
         except Exception:
             pass
 
+    def shutdown(self):
+        """Stops all instances, including unclaimed warm ones, and then the processes shared by all instances. The
+        DBWriter is stopped last, once everything the instances sent is written."""
+        if self.warm_pool is not None:
+            self.warm_pool.close()
+        for instance_id in list(self.env_runners):
+            self.stop_runner(instance_id)
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        for inference_server in (self.inference_servers or {}).values():
+            inference_server.close()
+        if self.db_writer is not None:
+            self.db_writer.close()
+
     # TODO rename
 
     def close_env(self, instance_id):
@@ -309,6 +377,9 @@ class EnvsManager:
     def observation_space_for(self, instance_id):
         return self.get_runner(instance_id).observation_space
 
+    def spaces_for(self, instance_id):
+        return self.get_runner(instance_id).spaces
+
     def __del__(self):
         for runner in self.env_runners:
             self.close_runner(self.env_runners[runner])
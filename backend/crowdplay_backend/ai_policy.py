@@ -117,6 +117,20 @@ class PretrainedRLLibA2CPolicyCustomModel:
         """
         return self.policy.compute_single_action(self.preprocessor.transform(obs))[0]
 
+    def compute_actions(self, observations):
+        """
+        Compute actions for a batch of observations in one forward pass, see inference_server.py.
+
+        Args:
+            observations: A list of observations, each as passed to compute_action().
+        Returns:
+            A list of actions, in the same order.
+        """
+        actions = self.policy.compute_actions(np.stack([self.preprocessor.transform(obs) for obs in observations]))[0]
+        if isinstance(actions, dict):
+            return [{key: actions[key][i] for key in actions} for i in range(len(observations))]
+        return list(actions)
+
 
 def partition(pred, iterable):
     trues = []
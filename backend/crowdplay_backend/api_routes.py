@@ -1,30 +1,30 @@
 import pickle
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import partial
 from io import BytesIO
 from urllib.parse import urlparse
 from zipfile import ZIP_DEFLATED, ZipFile
 
-import numpy as np
 from flask import Blueprint, current_app, jsonify, request, send_file
 
+from .completion_counts import completion_counts
 from .db import db
 from .db_models import (
     SessionModel,
     UserDataModel,
-    get_all_task_callable_by_task_id,
-    get_completed_assignments_by_task_id,
-    get_completed_assignments_by_task_id_and_worker_id,
+    get_completed_assignments_by_task_ids,
     get_env_by_game_id,
     get_envs,
     get_envs_for_worker,
-    get_episode_callables_by_task_id,
     get_episode_callables_by_visit_id,
+    get_episode_callables_with_keys_by_task_id,
     get_games_by_instance_id,
     get_hits,
     get_step_by_prim_keys,
     get_steps_by_game_id,
     get_task_callable_by_visit_id,
+    get_task_callables_with_keys_by_task_id,
     get_total_reward_by_visit_id,
     get_total_rewards_by_task_id,
 )
@@ -39,13 +39,13 @@ from .exceptions import (
     TokenForbidden,
 )
 from .logger import getLogger
+from .score_index import SortedScores, get_score_stats, score_index
 from .session_setup import SessionSetup
 from .socketio import socketio
 from .utils import (
     consolidate_steps,
     make_or_get_env_to_dict,
     observation_to_serializable,
-    space_to_dict,
 )
 
 logger = getLogger("api_routes")
@@ -196,8 +196,7 @@ def action_space(instance_id):
     # TODO: multiagent? (agents keys)
 
     try:
-        space = envs_manager.action_space_for(instance_id)
-        space_dict = space_to_dict(space, in_depth)
+        space_dict = envs_manager.spaces_for(instance_id).space_dict("action_space", in_depth=in_depth)
         return jsonify(space_dict)
     except InstanceNotFound:
         return jsonify(error="InstanceNotFound"), 404
@@ -240,8 +239,7 @@ def observation_space(instance_id):
     # TODO: multiagent? (agents keys)
 
     try:
-        space = envs_manager.observation_space_for(instance_id)
-        space_dict = space_to_dict(space, in_depth)
+        space_dict = envs_manager.spaces_for(instance_id).space_dict("observation_space", in_depth=in_depth)
         return jsonify(space_dict)
     except InstanceNotFound:
         return jsonify(error="InstanceNotFound"), 404
@@ -250,6 +248,39 @@ def observation_space(instance_id):
         return jsonify(error=str(error)), 500
 
 
+@api_v1.route("/stream-metrics/<instance_id>")
+def stream_metrics(instance_id):
+    """Returns the adaptive streaming state of each client of an instance, see stream_controller.py.
+    ---
+    tags:
+      - App API
+    parameters:
+      - name: instance_id
+        in: path
+        type: string
+    responses:
+      200:
+        description: Streaming level, quality, scale, frame skip, latencies and frame counts, by agent key
+      404:
+        description: Instance not found
+        schema:
+          $ref: '#/definitions/Error'
+      500:
+        description: Unknown error
+        schema:
+          $ref: '#/definitions/Error'
+    """
+    envs_manager = EnvsManager.getInstance()
+
+    try:
+        return jsonify(envs_manager.get_runner(instance_id).stream_metrics())
+    except InstanceNotFound:
+        return jsonify(error="InstanceNotFound"), 404
+    except Exception as error:
+        logger.error("Error:", error)
+        return jsonify(error=str(error)), 500
+
+
 # TODO I think this is never called? Remove?
 @api_v1.route("/stop/<instance_id>", methods=["POST"])
 def stop(instance_id):
@@ -367,25 +398,25 @@ def get_task_id_from_auto(auto_task_id, session_input):
     task_list = crowdplay_environments[auto_task_id]["auto"]
     # Check if there is an existing env with open player slots available for any of the tasks.
     for task in task_list:
-        for instance_id in (
-            instance_id
-            for instance_id in envs_manager.env_runners
-            if envs_manager.env_runners[instance_id].task_id == task
-        ):
-            if len(envs_manager._agents_to_assign(instance_id)) > 0:
-                return task
+        if len(envs_manager.open_instance_ids(task)) > 0:
+            return task
 
     # If the taskId is set to Auto, we assign the first task that doesn't have enough complete assignments yet,
     # and that the user hasn't done before.
-    for task in task_list:
-        if get_completed_assignments_by_task_id(task) < crowdplay_environments[task]["target_complete_assignments"]:
-            if get_completed_assignments_by_task_id_and_worker_id(task, session_input["workerId"]) < 1:
+    completed_so_far = completion_counts.get(task_list, get_completed_assignments_by_task_ids)
+    open_tasks = [
+        task
+        for task in task_list
+        if completed_so_far[task] < crowdplay_environments[task]["target_complete_assignments"]
+    ]
+    if open_tasks:
+        completed_by_worker = get_completed_assignments_by_task_ids(open_tasks, session_input["workerId"])
+        for task in open_tasks:
+            if completed_by_worker[task] < 1:
                 return task
 
     # Otherwise assign task with fewest completed tasks so far, tiebreaking randomly.
-    completed_so_far = {}
-    for task in task_list:
-        completed_so_far[task] = int(get_completed_assignments_by_task_id(task))
+    completed_so_far = {task: int(completed_so_far[task]) for task in task_list}
     m = min(completed_so_far, key=completed_so_far.get)
     min_tasks = [task for task in completed_so_far if completed_so_far[task] == completed_so_far[m]]
     return random.choice(min_tasks)
@@ -674,12 +705,12 @@ def collect_user_data():
 
 @api_v1.route("/get_scores/<visit_id>")
 def get_scores(visit_id):
-    # Sleep for a moment to allow scores to make it to the DB after game end.
-    socketio.sleep(0.5)
     user_details = SessionModel.query.get(visit_id)
     task_id = user_details.task_id
 
     if "task_callables" not in crowdplay_environments[task_id]:
+        # Sleep for a moment to allow scores to make it to the DB after game end.
+        socketio.sleep(0.5)
         rewards_this_task = get_total_rewards_by_task_id(task_id)
         reward_this_visit = get_total_reward_by_visit_id(visit_id)
         return jsonify(
@@ -689,9 +720,23 @@ def get_scores(visit_id):
         )
 
     results = []
+    session_key = (user_details.env_instance_id, user_details.agent_key)
     callables = crowdplay_environments[task_id]["task_callables"]
     for callable in callables:
-        total_performance_this_visit = get_task_callable_by_visit_id(visit_id, callable)
+        # Scores of all players of the task are ranked in memory, and updated at every episode end.
+        scores = score_index.get(
+            task_id,
+            callable,
+            partial(get_task_callables_with_keys_by_task_id, task_id, callable),
+            partial(get_episode_callables_with_keys_by_task_id, task_id, callable),
+        )
+        total_performance_this_visit = scores.totals.get(session_key)
+        highest_episode = scores.best_episodes.get(session_key)
+        if total_performance_this_visit is None:
+            # Not played in this process, e.g. before a restart. Give the DB writer a moment after game end.
+            socketio.sleep(0.5)
+            total_performance_this_visit = get_task_callable_by_visit_id(visit_id, callable)
+            highest_episode = max(get_episode_callables_by_visit_id(visit_id, callable))
         if total_performance_this_visit is None:
             return (
                 jsonify(
@@ -700,65 +745,14 @@ def get_scores(visit_id):
                 ),
                 404,
             )
-        total_performance_this_task = get_all_task_callable_by_task_id(task_id, callable)
-        episodes_this_visit = get_episode_callables_by_visit_id(visit_id, callable)
-        highest_episode = max(episodes_this_visit)
-        episodes_this_task = get_episode_callables_by_task_id(task_id, callable)
-        results.append(
-            get_stats_from_raw_data(f"{callable} (total)", total_performance_this_visit, total_performance_this_task)
-        )
-        results.append(get_stats_from_raw_data(f"{callable} (best single game)", highest_episode, episodes_this_task))
+        results.append(get_score_stats(f"{callable} (total)", total_performance_this_visit, scores.totals))
+        results.append(get_score_stats(f"{callable} (best single game)", highest_episode, scores.episodes))
 
     return jsonify(results)
 
 
 def get_stats_from_raw_data(metric, this_score, all_scores):
-    if isinstance(this_score, float):
-        this_score_string = f"{this_score:.2f}"
-    else:
-        this_score_string = str(this_score)
-    # Seems to be necessary in case current score hasn't made it into the DB yet.
-    # TODO check if this is really the right thing to do.
-    # Not a huge problem if not though.
-    if this_score not in all_scores:
-        all_scores.append(this_score)
-    if isinstance(this_score, timedelta):
-        this_score = this_score / timedelta(minutes=1)
-        all_scores = list(
-            map(lambda s: s / timedelta(minutes=1), [score for score in all_scores if isinstance(score, timedelta)])
-        )
-    all_scores.sort()
-    low = all_scores[0]
-    high = all_scores[-1]
-    n_bins = 10
-    # We do one more bin that specified, because we do a half-sized bin on each end
-    bin_size = (high - low) / (n_bins)
-    if bin_size == 0:
-        bin_size = 1
-    binned_data = np.histogram(all_scores, bins=n_bins + 1, range=(low - (bin_size / 2), high + (bin_size / 2)))
-    # We put the data into an x-y list, and also add a few additional data points
-    # below and above the actual data for nicer rendering.
-    additional_data_points = n_bins // 5
-    binned_data_processed = (
-        [{"x": float(low + i * bin_size), "y": 0.0} for i in range(-additional_data_points, 0)]
-        + [{"x": float(low + i * bin_size), "y": float(binned_data[0][i])} for i in range(len(binned_data[0]))]
-        + [{"x": float(high + i * bin_size), "y": 0.0} for i in range(1, additional_data_points + 1)]
-    )
-    rank_lower = len(all_scores) - all_scores.index(this_score)
-    all_scores.reverse()
-    rank = all_scores.index(this_score) + 1
-
-    total_scores = len(all_scores)
-    percentile = 100 if total_scores == 1 else int(100 * (1 - rank_lower / total_scores))
-    return {
-        "metric": metric,
-        "your_score": this_score_string,
-        "your_score_raw": this_score,
-        "your_rank": rank,
-        "out_of": total_scores,
-        "percentile": percentile,
-        "histogram": binned_data_processed,
-    }
+    return get_score_stats(metric, this_score, SortedScores.from_values(all_scores))
 
 
 @api_v1.route("/get_task_choices", methods=["POST"])
@@ -0,0 +1,58 @@
+"""
+In-memory count of completed assignments per task, for assigning new participants of "auto" tasks to tasks.
+
+Every new participant of an auto task needs the completed assignments of all tasks in the group (see
+api_routes.get_task_id_from_auto()), which during a burst of new participants would be the same query many times a
+second. CompletionCounts keeps the counts for ttl_seconds, loading all tasks that are missing or expired with one
+query. In between, EnvRunners report every completion their EnvProcess writes to the DB, which is added to the
+counts right away. Counts can be slightly off until the next load, which is fine for balancing tasks.
+"""
+
+import time
+
+from .config import Config
+
+
+class CompletionCounts:
+    def __init__(self, ttl_seconds=10.0):
+        self.ttl_seconds = ttl_seconds
+        # Completed assignments and the time they were loaded, by task id.
+        self.counts = {}
+        self.loaded_at = {}
+        # Latest completion reported for each player, by (instance id, agent key).
+        self.completions = {}
+
+    def get(self, task_ids, load):
+        """Returns the completed assignments of each task, loading them if needed.
+
+        Args:
+            load: Returns {task_id: completed assignments} for a list of task ids from the DB.
+        """
+        now = time.monotonic()
+        to_load = [
+            task_id
+            for task_id in task_ids
+            if task_id not in self.counts or now - self.loaded_at[task_id] > self.ttl_seconds
+        ]
+        if to_load:
+            loaded = load(to_load)
+            for task_id in to_load:
+                self.counts[task_id] = loaded.get(task_id, 0)
+                self.loaded_at[task_id] = now
+        return {task_id: self.counts[task_id] for task_id in task_ids}
+
+    def record_completion(self, task_id, instance_id, agent_key, completed):
+        """Records the completion of one player, and adds the change since it was last reported to its task's count."""
+        previous = self.completions.get((instance_id, agent_key), 0)
+        self.completions[(instance_id, agent_key)] = completed
+        if task_id in self.counts:
+            self.counts[task_id] += completed - previous
+
+    def forget_instance(self, instance_id, agent_keys):
+        """Drops the completions reported for an instance once it is closed."""
+        for agent_key in agent_keys:
+            self.completions.pop((instance_id, agent_key), None)
+
+
+# The counts used by the web process.
+completion_counts = CompletionCounts(Config.COMPLETION_COUNTS_TTL_SECONDS)
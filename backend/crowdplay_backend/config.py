@@ -26,6 +26,41 @@ class Config:
     TIME_PLAYING = 5  # 30 seconds
     NO_HIT = "NO_HIT"
 
+    # How trajectories are stored in the episode_trajectories table.
+    # "columnar" (see trajectory_format.py) or "pickle" for the legacy bzipped pickle.
+    TRAJECTORY_FORMAT = os.environ.get("TRAJECTORY_FORMAT") or "columnar"
+    TRAJECTORY_CODEC = os.environ.get("TRAJECTORY_CODEC") or "zlib"
+    # Store frames in columnar trajectories as palette indices, which is lossless and a third of the size.
+    TRAJECTORY_PALETTE = (os.environ.get("TRAJECTORY_PALETTE") or "1") == "1"
+    # Trajectories are written to the DB in chunks of this many steps, so long episodes don't need to be kept in
+    # memory until they end. This is also the number of steps the trajectory recorder preallocates buffers for.
+    TRAJECTORY_CHUNK_STEPS = int(os.environ.get("TRAJECTORY_CHUNK_STEPS") or 3600)
+    # Size of each of the two shared memory slots used to send steps from EnvProcess to the web process.
+    # Must fit the frames of all agents plus the remaining step data, one Atari frame is about 100kB.
+    FRAME_BUFFER_BYTES = int(os.environ.get("FRAME_BUFFER_BYTES") or 4 * 1024 * 1024)
+    # Run instances on this many shared worker processes, with up to ENV_WORKER_SLOTS instances each, instead of
+    # starting an EnvProcess per instance (see env_worker.py). 0 disables worker processes.
+    ENV_WORKERS = int(os.environ.get("ENV_WORKERS") or 0)
+    ENV_WORKER_SLOTS = int(os.environ.get("ENV_WORKER_SLOTS") or 16)
+    # All game data is written to the DB by one DBWriter process (see db_writer.py), with this many pooled connections,
+    # writing up to DB_WRITER_BATCH_SIZE messages per transaction. DB_WRITER_MAX_INSTANCES is the number of instances
+    # whose data we can wait for to be written when they stop, it should be at least the number of concurrent instances.
+    DB_WRITER_CONNECTIONS = int(os.environ.get("DB_WRITER_CONNECTIONS") or 4)
+    DB_WRITER_BATCH_SIZE = int(os.environ.get("DB_WRITER_BATCH_SIZE") or 500)
+    DB_WRITER_MAX_INSTANCES = int(os.environ.get("DB_WRITER_MAX_INSTANCES") or 1024)
+    # Scores shown at the end of a session are ranked in memory (see score_index.py), and reloaded from the DB this often.
+    SCORE_INDEX_REFRESH_SECONDS = int(os.environ.get("SCORE_INDEX_REFRESH_SECONDS") or 600)
+    # Completed assignments per task, for assigning participants of auto tasks (see completion_counts.py), are reloaded
+    # from the DB this often.
+    COMPLETION_COUNTS_TTL_SECONDS = int(os.environ.get("COMPLETION_COUNTS_TTL_SECONDS") or 10)
+    # Number of instances of each task started ahead of time for new players (see warm_pool.py), for tasks that don't
+    # set "warm_pool_size" themselves. 0 starts instances only when players need them.
+    WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE") or 0)
+    # Compute the actions of each AI policy for all instances in one process, in batches of up to
+    # AI_INFERENCE_BATCH_SIZE observations (see inference_server.py), instead of loading the policies in every EnvProcess.
+    AI_INFERENCE_SERVERS = (os.environ.get("AI_INFERENCE_SERVERS") or "0") == "1"
+    AI_INFERENCE_BATCH_SIZE = int(os.environ.get("AI_INFERENCE_BATCH_SIZE") or 32)
+
 
 class ConfigLocalDocker(Config):
     pass
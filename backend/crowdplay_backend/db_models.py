@@ -1,4 +1,6 @@
 import json
+import math
+import numbers
 import pickle
 from datetime import datetime, timedelta
 
@@ -127,13 +129,15 @@ class GameModel(db.Model):
 class TrajectoryModel(db.Model):
     __tablename__ = "episode_trajectories"
     episode_id = db.Column(db.String(32), primary_key=True)
+    # Long episodes are stored in several chunks, see Config.TRAJECTORY_CHUNK_STEPS.
+    chunk_index = db.Column(db.Integer, primary_key=True, default=0)
     trajectory = db.Column(db.LargeBinary, nullable=False)
 
     def to_dict(self):
-        return {"episode_id": self.id, "trajectory": self.trajectory}
+        return {"episode_id": self.episode_id, "chunk_index": self.chunk_index, "trajectory": self.trajectory}
 
     def __repr__(self):
-        return f'<TrajectoryModel episode_id="{self.episode_id}" />'
+        return f'<TrajectoryModel episode_id="{self.episode_id}" chunk_index="{self.chunk_index}" />'
 
 
 @updatable_model
@@ -211,6 +215,9 @@ class TaskCallableModel(db.Model):
     callable_key = db.Column(db.String(255), primary_key=True)
     value_achieved = db.Column(db.String(255))
     value_required = db.Column(db.String(255))
+    # value_achieved if it is a number or duration, see callable_value_to_number().
+    value_numeric = db.Column(db.Float)
+    value_kind = db.Column(db.String(16))
 
     def to_dict(self):
         return {
@@ -219,6 +226,8 @@ class TaskCallableModel(db.Model):
             "callable_key": self.callable_key,
             "value_achieved": self.value_achieved,
             "value_required": self.value_required,
+            "value_numeric": self.value_numeric,
+            "value_kind": self.value_kind,
         }
 
     def __repr__(self):
@@ -236,6 +245,9 @@ class EpisodeCallableModel(db.Model):
     callable_key = db.Column(db.String(255), primary_key=True)
     value_achieved = db.Column(db.String(255))
     value_required = db.Column(db.String(255))
+    # value_achieved if it is a number or duration, see callable_value_to_number().
+    value_numeric = db.Column(db.Float)
+    value_kind = db.Column(db.String(16))
 
     def to_dict(self):
         return {
@@ -245,6 +257,8 @@ class EpisodeCallableModel(db.Model):
             "callable_key": self.callable_key,
             "value_achieved": self.value_achieved,
             "value_required": self.value_required,
+            "value_numeric": self.value_numeric,
+            "value_kind": self.value_kind,
         }
 
     def __repr__(self):
@@ -366,31 +380,72 @@ def value_to_appropriate_type(value):
             return value
 
 
+# Kinds of typed callable values, in the value_kind columns.
+CALLABLE_VALUE_INT = "int"
+CALLABLE_VALUE_FLOAT = "float"
+CALLABLE_VALUE_DURATION = "duration"
+
+
+def callable_value_to_number(value):
+    """Returns (value_numeric, value_kind) to store a callable value typed, or (None, None) if it isn't a number or
+    duration. Durations are stored in seconds."""
+    if isinstance(value, bool):
+        return None, None
+    if isinstance(value, timedelta):
+        return value.total_seconds(), CALLABLE_VALUE_DURATION
+    if isinstance(value, numbers.Integral):
+        return float(value), CALLABLE_VALUE_INT
+    if isinstance(value, numbers.Real) and math.isfinite(value):
+        return float(value), CALLABLE_VALUE_FLOAT
+    return None, None
+
+
+def number_to_callable_value(value_numeric, value_kind):
+    """Converts typed callable values back into the values they were stored from."""
+    if value_kind == CALLABLE_VALUE_DURATION:
+        return timedelta(seconds=value_numeric)
+    if value_kind == CALLABLE_VALUE_INT:
+        return int(value_numeric)
+    if value_kind == CALLABLE_VALUE_FLOAT:
+        return value_numeric
+    return None
+
+
+def stored_callable_value(value_numeric, value_kind, value_achieved):
+    """Returns a stored callable value, typed if possible, and parsed from its string otherwise."""
+    if value_kind is not None:
+        return number_to_callable_value(value_numeric, value_kind)
+    return value_to_appropriate_type(value_achieved)
+
+
 def get_task_callable_by_visit_id(visit_id, callable):
     """Returns the total task callable across all games played by the given visit_id."""
-    value_achieved = (
-        db.session.query(TaskCallableModel.value_achieved)
+    value = (
+        db.session.query(
+            TaskCallableModel.value_numeric, TaskCallableModel.value_kind, TaskCallableModel.value_achieved
+        )
         .filter(SessionModel.visit_id == visit_id)
         .filter(TaskCallableModel.env_instance_id == SessionModel.env_instance_id)
         .filter(TaskCallableModel.callable_key == callable)
         .filter(TaskCallableModel.agent_key == SessionModel.agent_key)
-        .scalar()
+        .first()
     )
-    value_achieved = value_to_appropriate_type(value_achieved)
-    return value_achieved
+    return stored_callable_value(*value) if value is not None else None
 
 
 def get_episode_callables_by_visit_id(visit_id, callable):
     """Returns the callables for each games played by the given visit_id."""
     values = (
-        db.session.query(EpisodeCallableModel.value_achieved)
+        db.session.query(
+            EpisodeCallableModel.value_numeric, EpisodeCallableModel.value_kind, EpisodeCallableModel.value_achieved
+        )
         .filter(SessionModel.visit_id == visit_id)
         .filter(EpisodeCallableModel.env_instance_id == SessionModel.env_instance_id)
         .filter(EpisodeCallableModel.callable_key == callable)
         .filter(EpisodeCallableModel.agent_key == SessionModel.agent_key)
         .all()
     )
-    values = list(map(lambda t: value_to_appropriate_type(t[0]), values))
+    values = [stored_callable_value(*t) for t in values]
     return values or [
         0,
     ]
@@ -399,14 +454,16 @@ def get_episode_callables_by_visit_id(visit_id, callable):
 def get_episode_callables_by_task_id(task_id, callable):
     """Returns the callables for each games played by the given visit_id."""
     values = (
-        db.session.query(EpisodeCallableModel.value_achieved)
+        db.session.query(
+            EpisodeCallableModel.value_numeric, EpisodeCallableModel.value_kind, EpisodeCallableModel.value_achieved
+        )
         .filter(SessionModel.task_id == task_id)
         .filter(EpisodeCallableModel.env_instance_id == SessionModel.env_instance_id)
         .filter(EpisodeCallableModel.callable_key == callable)
         .filter(EpisodeCallableModel.agent_key == SessionModel.agent_key)
         .all()
     )
-    values = list(map(lambda t: value_to_appropriate_type(t[0]), values))
+    values = [stored_callable_value(*t) for t in values]
     return values or [
         0,
     ]
@@ -414,18 +471,58 @@ def get_episode_callables_by_task_id(task_id, callable):
 
 def get_all_task_callable_by_task_id(task_id, callable):
     """Returns the total task callable across all games played by the given visit_id."""
-    values_achieved = (
-        db.session.query(TaskCallableModel.value_achieved)
+    values = (
+        db.session.query(
+            TaskCallableModel.value_numeric, TaskCallableModel.value_kind, TaskCallableModel.value_achieved
+        )
         .filter(SessionModel.task_id == task_id)
         .filter(TaskCallableModel.env_instance_id == SessionModel.env_instance_id)
         .filter(TaskCallableModel.callable_key == callable)
         .filter(TaskCallableModel.agent_key == SessionModel.agent_key)
         .all()
     )
-    raw_values = list(map(lambda value_achieved: value_achieved[0], values_achieved)) or [
+    return [stored_callable_value(*t) for t in values] or [
         0,
     ]
-    return list(map(value_to_appropriate_type, raw_values))
+
+
+def get_task_callables_with_keys_by_task_id(task_id, callable):
+    """Returns (env_instance_id, agent_key, value) of the total task callable of every session of the given task_id."""
+    values = (
+        db.session.query(
+            TaskCallableModel.env_instance_id,
+            TaskCallableModel.agent_key,
+            TaskCallableModel.value_numeric,
+            TaskCallableModel.value_kind,
+            TaskCallableModel.value_achieved,
+        )
+        .filter(SessionModel.task_id == task_id)
+        .filter(TaskCallableModel.env_instance_id == SessionModel.env_instance_id)
+        .filter(TaskCallableModel.callable_key == callable)
+        .filter(TaskCallableModel.agent_key == SessionModel.agent_key)
+        .all()
+    )
+    return [(t[0], t[1], stored_callable_value(*t[2:])) for t in values]
+
+
+def get_episode_callables_with_keys_by_task_id(task_id, callable):
+    """Returns (env_instance_id, episode_id, agent_key, value) of the callable of every game of the given task_id."""
+    values = (
+        db.session.query(
+            EpisodeCallableModel.env_instance_id,
+            EpisodeCallableModel.episode_id,
+            EpisodeCallableModel.agent_key,
+            EpisodeCallableModel.value_numeric,
+            EpisodeCallableModel.value_kind,
+            EpisodeCallableModel.value_achieved,
+        )
+        .filter(SessionModel.task_id == task_id)
+        .filter(EpisodeCallableModel.env_instance_id == SessionModel.env_instance_id)
+        .filter(EpisodeCallableModel.callable_key == callable)
+        .filter(EpisodeCallableModel.agent_key == SessionModel.agent_key)
+        .all()
+    )
+    return [(t[0], t[1], t[2], stored_callable_value(*t[3:])) for t in values]
 
 
 def get_total_rewards_by_task_id(task_id):
@@ -459,34 +556,43 @@ def get_total_steps_by_assignment_id(assignment_id):
 
 def get_completed_assignments_by_hit_id(hit_id, min_reward, min_steps):
     """Returns how many complete assignments we have for a given HIT."""
-    # TODO make this one fancy SQL query?
-    assignments = SessionModel.query.filter(SessionModel.hit_id == hit_id).all()
-    completed_assignments = len(
-        [
-            assignment
-            for assignment in assignments
-            if (
-                get_total_reward_by_assignment_id(assignment.assignment_id) >= min_reward
-                and get_total_steps_by_assignment_id(assignment.assignment_id) >= min_steps
-            )
-        ]
+    # Total reward and steps of each assignment, outer joined so that assignments without any steps count too.
+    assignments = (
+        db.session.query(
+            db.func.count(db.distinct(SessionModel.visit_id)),
+            db.func.coalesce(db.func.sum(StepModel.reward), 0),
+            db.func.count(StepModel.game_id),
+        )
+        .filter(SessionModel.hit_id == hit_id)
+        .outerjoin(GameModel, GameModel.env_instance_id == SessionModel.env_instance_id)
+        .outerjoin(StepModel, db.and_(StepModel.game_id == GameModel.id, StepModel.agent_key == SessionModel.agent_key))
+        .group_by(SessionModel.assignment_id)
+        .all()
+    )
+    return sum(
+        sessions
+        for sessions, total_reward, total_steps in assignments
+        if total_reward >= min_reward and total_steps >= min_steps
     )
-    return completed_assignments
+
+
+def get_completed_assignments_by_task_ids(task_ids, worker_id=None):
+    """Returns how many complete assignments we have for each of the given tasks (and worker, if given), as
+    {task_id: completed}."""
+    query = db.session.query(SessionModel.task_id, db.func.sum(SessionModel.completed)).filter(
+        SessionModel.task_id.in_(task_ids)
+    )
+    if worker_id is not None:
+        query = query.filter(SessionModel.worker_id == worker_id)
+    completed = dict(query.group_by(SessionModel.task_id).all())
+    return {task_id: completed.get(task_id) or 0 for task_id in task_ids}
 
 
 def get_completed_assignments_by_task_id(task_id):
     """Returns how many complete assignments we have for a given task."""
-    # TODO make this one fancy SQL query?
-    assignments = SessionModel.query.filter(SessionModel.task_id == task_id).all()
-    completed_assignments = sum(assignment.completed for assignment in assignments)
-    return completed_assignments
+    return get_completed_assignments_by_task_ids([task_id])[task_id]
 
 
 def get_completed_assignments_by_task_id_and_worker_id(task_id, worker_id):
     """Returns how many complete assignments we have for a given task and worker."""
-    # TODO make this one fancy SQL query?
-    assignments = (
-        SessionModel.query.filter(SessionModel.task_id == task_id).filter(SessionModel.worker_id == worker_id).all()
-    )
-    completed_assignments = sum(assignment.completed for assignment in assignments)
-    return completed_assignments
+    return get_completed_assignments_by_task_ids([task_id], worker_id)[task_id]
@@ -0,0 +1,343 @@
+"""
+The single process that writes game data to the DB for all instances.
+
+EnvProcesses don't talk to the DB themselves. They put messages on the DBWriter's queue, which is shared by all
+instances (and all env workers, see env_worker.py), and the DBWriter process writes them in batches on a small pool of
+connections, so that the number of DB connections doesn't grow with the number of instances.
+
+Each message is a tuple (kind, instance_id, ...). Messages are assigned to one of Config.DB_WRITER_CONNECTIONS writer
+threads by instance id, so that the messages of each instance are written in order. Each thread takes all messages
+that are waiting (up to Config.DB_WRITER_BATCH_SIZE), and writes them in one transaction with one multi-row statement
+per table. At low load batches are small and nothing waits; under load batches grow, and the cost per row drops.
+
+Trajectory chunks are encoded before they are sent, by a TrajectoryEncoder thread in each EnvProcess, so that the
+encoding CPU of all instances isn't serialized in the DBWriter, and a batch that is retried doesn't encode them again.
+
+When an instance closes, its EnvProcess sends "instance_closed" as its last message. Once that has been written, the
+DBWriter sets the instance's event, so that the EnvRunner knows all data of the instance is in the DB. Events can only
+be shared with a process when it is started, so a fixed number of them is created with the DBWriter and leased to
+instances.
+"""
+
+import bz2
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+
+from mysql.connector import pooling
+
+from .config import Config
+from .logger import getLogger
+from .trajectory_format import columns_to_trajectory, encode_columns
+
+logger = getLogger(__name__)
+
+# At most this many rows are written per statement, to stay well below max_allowed_packet.
+MAX_ROWS_PER_STATEMENT = 500
+
+# How long the writer blocks on the queue before checking the exit event.
+WAIT_TIMEOUT = 0.1
+
+
+def encode_trajectory_for_db(columns, chunk_index=0):
+    """Encodes a recorded trajectory (as returned by TrajectoryRecorder.to_columns()) in the format set by
+    Config.TRAJECTORY_FORMAT."""
+    if Config.TRAJECTORY_FORMAT == "columnar":
+        return encode_columns(
+            columns,
+            codec=Config.TRAJECTORY_CODEC,
+            meta={"chunk_index": chunk_index},
+            palette=Config.TRAJECTORY_PALETTE,
+        )
+    return bz2.compress(pickle.dumps(columns_to_trajectory(columns)))
+
+
+class TrajectoryEncoder:
+    """Encodes the trajectory chunks of an instance in a background thread, and sends them to the DBWriter."""
+
+    def __init__(self, database_queue):
+        self.database_queue = database_queue
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, instance_id, game_id, chunk_index, columns):
+        """Queues a chunk (as returned by TrajectoryRecorder.to_columns()) to be encoded and sent."""
+        self.queue.put((instance_id, game_id, chunk_index, columns))
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            instance_id, game_id, chunk_index, columns = chunk
+            logger.info(f"Encoding episode data chunk {chunk_index} for game id {game_id}")
+            try:
+                trajectory = encode_trajectory_for_db(columns, chunk_index)
+            except Exception:
+                logger.exception(f"Failed to encode episode data chunk {chunk_index} for game id {game_id}.")
+                continue
+            self.database_queue.put(("episode_to_db", instance_id, game_id, chunk_index, trajectory))
+
+    def close(self):
+        """Returns once all queued chunks are encoded and sent."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def insert_rows(cursor, statement, rows):
+    """Runs an INSERT or REPLACE statement for many rows, with up to MAX_ROWS_PER_STATEMENT rows per statement.
+
+    Args:
+        statement: The statement up to and including VALUES, e.g. "INSERT INTO games (id, started_on) VALUES".
+        rows: Tuples of values, all of the same length.
+    """
+    if len(rows) == 0:
+        return
+    placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    for start in range(0, len(rows), MAX_ROWS_PER_STATEMENT):
+        chunk = rows[start : start + MAX_ROWS_PER_STATEMENT]
+        cursor.execute(
+            f"{statement} {', '.join([placeholders] * len(chunk))}", [value for row in chunk for value in row]
+        )
+
+
+class WriteBatch:
+    """Rows to write for a batch of messages, grouped by table."""
+
+    def __init__(self):
+        self.games = []
+        self.game_ends = []
+        self.task_callables_per_env = []
+        self.task_callables_per_game = []
+        self.episode_callables = []
+        self.trajectories = []
+        # Only the latest completion of each agent matters, by (instance_id, agent_id).
+        self.completions = {}
+        self.envprocess_status_codes = []
+        self.dbprocess_status_codes = []
+        # Events to set once the batch is written, for instances that have closed.
+        self.closed_event_indices = []
+
+    def add(self, message):
+        kind, instance_id = message[0], message[1]
+        if kind == "episode_start":
+            game_id, started_on = message[2:]
+            self.games.append((game_id, instance_id, started_on))
+        elif kind == "episode_end":
+            game_id, ended_on, task_callable_values, episode_callable_values = message[2:]
+            self.game_ends.append((ended_on, game_id))
+            # Values are (agent_id, callable_key, value_achieved, value_required, value_numeric, value_kind).
+            for values in task_callable_values:
+                self.task_callables_per_env.append((instance_id,) + values)
+                self.task_callables_per_game.append((instance_id, game_id) + values)
+            for values in episode_callable_values:
+                self.episode_callables.append((instance_id, game_id) + values)
+        elif kind == "episode_to_db":
+            # Already encoded, see TrajectoryEncoder.
+            game_id, chunk_index, trajectory = message[2:]
+            self.trajectories.append((game_id, chunk_index, trajectory))
+        elif kind == "completion_to_db":
+            completion_value, bonus_value, agent_id = message[2:]
+            self.completions[(instance_id, agent_id)] = (completion_value, bonus_value, instance_id, agent_id)
+        elif kind == "envprocess_status":
+            self.envprocess_status_codes.append((message[2], instance_id))
+        elif kind == "instance_closed":
+            self.dbprocess_status_codes.append((1, instance_id))
+            if message[2] is not None:
+                self.closed_event_indices.append(message[2])
+        else:
+            logger.error(f"DBWriter got unknown message {kind} for instance {instance_id}.")
+
+    def write(self, cursor):
+        """Writes all rows, parents before children, and status codes last."""
+        insert_rows(cursor, "INSERT INTO games (id, env_instance_id, started_on) VALUES", self.games)
+        if self.game_ends:
+            cursor.executemany("UPDATE games SET ended_on = %s WHERE id = %s", self.game_ends)
+        insert_rows(
+            cursor,
+            "REPLACE INTO task_callable_per_env (env_instance_id, agent_key, callable_key, value_achieved, "
+            "value_required, value_numeric, value_kind) VALUES",
+            self.task_callables_per_env,
+        )
+        insert_rows(
+            cursor,
+            "REPLACE INTO task_callable_per_game (env_instance_id, episode_id, agent_key, callable_key, "
+            "value_achieved, value_required, value_numeric, value_kind) VALUES",
+            self.task_callables_per_game,
+        )
+        insert_rows(
+            cursor,
+            "REPLACE INTO episode_callable (env_instance_id, episode_id, agent_key, callable_key, value_achieved, "
+            "value_required, value_numeric, value_kind) VALUES",
+            self.episode_callables,
+        )
+        # Trajectory chunks are megabytes each, so they get a statement each.
+        for trajectory in self.trajectories:
+            cursor.execute(
+                "INSERT INTO episode_trajectories (episode_id, chunk_index, trajectory) VALUES (%s, %s, %s)",
+                trajectory,
+            )
+        if self.completions:
+            cursor.executemany(
+                "UPDATE sessions SET completed=%s, bonus=%s WHERE env_instance_id=%s AND agent_key=%s",
+                list(self.completions.values()),
+            )
+        if self.envprocess_status_codes:
+            cursor.executemany(
+                "UPDATE envs SET envprocess_status_code = %s WHERE instance_id = %s", self.envprocess_status_codes
+            )
+        if self.dbprocess_status_codes:
+            cursor.executemany(
+                "UPDATE envs SET dbprocess_status_code = %s WHERE instance_id = %s", self.dbprocess_status_codes
+            )
+
+
+def write_batch(connection_pool, messages):
+    """Writes messages in one transaction.
+
+    Returns:
+        The indices of the events of instances that closed in these messages, or None if writing failed.
+    """
+    batch = WriteBatch()
+    for message in messages:
+        try:
+            batch.add(message)
+        except Exception:
+            logger.exception(f"DBWriter failed to process message {message[0]} for instance {message[1]}.")
+    conn = connection_pool.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            batch.write(cursor)
+            cursor.close()
+        conn.commit()
+    except Exception:
+        logger.exception(f"DBWriter failed to write a batch of {len(messages)} messages.")
+        conn.rollback()
+        return None
+    finally:
+        # Returns the connection to the pool.
+        conn.close()
+    return batch.closed_event_indices
+
+
+def write_messages(connection_pool, messages, instance_events):
+    """Writes a batch of messages in one transaction.
+
+    If the transaction fails twice, the messages are written one instance at a time, and the messages of an instance
+    whose transaction fails are written one at a time, so that a bad row only loses that row. An instance's event is
+    only set once its "instance_closed" message is committed, the EnvRunner logs it if that doesn't happen in time.
+    """
+    closed_event_indices = write_batch(connection_pool, messages)
+    if closed_event_indices is None:
+        logger.warn(f"Retrying batch of {len(messages)} messages.")
+        closed_event_indices = write_batch(connection_pool, messages)
+    if closed_event_indices is None:
+        closed_event_indices = []
+        messages_per_instance = {}
+        for message in messages:
+            messages_per_instance.setdefault(message[1], []).append(message)
+        for instance_id, instance_messages in messages_per_instance.items():
+            written = write_batch(connection_pool, instance_messages)
+            if written is None:
+                logger.warn(f"Writing {len(instance_messages)} messages of instance {instance_id} one at a time.")
+                written = []
+                for message in instance_messages:
+                    written += write_batch(connection_pool, [message]) or []
+            closed_event_indices += written
+    for index in closed_event_indices:
+        instance_events[index].set()
+
+
+def writer_thread_fn(connection_pool, messages_queue, instance_events, batch_size):
+    while True:
+        messages = [messages_queue.get()]
+        while len(messages) < batch_size:
+            try:
+                messages.append(messages_queue.get_nowait())
+            except queue.Empty:
+                break
+        # None tells the thread to exit once everything before it is written.
+        exiting = messages[-1] is None
+        if exiting:
+            messages.pop()
+        if messages:
+            write_messages(connection_pool, messages, instance_events)
+        if exiting:
+            return
+
+
+def run_db_writer(input_queue, instance_events, exit_event, num_connections, batch_size):
+    logger.info(f"DBWriter starting with {num_connections} connections.")
+    connection_pool = pooling.MySQLConnectionPool(
+        pool_name="crowdplay_db_writer",
+        pool_size=num_connections,
+        user=os.environ.get("MYSQL_USER"),
+        password=os.environ.get("MYSQL_PASSWORD"),
+        host=os.environ.get("MYSQL_HOST"),
+        database=os.environ.get("MYSQL_DATABASE"),
+    )
+    thread_queues = [queue.Queue() for _ in range(num_connections)]
+    threads = [
+        threading.Thread(
+            target=writer_thread_fn, args=(connection_pool, thread_queue, instance_events, batch_size), daemon=True
+        )
+        for thread_queue in thread_queues
+    ]
+    for thread in threads:
+        thread.start()
+    while True:
+        try:
+            message = input_queue.get(timeout=WAIT_TIMEOUT)
+        except queue.Empty:
+            # Only exit once everything sent before the exit event was set has arrived.
+            if exit_event.is_set():
+                break
+            continue
+        # Messages of the same instance always go to the same thread, so they are written in order.
+        thread_queues[hash(message[1]) % num_connections].put(message)
+    for thread_queue in thread_queues:
+        thread_queue.put(None)
+    for thread in threads:
+        thread.join()
+    logger.info("DBWriter exiting.")
+
+
+class DBWriter:
+    """Starts the DB writer process, and leases the events that tell EnvRunners when an instance's data is written."""
+
+    def __init__(self, num_connections, max_instances, batch_size):
+        self.queue = multiprocessing.Queue()
+        self.exit_event = multiprocessing.Event()
+        self.instance_events = [multiprocessing.Event() for _ in range(max_instances)]
+        # Instance id that leased each event, or None if it is free. Only used in the web process.
+        self.leases = [None] * max_instances
+        self.process = multiprocessing.Process(
+            target=run_db_writer,
+            args=(self.queue, self.instance_events, self.exit_event, num_connections, batch_size),
+        )
+        self.process.start()
+
+    def lease_event(self, instance_id):
+        """Leases an event to be set once all data of instance_id is written.
+
+        Returns:
+            The index of the event, or None if all events are leased.
+        """
+        for index, lease in enumerate(self.leases):
+            if lease is None:
+                self.leases[index] = instance_id
+                self.instance_events[index].clear()
+                return index
+        logger.warn(f"All {len(self.leases)} DBWriter events are leased, not waiting for data of {instance_id}.")
+        return None
+
+    def release_event(self, index):
+        self.leases[index] = None
+
+    def close(self):
+        """Stops the writer process once everything already sent is written."""
+        self.exit_event.set()
+        self.process.join()
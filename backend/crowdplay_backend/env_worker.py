@@ -0,0 +1,343 @@
+"""
+Worker processes that each host many environment instances.
+
+By default every EnvRunner starts its own EnvProcess, each with its own copy of all loaded modules (gym, TF, ray, ...),
+which limits how many games a host can run at once. With Config.ENV_WORKERS set, a fixed pool of EnvWorker processes
+is started instead, and EnvsManager places new instances on the least-loaded worker. Instances on workers write to the
+DB through the same DBWriter as all other instances (see db_writer.py).
+
+Pipes, events and shared memory can only be shared with a process when it is started, so each worker is started with
+a fixed number of slots, which hold everything an instance needs to talk to its EnvRunner. An EnvRunner leases a free
+slot and uses it exactly like the pipes and events of its own EnvProcess, so the web process side works the same
+either way. The worker runs all episodes on one clock: it runs each instance's next frame when it is due (see
+EnvProcess.episode_frames()), and in between blocks until the next frame is due, a command arrives, or a player of a
+turn-based game sends an action. Creating an EnvProcess builds the environment and loads the ROM and AI policies, which
+can take seconds, so new instances are created in a builder thread and handed to the frame loop once they are ready.
+
+If a worker process dies, EnvWorkerPool tells the EnvRunners of its instances that they are finished, closes them in the
+DB, and starts a new worker with new slots in its place.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing.connection import wait
+
+from .config import Config
+from .EnvRunner import EPISODE_WAITING, WAIT_TIMEOUT, EnvProcess
+from .frame_buffer import SharedFrameBuffer
+from .frame_scheduler import FrameScheduler
+from .logger import getLogger
+from .socketio import socketio
+
+logger = getLogger(__name__)
+
+# EnvWorker wakes up slightly after frames are due, that shouldn't count as an overrun.
+WORKER_FRAME_TOLERANCE = 0.002
+
+# How often EnvWorkerPool.monitor() checks whether worker processes are alive.
+WORKER_CHECK_INTERVAL = 1.0
+
+
+class WorkerSlot:
+    """Pipes, events and frame buffer for one instance on an EnvWorker, shared between the web process and worker."""
+
+    def __init__(self, worker_index, index):
+        self.worker_index = worker_index
+        self.index = index
+        self.command_parent, self.command_child = multiprocessing.Pipe()
+        self.action_recv, self.action_send = multiprocessing.Pipe(duplex=False)
+        self.frame_buffer = SharedFrameBuffer(Config.FRAME_BUFFER_BYTES)
+        self.exit_event = multiprocessing.Event()
+        self.episode_running_event = multiprocessing.Event()
+        self.stop_episode_event = multiprocessing.Event()
+        self.is_finished_event = multiprocessing.Event()
+        self.ready_event = multiprocessing.Event()
+        # Only used in the web process.
+        self.instance_id = None
+        self.database_event_index = None
+
+    def lease(self, instance_id, database_event_index=None):
+        """Marks the slot as used by instance_id, and clears anything left over from its previous instance."""
+        self.instance_id = instance_id
+        self.database_event_index = database_event_index
+        for event in (
+            self.exit_event,
+            self.episode_running_event,
+            self.stop_episode_event,
+            self.is_finished_event,
+            self.ready_event,
+        ):
+            event.clear()
+        # The previous instance is gone, so nothing reads from its pipes anymore. Drop what it didn't get to read
+        # (in both directions), before the new instance sends anything.
+        for connection in (self.command_parent, self.command_child, self.action_recv):
+            while connection.poll():
+                connection.recv()
+
+    def release(self):
+        self.instance_id = None
+        self.database_event_index = None
+
+
+class HostedInstance:
+    """An EnvProcess running on an EnvWorker, and the timing of its episode."""
+
+    def __init__(self, env_process):
+        self.env_process = env_process
+        self.scheduler = None
+        # When the episode started waiting for players' actions, or None if it isn't waiting.
+        self.waiting_since = None
+
+
+class EnvWorker:
+    def __init__(self, index, slots, command_recv, database_queue, exit_event, inference_queues=None):
+        self.index = index
+        self.slots = slots
+        self.command_recv = command_recv
+        self.database_queue = database_queue
+        self.inference_queues = inference_queues
+        self.exit_event = exit_event
+        # Hosted instances by slot index.
+        self.instances = {}
+        # Data of "add_instance" commands for the builder thread, and the EnvProcesses it has built, by slot index. The
+        # builder sends on built_send whenever it has put one in self.built, to wake up the frame loop.
+        self.build_queue = queue.Queue()
+        self.built = queue.Queue()
+        self.built_recv, self.built_send = multiprocessing.Pipe(duplex=False)
+        self.builder = threading.Thread(target=self.build_instances, daemon=True)
+
+    def run(self):
+        logger.info(f"EnvWorker {self.index} starting.")
+        self.builder.start()
+        while not self.exit_event.is_set():
+            while self.command_recv.poll():
+                self.process_command(*self.command_recv.recv())
+            while self.built_recv.poll():
+                self.built_recv.recv()
+                self.host_instance(*self.built.get_nowait())
+            timeout = WAIT_TIMEOUT
+            for slot_index, instance in list(self.instances.items()):
+                instance.env_process.process_command()
+                if instance.env_process.env_process_exit_event.is_set():
+                    self.close_instance(slot_index)
+                elif instance.env_process.episode is not None:
+                    timeout = min(timeout, self.run_instance(instance))
+            wait(self.wait_objects(), max(0.0, timeout))
+        # Instances that are still being built have to be closed too, so that their EnvRunners and the DBWriter know.
+        self.build_queue.put(None)
+        self.builder.join()
+        while not self.built.empty():
+            self.host_instance(*self.built.get_nowait())
+        for slot_index in list(self.instances):
+            self.close_instance(slot_index)
+        logger.info(f"EnvWorker {self.index} exiting.")
+
+    def process_command(self, cmd, data):
+        if cmd == "add_instance":
+            self.build_queue.put(data)
+
+    def build_instances(self):
+        """Builder thread: creates the EnvProcesses of new instances, without holding up the frame loop."""
+        while True:
+            data = self.build_queue.get()
+            if data is None:
+                return
+            slot = self.slots[data["slot_index"]]
+            try:
+                env_process = EnvProcess(
+                    data["instance_id"],
+                    data["task_id"],
+                    slot.command_child,
+                    slot.action_recv,
+                    slot.frame_buffer,
+                    slot.exit_event,
+                    slot.episode_running_event,
+                    slot.stop_episode_event,
+                    slot.is_finished_event,
+                    self.database_queue,
+                    data["database_event_index"],
+                    data["fps"],
+                    worker_slot_index=slot.index,
+                    inference_queues=self.inference_queues,
+                    env_process_ready_event=slot.ready_event,
+                )
+            except Exception:
+                logger.exception(f"EnvWorker {self.index} failed to create instance {data['instance_id']}.")
+                # Let the EnvRunner know the instance is gone, so that the slot and DBWriter event can be reused.
+                self.database_queue.put(("instance_closed", data["instance_id"], data["database_event_index"]))
+                slot.is_finished_event.set()
+                continue
+            self.built.put((slot.index, env_process))
+            self.built_send.send(slot.index)
+
+    def host_instance(self, slot_index, env_process):
+        self.instances[slot_index] = HostedInstance(env_process)
+        logger.info(f"EnvWorker {self.index} hosting instance {env_process.instance_id} in slot {slot_index}.")
+
+    def run_instance(self, instance):
+        """Runs the next frame of an instance's episode if it is due, and returns how long until it should run next."""
+        env_process = instance.env_process
+        if instance.scheduler is None:
+            # New episode, run its first frame right away.
+            instance.scheduler = FrameScheduler(
+                env_process.fps, name=f"Instance {env_process.instance_id}", tolerance=WORKER_FRAME_TOLERANCE
+            )
+        elif instance.waiting_since is not None:
+            if not env_process.action_recv.poll() and time.monotonic() - instance.waiting_since < WAIT_TIMEOUT:
+                return WAIT_TIMEOUT
+            instance.waiting_since = None
+            instance.scheduler.resync()
+        else:
+            instance.scheduler.fps = env_process.fps
+            delay = instance.scheduler.time_until_due()
+            if delay > 0:
+                return delay
+            instance.scheduler.advance(-delay)
+
+        try:
+            state = next(env_process.episode)
+        except StopIteration:
+            self.end_episode(instance)
+            return WAIT_TIMEOUT
+        except Exception:
+            # Same as an exception in the episode thread of a standalone EnvProcess, but don't take down the worker.
+            logger.exception(f"Episode in instance {env_process.instance_id} failed.")
+            self.end_episode(instance)
+            return WAIT_TIMEOUT
+        if state == EPISODE_WAITING:
+            instance.waiting_since = time.monotonic()
+            return WAIT_TIMEOUT
+        return instance.scheduler.time_until_due()
+
+    def end_episode(self, instance):
+        instance.scheduler.report()
+        instance.env_process.episode = None
+        instance.scheduler = None
+        instance.waiting_since = None
+
+    def close_instance(self, slot_index):
+        instance = self.instances.pop(slot_index)
+        if instance.env_process.episode is not None:
+            # The exit event is set, so this only runs the end of the episode.
+            for _ in instance.env_process.episode:
+                pass
+            instance.env_process.episode = None
+        instance.env_process.close_process()
+
+    def wait_objects(self):
+        """Connections that should wake up the worker when they are readable."""
+        objects = [self.command_recv, self.built_recv]
+        for instance in self.instances.values():
+            objects.append(instance.env_process.command_child)
+            if instance.waiting_since is not None:
+                objects.append(instance.env_process.action_recv)
+        return objects
+
+
+def run_env_worker(index, slots, command_recv, database_queue, exit_event, inference_queues):
+    EnvWorker(index, slots, command_recv, database_queue, exit_event, inference_queues).run()
+
+
+class EnvWorkerPool:
+    """Starts and keeps track of the EnvWorker processes, and places instances on them."""
+
+    def __init__(self, num_workers, slots_per_worker, database_queue, inference_queues=None):
+        """
+        Args:
+            database_queue: Queue of the DBWriter, shared by all instances on all workers.
+            inference_queues: Queues and ready events of InferenceServers by AI policy id (see inference_server.py), or
+                None.
+        """
+        self.exit_event = multiprocessing.Event()
+        self.slots_per_worker = slots_per_worker
+        self.database_queue = database_queue
+        self.inference_queues = inference_queues
+        self.slots = [None] * num_workers
+        self.command_sends = [None] * num_workers
+        self.worker_processes = [None] * num_workers
+        for worker_index in range(num_workers):
+            self.start_worker(worker_index)
+        logger.info(f"Started {num_workers} env workers with {slots_per_worker} slots each.")
+
+    def start_worker(self, worker_index):
+        """Starts a worker process with new slots."""
+        slots = [WorkerSlot(worker_index, index) for index in range(self.slots_per_worker)]
+        command_recv, command_send = multiprocessing.Pipe(duplex=False)
+        worker_process = multiprocessing.Process(
+            target=run_env_worker,
+            args=(worker_index, slots, command_recv, self.database_queue, self.exit_event, self.inference_queues),
+        )
+        worker_process.start()
+        self.slots[worker_index] = slots
+        self.command_sends[worker_index] = command_send
+        self.worker_processes[worker_index] = worker_process
+
+    def check_workers(self):
+        """Replaces workers whose process has died.
+
+        The instances on a dead worker are gone, so their EnvRunners are told they are finished, and they are closed in
+        the DB with EnvProcess status 2, like an EnvProcess that didn't exit. This also sets their DBWriter events once
+        everything they sent before has been written.
+        """
+        if self.exit_event.is_set():
+            return
+        for worker_index, worker_process in enumerate(self.worker_processes):
+            if worker_process.is_alive():
+                continue
+            logger.error(
+                f"Env worker {worker_index} died with exit code {worker_process.exitcode}, starting a new one."
+            )
+            for slot in self.slots[worker_index]:
+                if slot.instance_id is None:
+                    continue
+                self.database_queue.put(("envprocess_status", slot.instance_id, 2))
+                self.database_queue.put(("instance_closed", slot.instance_id, slot.database_event_index))
+                slot.is_finished_event.set()
+            # The dead worker's slots stay with the EnvRunners that still use them, and are never leased again.
+            self.start_worker(worker_index)
+
+    def monitor(self):
+        """Checks workers regularly until the pool is closed. Runs as a background task in the web process."""
+        while not self.exit_event.is_set():
+            self.check_workers()
+            socketio.sleep(WORKER_CHECK_INTERVAL)
+
+    def load(self, worker_index):
+        """Number of instances on a worker."""
+        return sum(slot.instance_id is not None for slot in self.slots[worker_index])
+
+    def place(self, instance_id, task_id, fps, database_event_index):
+        """Starts an instance on the least-loaded worker.
+
+        Returns:
+            The WorkerSlot leased for the instance, or None if all workers are full.
+        """
+        self.check_workers()
+        worker_index = min(range(len(self.slots)), key=self.load)
+        free_slots = [slot for slot in self.slots[worker_index] if slot.instance_id is None]
+        if len(free_slots) == 0:
+            return None
+        slot = free_slots[0]
+        slot.lease(instance_id, database_event_index)
+        self.command_sends[worker_index].send(
+            (
+                "add_instance",
+                {
+                    "slot_index": slot.index,
+                    "instance_id": instance_id,
+                    "task_id": task_id,
+                    "fps": fps,
+                    "database_event_index": database_event_index,
+                },
+            )
+        )
+        logger.info(
+            f"Placed instance {instance_id} on env worker {worker_index} ({self.load(worker_index)} instances)."
+        )
+        return slot
+
+    def close(self):
+        """Stops all workers. Instances still running are stopped, and their data sent to the DBWriter."""
+        self.exit_event.set()
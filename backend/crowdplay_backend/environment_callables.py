@@ -1,3 +1,14 @@
+"""
+Callables that track task progress, e.g. the score, play time, or how aliens were shot in Space Invaders.
+
+Callables are called with the step_info of every step of an episode, and return their value after that step, by agent.
+Built-in callables also have an evaluate_episode() method that returns the same as the last call after a whole
+episode, computed with NumPy on whole columns at once. This is used to (re)compute callables for recorded episodes,
+see crowdplay_datasets.dataset.EpisodeModel.run_callable(). Its argument is a dict with the episode's "length", and by
+agent its "ram" as a (T, 128) uint8 array, and "reward" and "action" (game actions) as (T,) arrays.
+"""
+
+from abc import ABC, abstractmethod
 from datetime import timedelta
 
 import numpy as np
@@ -10,6 +21,9 @@ class ConstantCallable:
     def __call__(self, step_info):
         return self.constants
 
+    def evaluate_episode(self, episode):
+        return self.constants
+
 
 class TimeCallable:
     def __init__(self):
@@ -20,6 +34,9 @@ class TimeCallable:
         self.time_cur += 1
         return {agent: timedelta(seconds=self.time_cur // 60) for agent in step_info["prev_obs"]}
 
+    def evaluate_episode(self, episode):
+        return {agent: timedelta(seconds=episode["length"] // 60) for agent in episode["reward"]}
+
 
 class ActiveTimeCallable:
     """Incentives active play time (at least some reward or action every timout frames)."""
@@ -49,6 +66,19 @@ class ActiveTimeCallable:
                 self.agent_active_time[agent] += 1
         return {agent: timedelta(seconds=self.agent_active_time[agent] // 60) for agent in self.agent_active_time}
 
+    def evaluate_episode(self, episode):
+        time = np.arange(1, episode["length"] + 1)
+        active_time = {}
+        for agent in self.agent_active_time:
+            # Time of the last reward and action up to each step, or 0 if there was none yet.
+            last_reward_time = np.maximum.accumulate(np.where(episode["reward"][agent] != 0, time, 0))
+            active = last_reward_time + self.timeout >= time
+            if self.action_timeout is not None:
+                last_action_time = np.maximum.accumulate(np.where(episode["action"][agent] != 0, time, 0))
+                active &= last_action_time + self.action_timeout >= time
+            active_time[agent] = int(active.sum())
+        return {agent: timedelta(seconds=active_time[agent] // 60) for agent in active_time}
+
 
 class ScoreCallable:
     def __init__(self, agents):
@@ -61,6 +91,13 @@ class ScoreCallable:
         return {agent: self.reward_cur[agent] for agent in self.reward_cur}
         # {agent: f'Reward: {self.reward_cur[agent]} / {self.reward_goals[agent]}' for agent in self.reward_goals})
 
+    def evaluate_episode(self, episode):
+        # cumsum adds up rewards in order, like __call__(), so float rewards round the same way.
+        return {
+            agent: np.cumsum(episode["reward"][agent])[-1].item() if episode["length"] > 0 else 0
+            for agent in self.reward_cur
+        }
+
 
 class SpaceInvadersLeftRightCallable:
     def __init__(self, position_goals):
@@ -71,14 +108,24 @@ class SpaceInvadersLeftRightCallable:
     def __call__(self, step_info):
         self.time += 1
         for agent in step_info["reward"]:
+            player_x = space_invaders_ram_features(step_info["info"][agent]["RAM"]).player_x
             if agent.endswith("0"):
-                pos = (step_info["info"][agent]["RAM"][0x1C] - 0x23) / (0x75 - 0x23)
+                pos = (player_x[0] - 0x23) / (0x75 - 0x23)
             else:
-                pos = (step_info["info"][agent]["RAM"][0x1D] - 0x23) / (0x75 - 0x23)
+                pos = (player_x[1] - 0x23) / (0x75 - 0x23)
             if self.position_goals[agent]["min"] <= pos and pos <= self.position_goals[agent]["max"]:
                 self.position_cur[agent] += 1
         return {agent: (self.position_cur[agent] / self.time) for agent in self.position_goals}
 
+    def evaluate_episode(self, episode):
+        results = {}
+        for agent in self.position_goals:
+            player_x = SpaceInvadersRamFeatures(episode["ram"][agent]).player_x
+            pos = (player_x[:, 0 if agent.endswith("0") else 1] - 0x23) / (0x75 - 0x23)
+            goals = self.position_goals[agent]
+            results[agent] = int(((goals["min"] <= pos) & (pos <= goals["max"])).sum()) / episode["length"]
+        return results
+
 
 # class MinCallable:
 #     def __init__(self, callables, list_of_agents):
@@ -115,6 +162,59 @@ def space_invaders_ram_to_aliens(ram):
     #         alien = (row & (1<<j) != 0)
 
 
+class SpaceInvadersRamFeatures:
+    """Everything the Space Invaders callables read from the RAM, for one step ((128,) RAM) or a whole episode
+    ((T, 128) RAM, in which case every feature has the step as its first axis)."""
+
+    def __init__(self, ram):
+        ram = np.asarray(ram, dtype=np.uint8)
+        # aliens[..., i, j] is whether the alien in row i, column j is still there (see space_invaders_ram_to_aliens()).
+        self.aliens = (ram[..., 0x12:0x18, np.newaxis] >> np.arange(6) & 1).astype(bool)
+        self.rows_with_aliens = self.aliens.any(axis=-1)
+        self.columns_with_aliens = self.aliens.any(axis=-2)
+        # x position of each player.
+        self.player_x = ram[..., [0x1C, 0x1D]].astype(np.int64)
+        # y position of the two shots in flight, and which player they belong to (bits 0x4 and 0x8).
+        self.shot_y = ram[..., [0x55, 0x56]]
+        self.shot_players = ram[..., 0x18]
+
+
+class RamFeatureCache:
+    """Computes the features of a RAM array only once, for all agents and callables of a step.
+
+    MaxFrameAndRAMWrapper puts the same RAM array into the info of every agent, and a new one every step, so it is
+    enough to keep the features of the latest array. RAM arrays must not be modified once callables have seen them.
+    RAM that isn't a numpy array (e.g. lists in old trajectories) is not cached.
+    """
+
+    def __init__(self, make_features):
+        self.make_features = make_features
+        self.ram = None
+        self.features = None
+
+    def __call__(self, ram):
+        if ram is not self.ram:
+            self.features = self.make_features(ram)
+            self.ram = ram if isinstance(ram, np.ndarray) else None
+        return self.features
+
+
+space_invaders_ram_features = RamFeatureCache(SpaceInvadersRamFeatures)
+
+
+def space_invaders_aliens_shot(prev_aliens, agent, aliens):
+    """Returns a 6x6 bool array of the aliens shot since the last step, and remembers aliens for the next one."""
+    shot = prev_aliens[agent] & ~aliens
+    prev_aliens[agent] = aliens
+    return shot
+
+
+def space_invaders_episode_aliens_shot(aliens):
+    """Returns a (T, 6, 6) bool array of the aliens shot in each step, given the (T, 6, 6) aliens of an episode."""
+    prev_aliens = np.concatenate([np.ones((1, 6, 6), dtype=bool), aliens[:-1]])
+    return prev_aliens & ~aliens
+
+
 # class SpaceInvadersShowAlienMatrix:
 #     def __init__(self):
 #         pass
@@ -126,59 +226,84 @@ def space_invaders_ram_to_aliens(ram):
 #         return (result, string)
 
 
-class SpaceInvadersRows135:
-    """Incentivises only shooting rows 1,3,5"""
+class SpaceInvadersAliensCallable(ABC):
+    """Base class of callables that count the aliens each agent shot, as good or bad ones (see good_shots()).
 
-    def __init__(self, agents):
-        self.prev_aliens = {agent: tuple(tuple(1 for j in range(6)) for i in range(6)) for agent in agents}
+    Returns the fraction of good aliens among all aliens shot, or the number of good aliens shot with kind="count".
+    """
+
+    def __init__(self, agents, kind="fraction"):
+        self.prev_aliens = {agent: np.ones((6, 6), dtype=bool) for agent in agents}
         self.good_aliens = {agent: 0 for agent in agents}
         self.bad_aliens = {agent: 0 for agent in agents}
-        pass
+        self.kind = kind
 
-    def __call__(self, step_info):
+    @abstractmethod
+    def good_shots(self, features):
+        """Returns where shooting an alien is good, as a bool array that broadcasts to features.aliens.
+
+        Args:
+            features: SpaceInvadersRamFeatures of the step(s) the aliens were shot in.
+        """
+
+    def _results(self, agents, good_aliens, bad_aliens):
+        if self.kind != "fraction":
+            return good_aliens
         results = {}
-        for agent in step_info["info"]:
-            new_aliens = space_invaders_ram_to_aliens(step_info["info"][agent]["RAM"])
-            changed_aliens = tuple(
-                tuple(self.prev_aliens[agent][i][j] == 1 and new_aliens[i][j] == 0 for j in range(6)) for i in range(6)
-            )
-            self.prev_aliens[agent] = new_aliens
-            for j in (0, 2, 4):
-                for i in range(6):
-                    if changed_aliens[i][j] == 1:
-                        self.good_aliens[agent] += 1
-            for j in (1, 3, 5):
-                for i in range(6):
-                    if changed_aliens[i][j] == 1:
-                        self.bad_aliens[agent] += 1
-            if self.good_aliens[agent] + self.bad_aliens[agent] > 0:
-                alien_ratio = self.good_aliens[agent] / (self.good_aliens[agent] + self.bad_aliens[agent])
+        for agent in agents:
+            if good_aliens[agent] + bad_aliens[agent] > 0:
+                results[agent] = good_aliens[agent] / (good_aliens[agent] + bad_aliens[agent])
             else:
-                alien_ratio = 0
-            results[agent] = alien_ratio
+                results[agent] = 0
         return results
 
+    def __call__(self, step_info):
+        for agent in step_info["info"]:
+            features = space_invaders_ram_features(step_info["info"][agent]["RAM"])
+            # Check which aliens have been shot just now, and if they were the right ones
+            changed_aliens = space_invaders_aliens_shot(self.prev_aliens, agent, features.aliens)
+            good_shots = self.good_shots(features)
+            self.good_aliens[agent] += int((changed_aliens & good_shots).sum())
+            self.bad_aliens[agent] += int((changed_aliens & ~good_shots).sum())
+        return self._results(step_info["info"], self.good_aliens, self.bad_aliens)
+
+    def evaluate_episode(self, episode):
+        good_aliens = {}
+        bad_aliens = {}
+        for agent in self.good_aliens:
+            features = SpaceInvadersRamFeatures(episode["ram"][agent])
+            changed_aliens = space_invaders_episode_aliens_shot(features.aliens)
+            good_shots = self.good_shots(features)
+            good_aliens[agent] = int((changed_aliens & good_shots).sum())
+            bad_aliens[agent] = int((changed_aliens & ~good_shots).sum())
+        return self._results(good_aliens, good_aliens, bad_aliens)
+
+
+def rows_cleared_before(rows_with_aliens):
+    """Returns whether all rows before each row are cleared, for a (..., 6) array of the rows that have aliens."""
+    cleared = np.ones_like(rows_with_aliens)
+    cleared[..., 1:] = ~np.logical_or.accumulate(rows_with_aliens, axis=-1)[..., :-1]
+    return cleared
+
+
+class SpaceInvadersRows135(SpaceInvadersAliensCallable):
+    """Incentivises only shooting rows 1,3,5"""
+
+    def __init__(self, agents):
+        super().__init__(agents)
+
+    def good_shots(self, features):
+        return np.array([True, False] * 3)
 
-class SpaceInvadersAliensHit:
+
+class SpaceInvadersAliensHit(SpaceInvadersAliensCallable):
     """Counts number of aliens shot"""
 
     def __init__(self, agents):
-        self.prev_aliens = {agent: tuple(tuple(1 for j in range(6)) for i in range(6)) for agent in agents}
-        self.good_aliens = {agent: 0 for agent in agents}
-        pass
+        super().__init__(agents, kind="count")
 
-    def __call__(self, step_info):
-        for agent in step_info["info"]:
-            new_aliens = space_invaders_ram_to_aliens(step_info["info"][agent]["RAM"])
-            changed_aliens = tuple(
-                tuple(self.prev_aliens[agent][i][j] == 1 and new_aliens[i][j] == 0 for j in range(6)) for i in range(6)
-            )
-            self.prev_aliens[agent] = new_aliens
-            for j in range(6):
-                for i in range(6):
-                    if changed_aliens[i][j] == 1:
-                        self.good_aliens[agent] += 1
-        return self.good_aliens
+    def good_shots(self, features):
+        return np.array(True)
 
 
 class SpaceInvadersAccuracy:
@@ -200,24 +325,23 @@ class SpaceInvadersAccuracy:
         # Check if a shot has been fired
         shot_did_fire = {p: False for p in self.agents}
 
-        ale_ram = step_info["info"][self.agents[0]]["RAM"]
+        features = space_invaders_ram_features(step_info["info"][self.agents[0]]["RAM"])
 
         # There are two slots available for shots in flight; either can belong to either player.
         # We will check each, and then check which player it belongs to.
         # Get RAM contents of shot 0 and 1 slots y-coordinate.
-        shot0 = ale_ram[0x55]
-        shot1 = ale_ram[0x56]
+        shot0, shot1 = features.shot_y
 
         # New shot starts at y-coordinate 0x55, and no-shot is encoded as 0xf6 (always?).
         # It looks like it is enough to check if a shot is at y-coord 0x55.
         # We check that, then check which player it belongs to, then increase that player's shot counter.
         if shot0 == 0x55:
-            if ale_ram[0x18] & 0x4:
+            if features.shot_players & 0x4:
                 shot_did_fire[self.agents[1]] = True
             else:
                 shot_did_fire[self.agents[0]] = True
         if shot1 == 0x55:
-            if ale_ram[0x18] & 0x8:
+            if features.shot_players & 0x8:
                 shot_did_fire[self.agents[1]] = True
             else:
                 shot_did_fire[self.agents[0]] = True
@@ -232,167 +356,60 @@ class SpaceInvadersAccuracy:
             for agent in self.agents
         }
 
+    def evaluate_episode(self, episode):
+        features = SpaceInvadersRamFeatures(episode["ram"][self.agents[0]])
+        # Steps in which each player fired at least one new shot, see __call__().
+        shot_did_fire = {agent: np.zeros(episode["length"], dtype=bool) for agent in self.agents}
+        for slot, second_player_bit in ((0, 0x4), (1, 0x8)):
+            new_shot = features.shot_y[:, slot] == 0x55
+            second_player = (features.shot_players & second_player_bit) != 0
+            if (new_shot & second_player).any():
+                shot_did_fire[self.agents[1]] |= new_shot & second_player
+            shot_did_fire[self.agents[0]] |= new_shot & ~second_player
+        results = {}
+        for agent in self.agents:
+            shots_fired = int(shot_did_fire[agent].sum())
+            clipped_reward = np.sign(episode["reward"][agent]).sum()
+            results[agent] = (clipped_reward / shots_fired) if shots_fired > 0 else 0
+        return results
 
-class SpaceInvadersRowsByRow:
-    """Incentivises shooting aliens by row"""
 
-    def __init__(self, agents, kind="fraction"):
-        self.prev_aliens = {agent: tuple(tuple(1 for j in range(6)) for i in range(6)) for agent in agents}
-        self.good_aliens = {agent: 0 for agent in agents}
-        self.bad_aliens = {agent: 0 for agent in agents}
-        self.kind = kind
-        pass
+class SpaceInvadersRowsByRow(SpaceInvadersAliensCallable):
+    """Incentivises shooting aliens by row"""
 
-    def __call__(self, step_info):
-        results = {}
-        for agent in step_info["info"]:
-            # Check which aliens have been shot just now
-            new_aliens = space_invaders_ram_to_aliens(step_info["info"][agent]["RAM"])
-            changed_aliens = tuple(
-                tuple(self.prev_aliens[agent][i][j] == 1 and new_aliens[i][j] == 0 for j in range(6)) for i in range(6)
-            )
-            self.prev_aliens[agent] = new_aliens
-            # Check which rows are cleared
-            rows_cleared = [True for i in range(-1, 6)]
-            for i in range(6):
-                for j in range(6):
-                    if new_aliens[i][j] == 1:
-                        rows_cleared[i] = False
-                if not rows_cleared[i]:
-                    for k in range(i, 6):
-                        rows_cleared[k] = False
-                    break
-            # Check if the correct aliens have been shot.
-            for i in range(6):
-                for j in range(6):
-                    if changed_aliens[i][j] == 1:
-                        if rows_cleared[i - 1]:
-                            self.good_aliens[agent] += 1
-                        else:
-                            self.bad_aliens[agent] += 1
-            if self.good_aliens[agent] + self.bad_aliens[agent] > 0:
-                alien_ratio = self.good_aliens[agent] / (self.good_aliens[agent] + self.bad_aliens[agent])
-            else:
-                alien_ratio = 0
-            results[agent] = alien_ratio
-        if self.kind == "fraction":
-            return results
-        else:
-            return self.good_aliens
+    def good_shots(self, features):
+        # Shooting an alien is good if all rows before its row are cleared.
+        return rows_cleared_before(features.rows_with_aliens)[..., np.newaxis]
 
 
-class SpaceInvadersOutsideIn:
+class SpaceInvadersOutsideIn(SpaceInvadersAliensCallable):
     """Incentivises shooting aliens by column outside in"""
 
-    def __init__(self, agents, kind="fraction"):
-        self.prev_aliens = {agent: tuple(tuple(1 for j in range(6)) for i in range(6)) for agent in agents}
-        self.good_aliens = {agent: 0 for agent in agents}
-        self.bad_aliens = {agent: 0 for agent in agents}
-        self.kind = kind
-        pass
-
-    def __call__(self, step_info):
-        results = {}
-        for agent in step_info["info"]:
-            # Check which aliens have been shot just now
-            new_aliens = space_invaders_ram_to_aliens(step_info["info"][agent]["RAM"])
-            changed_aliens = tuple(
-                tuple(self.prev_aliens[agent][i][j] == 1 and new_aliens[i][j] == 0 for j in range(6)) for i in range(6)
-            )
-            self.prev_aliens[agent] = new_aliens
-            # Check which columns are cleared
-            cols_cleared = [True for i in range(-1, 7)]
-            for i in range(6):
-                for j in range(6):
-                    if new_aliens[i][j] == 1:
-                        cols_cleared[j] = False
-                # Propagate cols cleared. But maybe easier to check below.
-                # if cols_cleared[j] == False:
-                #     for k in range(j, 6):
-                #         cols_cleared[k] = False
-                #     break
-            # Check if the correct aliens have been shot.
-            for i in range(6):
-                for j in range(3):
-                    if changed_aliens[i][j] == 1:
-                        if all(list((cols_cleared[k] for k in range(j)))):
-                            self.good_aliens[agent] += 1
-                        else:
-                            self.bad_aliens[agent] += 1
-                for j in range(3, 6):
-                    if changed_aliens[i][j] == 1:
-                        if all(list((cols_cleared[k] for k in range(j + 1, 7)))):
-                            self.good_aliens[agent] += 1
-                        else:
-                            self.bad_aliens[agent] += 1
-            if self.good_aliens[agent] + self.bad_aliens[agent] > 0:
-                alien_ratio = self.good_aliens[agent] / (self.good_aliens[agent] + self.bad_aliens[agent])
-            else:
-                alien_ratio = 0
-            results[agent] = alien_ratio
-        if self.kind == "fraction":
-            return results
-        else:
-            return self.good_aliens
+    def good_shots(self, features):
+        # Shooting an alien in the left half is good if all columns to its left are cleared,
+        # and in the right half if all columns to its right are cleared.
+        columns = features.columns_with_aliens
+        good_columns = np.empty_like(columns)
+        for j in range(3):
+            good_columns[..., j] = ~columns[..., :j].any(axis=-1)
+        for j in range(3, 6):
+            good_columns[..., j] = ~columns[..., j + 1 :].any(axis=-1)
+        return good_columns[..., np.newaxis, :]
 
 
-class SpaceInvadersInsideOut:
+class SpaceInvadersInsideOut(SpaceInvadersAliensCallable):
     """Incentivises shooting aliens by column inside out"""
 
-    def __init__(self, agents, kind="fraction"):
-        self.prev_aliens = {agent: tuple(tuple(1 for j in range(6)) for i in range(6)) for agent in agents}
-        self.good_aliens = {agent: 0 for agent in agents}
-        self.bad_aliens = {agent: 0 for agent in agents}
-        self.kind = kind
-        pass
-
-    def __call__(self, step_info):
-        results = {}
-        for agent in step_info["info"]:
-            # Check which aliens have been shot just now
-            new_aliens = space_invaders_ram_to_aliens(step_info["info"][agent]["RAM"])
-            changed_aliens = tuple(
-                tuple(self.prev_aliens[agent][i][j] == 1 and new_aliens[i][j] == 0 for j in range(6)) for i in range(6)
-            )
-            self.prev_aliens[agent] = new_aliens
-            # Check which columns are cleared
-            cols_cleared = [True for i in range(-1, 7)]
-            for i in range(6):
-                for j in range(6):
-                    if new_aliens[i][j] == 1:
-                        cols_cleared[j] = False
-                # Propagate cols cleared. But maybe easier to check below.
-                # if cols_cleared[j] == False:
-                #     for k in range(j, 6):
-                #         cols_cleared[k] = False
-                #     break
-            # Check if the correct aliens have been shot.
-            for i in range(6):
-                # Innermost two rows
-                for j in range(2, 4):
-                    if changed_aliens[i][j] == 1:
-                        self.good_aliens[agent] += 1
-                for j in range(2):
-                    if changed_aliens[i][j] == 1:
-                        if all(list((cols_cleared[k] for k in range(j + 1, 3)))):
-                            self.good_aliens[agent] += 1
-                        else:
-                            self.bad_aliens[agent] += 1
-                for j in range(4, 6):
-                    if changed_aliens[i][j] == 1:
-                        if all(list((cols_cleared[k] for k in range(3, j)))):
-                            self.good_aliens[agent] += 1
-                        else:
-                            self.bad_aliens[agent] += 1
-            if self.good_aliens[agent] + self.bad_aliens[agent] > 0:
-                alien_ratio = self.good_aliens[agent] / (self.good_aliens[agent] + self.bad_aliens[agent])
-            else:
-                alien_ratio = 0
-            results[agent] = alien_ratio
-        if self.kind == "fraction":
-            return results
-        else:
-            return self.good_aliens
+    def good_shots(self, features):
+        # Shooting an alien in the innermost two columns is always good, and in any other column if all columns
+        # between it and the innermost two are cleared.
+        columns = features.columns_with_aliens
+        good_columns = np.empty_like(columns)
+        for j in range(3):
+            good_columns[..., j] = ~columns[..., j + 1 : 3].any(axis=-1)
+        for j in range(3, 6):
+            good_columns[..., j] = ~columns[..., 3:j].any(axis=-1)
+        return good_columns[..., np.newaxis, :]
 
 
 class RiverraidLeftRightCallable:
@@ -405,7 +422,16 @@ class RiverraidLeftRightCallable:
         self.time += 1
         for agent in step_info["reward"]:
             if agent.endswith("0"):
-                pos = step_info["info"][agent]["RAM"][0x33] - 0x4C
+                pos = int(step_info["info"][agent]["RAM"][0x33]) - 0x4C
             if self.position_goals[agent]["min"] <= pos and pos <= self.position_goals[agent]["max"]:
                 self.position_cur[agent] += 1
         return {agent: (self.position_cur[agent] / self.time) for agent in self.position_goals}
+
+    def evaluate_episode(self, episode):
+        results = {}
+        for agent in self.position_goals:
+            # __call__() only sets pos for player 0, and others use player 0's, which is in the RAM of every agent.
+            pos = episode["ram"][agent][:, 0x33].astype(np.int64) - 0x4C
+            goals = self.position_goals[agent]
+            results[agent] = int(((goals["min"] <= pos) & (pos <= goals["max"])).sum()) / episode["length"]
+        return results
@@ -75,6 +75,9 @@ crowdplay_environments = {
         # This one defines agents where an AI can take over if needed if a human player disconnects mid-game:
         # This is useful for multiagent MTurk experiments, so that the remaining Turker can keep playing to fulfil their HIT.
         "ai_agent_map_fallback": {},
+        # Optionally, how many instances of this task to keep started ahead of time, so that new players don't have to
+        # wait for the environment and AI policies to load. Defaults to Config.WARM_POOL_SIZE.
+        # "warm_pool_size": 1,
         # A mapping from agent ID strings to human-readable explanation of which player you control.
         # This is shown in the UI. Useful for multiplayer-player games.
         "human_player_map": {"agent_0": "green"},
@@ -250,6 +253,8 @@ crowdplay_environments["demo_si_ai"] = dict(
     task_callables=TIME1MINCALL2P,
     ai_agent_map_fallback={},
     ai_agent_map_always={SECONDPLAYER: "si-comp-1"},
+    # Loading the AI policy takes several seconds.
+    warm_pool_size=1,
 )
 
 # Set a default task.
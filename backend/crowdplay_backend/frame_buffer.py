@@ -0,0 +1,174 @@
+"""
+Shared-memory double buffer for sending the latest step data from an EnvProcess to the web process.
+
+Sending every step through a Pipe means pickling every frame, even though the web process only ever emits the most
+recent one and drops everything else. Instead, EnvProcess writes each step into one of two slots in shared memory:
+numpy arrays (i.e. frames) are copied in raw, and only the small remaining data is pickled. The web process then
+reads the latest complete step whenever it is ready to emit, and never sees any of the steps in between.
+
+Each slot is protected by a sequence counter that is odd while the slot is being written (a seqlock), so the reader
+can detect when it has read a slot that was overwritten in the meantime and simply retry.
+Arrays that appear several times in a step, e.g. the screen that all players of a game see, are only stored once, and
+are read back as one array too, so the web process can encode them once for all players.
+The buffer has to be created before the EnvProcess is started, so that both processes share the same memory.
+"""
+
+import multiprocessing
+import pickle
+from collections import namedtuple
+
+import numpy as np
+
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+# Placeholder for an array stored in the frame area of a slot.
+SharedArray = namedtuple("SharedArray", ["offset", "shape", "dtype"])
+
+# Layout of the control array: [sequence, then for each slot: write counter, frame bytes used, meta bytes]
+_SEQUENCE = 0
+_SLOT_FIELDS = 3
+_ALIGNMENT = 8
+
+
+def _replace_arrays(value, store):
+    """Replaces numpy arrays inside (nested) dicts, lists and tuples by the result of store(array)."""
+    if isinstance(value, np.ndarray):
+        return store(value)
+    if isinstance(value, dict):
+        replaced = type(value)()
+        for key, item in value.items():
+            replaced[key] = _replace_arrays(item, store)
+        return replaced
+    if isinstance(value, (list, tuple)) and not hasattr(value, "_fields"):
+        return type(value)(_replace_arrays(item, store) for item in value)
+    return value
+
+
+def _restore_arrays(value, load):
+    if isinstance(value, SharedArray):
+        return load(value)
+    if isinstance(value, dict):
+        restored = type(value)()
+        for key, item in value.items():
+            restored[key] = _restore_arrays(item, load)
+        return restored
+    if isinstance(value, (list, tuple)) and not hasattr(value, "_fields"):
+        return type(value)(_restore_arrays(item, load) for item in value)
+    return value
+
+
+class SharedFrameBuffer:
+    def __init__(self, slot_bytes):
+        """
+        Args:
+            slot_bytes: Size of each of the two slots. Must fit all frames and the pickled remaining data of one step.
+        """
+        self.slot_bytes = slot_bytes
+        self._control = multiprocessing.RawArray("Q", 1 + 2 * _SLOT_FIELDS)
+        self._data = multiprocessing.RawArray("B", 2 * slot_bytes)
+        self._view = None
+
+    def __getstate__(self):
+        # Only the shared arrays are passed to the child process, views are recreated there.
+        state = self.__dict__.copy()
+        state["_view"] = None
+        return state
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = np.frombuffer(self._data, dtype=np.uint8)
+        return self._view
+
+    @property
+    def sequence(self):
+        """Number of steps written so far. Cheap to check, so readers can poll this."""
+        return self._control[_SEQUENCE]
+
+    def _slot_view(self, slot):
+        return self.view[slot * self.slot_bytes : (slot + 1) * self.slot_bytes]
+
+    def write(self, data):
+        """Writes data into the slot not currently marked as latest, then marks it as latest.
+
+        All numpy arrays in data are copied into the slot as raw bytes, everything else is pickled.
+        Must only be called from a single thread.
+
+        Returns:
+            False if the data didn't fit into a slot and was dropped, True otherwise.
+        """
+        sequence = self._control[_SEQUENCE]
+        slot = (sequence + 1) % 2
+        slot_view = self._slot_view(slot)
+        control = 1 + slot * _SLOT_FIELDS
+        offset = 0
+        # Arrays already stored in this step, by id. data holds on to them, so ids can't be reused while writing.
+        stored = {}
+
+        def store(array):
+            nonlocal offset
+            if id(array) in stored:
+                return stored[id(array)]
+            start = offset
+            # Keep arrays aligned, so that reading them back doesn't need another copy.
+            offset += array.nbytes + (-array.nbytes % _ALIGNMENT)
+            if offset <= self.slot_bytes:
+                slot_view[start : start + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+            stored[id(array)] = SharedArray(start, array.shape, array.dtype.str)
+            return stored[id(array)]
+
+        # Mark slot as being written.
+        self._control[control] += 1
+        meta = pickle.dumps(_replace_arrays(data, store), protocol=pickle.HIGHEST_PROTOCOL)
+        if offset + len(meta) > self.slot_bytes:
+            self._control[control] += 1
+            logger.error(f"Step data of {offset + len(meta)} bytes does not fit into frame buffer, dropping it.")
+            return False
+        slot_view[offset : offset + len(meta)] = np.frombuffer(meta, dtype=np.uint8)
+        self._control[control + 1] = offset
+        self._control[control + 2] = len(meta)
+        # Mark slot as complete, and as the latest one.
+        self._control[control] += 1
+        self._control[_SEQUENCE] = sequence + 1
+        return True
+
+    def read(self, since=None, retries=3):
+        """Returns the latest step data, or None if nothing was written since sequence number since.
+
+        Returns:
+            A tuple (sequence, data). Arrays in data are copies, and safe to keep. Arrays that were the same array when
+            written are the same array here, too.
+        """
+        for _ in range(retries):
+            sequence = self._control[_SEQUENCE]
+            if sequence == 0 or sequence == since:
+                return None
+            slot = sequence % 2
+            control = 1 + slot * _SLOT_FIELDS
+            counter = self._control[control]
+            if counter % 2 == 1:
+                continue
+            slot_view = self._slot_view(slot)
+            frames_nbytes = self._control[control + 1]
+            meta_nbytes = self._control[control + 2]
+            frames = slot_view[:frames_nbytes].copy()
+            meta = slot_view[frames_nbytes : frames_nbytes + meta_nbytes].tobytes()
+            if self._control[control] != counter:
+                # The writer has lapped us and overwritten this slot while we were reading it.
+                continue
+
+            # Arrays that were stored once are restored as one array.
+            loaded = {}
+
+            def load(shared_array):
+                if shared_array not in loaded:
+                    dtype = np.dtype(shared_array.dtype)
+                    nbytes = int(np.prod(shared_array.shape)) * dtype.itemsize
+                    array = frames[shared_array.offset : shared_array.offset + nbytes].view(dtype)
+                    loaded[shared_array] = array.reshape(shared_array.shape)
+                return loaded[shared_array]
+
+            return sequence, _restore_arrays(pickle.loads(meta), load)
+        return None
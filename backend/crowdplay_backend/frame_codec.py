@@ -0,0 +1,148 @@
+"""
+Frame encoders for streaming observations to clients.
+
+PaletteEncoder losslessly maps RGB frames to uint8 indices into a palette. Atari frames only ever use colours from the
+128-colour NTSC palette, so this reduces raw frame size by 3x, without any loss, before any compression. It is used to
+store frames in trajectories (see trajectory_format.encode_columns()), and to stream them to clients that support it.
+
+DeltaFrameEncoder only sends the parts of a frame that changed since the last frame it encoded.
+Atari frames are split into square tiles, and only tiles that differ from the previous frame are encoded, packed
+together into a single image (an "atlas") so that there is only one image encode per frame, however many tiles changed.
+Frames that are identical to the previous one aren't encoded at all. Every keyframe_interval frames, and whenever
+too much of the frame has changed for tiles to be worth it, the whole frame is sent as a keyframe instead.
+
+The client composites the tiles onto the last frame, see frontend/src/models/FrameCompositor.js.
+"""
+
+import numpy as np
+
+from .utils import rgb_array_to_bytes
+
+# Frames are converted to palette indices in batches of this many pixels, to bound temporary memory use.
+PALETTE_BATCH_PIXELS = 1 << 22
+
+
+class PaletteEncoder:
+    """Maps RGB frames to indices into a palette, which grows as new colours are seen (up to 256 colours).
+
+    Colours keep their index once they have been added to the palette, so the same encoder can be used for a whole
+    stream of frames, and all frames it encoded can be decoded with its final palette.
+    """
+
+    def __init__(self):
+        # Colours as 24 bit integers 0xRRGGBB, sorted, and the palette index of each.
+        self._keys = np.zeros(0, dtype=np.uint32)
+        self._indices = np.zeros(0, dtype=np.uint8)
+        self._palette = []
+
+    @property
+    def palette(self):
+        """The palette as a (K, 3) uint8 array."""
+        return np.array(self._palette, dtype=np.uint8).reshape(-1, 3)
+
+    def encode(self, frames):
+        """Returns the palette indices of an array of RGB pixels, of shape (..., 3), as an array of shape (...).
+
+        Raises:
+            ValueError: If frames use more than 256 different colours in total.
+        """
+        pixels = frames.reshape(-1, 3)
+        indices = np.empty(len(pixels), dtype=np.uint8)
+        for start in range(0, len(pixels), PALETTE_BATCH_PIXELS):
+            batch = pixels[start : start + PALETTE_BATCH_PIXELS].astype(np.uint32)
+            keys = (batch[:, 0] << 16) | (batch[:, 1] << 8) | batch[:, 2]
+            positions = np.searchsorted(self._keys, keys)
+            known = positions < len(self._keys)
+            known[known] = self._keys[positions[known]] == keys[known]
+            if not known.all():
+                self._add_colours(np.unique(keys[~known]))
+                positions = np.searchsorted(self._keys, keys)
+            indices[start : start + len(batch)] = self._indices[positions]
+        return indices.reshape(frames.shape[:-1])
+
+    def _add_colours(self, keys):
+        if len(self._palette) + len(keys) > 256:
+            raise ValueError("Frames use more than 256 colours and can't be palette encoded.")
+        new_indices = np.arange(len(self._palette), len(self._palette) + len(keys), dtype=np.uint8)
+        self._palette.extend([(key >> 16) & 255, (key >> 8) & 255, key & 255] for key in keys.tolist())
+        keys = np.concatenate([self._keys, keys])
+        indices = np.concatenate([self._indices, new_indices])
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._indices = indices[order]
+
+
+def palette_decode(indices, palette):
+    """Returns the RGB frames for palette indices, i.e. the inverse of PaletteEncoder.encode()."""
+    return np.asarray(palette, dtype=np.uint8).reshape(-1, 3)[indices]
+
+
+class DeltaFrameEncoder:
+    def __init__(self, tile_size=16, keyframe_interval=120, max_changed_fraction=0.5):
+        """
+        Args:
+            tile_size: Width and height of tiles in pixels. Should be a multiple of 8 (or 16 for JPEG with chroma
+                subsampling) so that tiles align with JPEG blocks and don't bleed into each other.
+            keyframe_interval: Send a full frame at least every this many frames.
+            max_changed_fraction: Send a full frame if more than this fraction of tiles changed.
+        """
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.max_changed_fraction = max_changed_fraction
+        self.previous = None
+        self.frames_since_keyframe = 0
+
+    def request_keyframe(self):
+        """Makes sure the next frame is sent in full, e.g. after a client (re)connected."""
+        self.previous = None
+
+    def _pad(self, frame):
+        # Pad frames to a multiple of the tile size. Clients clip tiles to the frame size when drawing them.
+        height, width = frame.shape[:2]
+        pad_height = -height % self.tile_size
+        pad_width = -width % self.tile_size
+        if pad_height == 0 and pad_width == 0:
+            return frame
+        return np.pad(frame, ((0, pad_height), (0, pad_width), (0, 0)), mode="edge")
+
+    def encode(self, frame, ext=".jpg", quality=None):
+        """Encodes a (H, W, 3) RGB frame, with the given quality for lossy formats.
+
+        Returns:
+            A tuple (image, tiles):
+            - For keyframes, image is the encoded full frame and tiles is None.
+            - For delta frames, image is the encoded atlas of changed tiles, and tiles a flat list
+              [atlas_columns, tile_size, x_0, y_0, x_1, y_1, ...] of the changed tiles' positions (in tiles).
+              Tile i is at column i % atlas_columns and row i // atlas_columns in the atlas.
+            - For frames identical to the previous one, image is None and tiles is an empty list.
+        """
+        previous = self.previous
+        self.previous = frame.copy()
+        self.frames_since_keyframe += 1
+        if previous is None or previous.shape != frame.shape or self.frames_since_keyframe >= self.keyframe_interval:
+            self.frames_since_keyframe = 0
+            return rgb_array_to_bytes(frame, ext, quality), None
+
+        size = self.tile_size
+        padded = self._pad(frame)
+        rows, columns = padded.shape[0] // size, padded.shape[1] // size
+        changed = np.any(frame != previous, axis=2)
+        changed = self._pad(changed[:, :, np.newaxis])[:, :, 0]
+        changed_tiles = changed.reshape(rows, size, columns, size).any(axis=(1, 3))
+        ys, xs = np.nonzero(changed_tiles)
+        if len(ys) == 0:
+            return None, []
+        if len(ys) > self.max_changed_fraction * rows * columns:
+            self.frames_since_keyframe = 0
+            return rgb_array_to_bytes(frame, ext, quality), None
+
+        tiles = padded.reshape(rows, size, columns, size, 3).transpose(0, 2, 1, 3, 4)[ys, xs]
+        # Pack tiles into a roughly square atlas, which compresses better than a long strip.
+        atlas_columns = int(np.ceil(np.sqrt(len(tiles))))
+        atlas_rows = int(np.ceil(len(tiles) / atlas_columns))
+        atlas = np.zeros((atlas_rows * atlas_columns, size, size, 3), dtype=frame.dtype)
+        atlas[: len(tiles)] = tiles
+        atlas = atlas.reshape(atlas_rows, atlas_columns, size, size, 3).transpose(0, 2, 1, 3, 4)
+        atlas = atlas.reshape(atlas_rows * size, atlas_columns * size, 3)
+        positions = np.stack([xs, ys], axis=1).reshape(-1).tolist()
+        return rgb_array_to_bytes(atlas, ext, quality), [atlas_columns, size] + positions
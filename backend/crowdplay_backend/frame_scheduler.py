@@ -0,0 +1,96 @@
+"""
+Frame timing for the episode loop in EnvProcess.
+
+FrameScheduler sleeps until the next frame is due on the monotonic clock, so frame times are not affected by changes
+of the system clock, and keeps a regular 1/fps rhythm without drifting. Frames whose work took longer than a frame
+period are counted as overruns, and reported in the log at most every report_interval seconds, so that overloaded
+hosts are visible without flooding the log. If the loop falls more than a frame behind, it skips ahead instead of
+running a burst of frames to catch up.
+
+In turn-based environments the loop blocks on the action pipe while waiting for players (see EnvProcess.run_episode),
+and calls resync() afterwards, so that time spent waiting for players is neither counted as an overrun nor caught up.
+"""
+
+import time
+
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class FrameScheduler:
+    def __init__(self, fps, name="", report_interval=10.0, tolerance=0.0):
+        """
+        Args:
+            fps: Frames per second. Can be changed at any time by setting fps.
+            name: Name used in overrun reports, e.g. the instance id.
+            report_interval: Log overruns at most every this many seconds.
+            tolerance: Frames started less than this many seconds late are not counted as overruns. Used by EnvWorker,
+                which starts frames when it wakes up, which is always slightly after they are due.
+        """
+        self.fps = fps
+        self.name = name
+        self.report_interval = report_interval
+        self.tolerance = tolerance
+        self.next_frame_time = time.monotonic() + 1 / fps
+        # Overruns since the scheduler was created, and since they were last reported.
+        self.overruns = 0
+        self.frames = 0
+        self.max_lateness = 0.0
+        self._unreported_overruns = 0
+        self._unreported_max_lateness = 0.0
+        self._last_report = time.monotonic()
+
+    def resync(self):
+        """Starts a new frame period now, e.g. after waiting for players' actions."""
+        self.next_frame_time = time.monotonic() + 1 / self.fps
+
+    def time_until_due(self):
+        """Seconds until the next frame is due, negative if it is late."""
+        return self.next_frame_time - time.monotonic()
+
+    def wait(self):
+        """Blocks until the next frame is due.
+
+        Returns:
+            How late the frame is, in seconds, or 0.0 if the previous frame finished in time.
+        """
+        lateness = -self.time_until_due()
+        if lateness < 0:
+            time.sleep(-lateness)
+            lateness = 0.0
+        return self.advance(lateness)
+
+    def advance(self, lateness):
+        """Starts the next frame, lateness seconds after it was due, without waiting. Returns lateness."""
+        now = time.monotonic()
+        period = 1 / self.fps
+        self.frames += 1
+        if lateness > self.tolerance:
+            self._overrun(lateness, now)
+        if lateness > period:
+            # Too far behind to catch up, skip ahead rather than running frames back to back.
+            self.next_frame_time = now + period
+        else:
+            self.next_frame_time += period
+        return lateness
+
+    def _overrun(self, lateness, now):
+        self.overruns += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        self._unreported_overruns += 1
+        self._unreported_max_lateness = max(self._unreported_max_lateness, lateness)
+        if now - self._last_report >= self.report_interval:
+            self.report(now)
+
+    def report(self, now=None):
+        """Logs overruns since the last report, if there were any."""
+        now = time.monotonic() if now is None else now
+        if self._unreported_overruns > 0:
+            logger.warning(
+                f"{self.name}: {self._unreported_overruns} frame overruns in the last {now - self._last_report:.0f}s "
+                f"at {self.fps} FPS, up to {self._unreported_max_lateness * 1000:.1f}ms late."
+            )
+        self._unreported_overruns = 0
+        self._unreported_max_lateness = 0.0
+        self._last_report = now
@@ -6,35 +6,68 @@ from gym import Wrapper, spaces
 from .multiagent_atari import MultiAgentEnvWrapper
 
 
+class FrameMaxer:
+    """Pixel-wise maximum of each frame and the frame before it, computed into preallocated buffers."""
+
+    def __init__(self, shape, dtype):
+        self.previous = np.zeros(shape, dtype=dtype)
+        # Callers may still hold on to the last result while the next one is computed, so alternate between two.
+        self.maxed = [np.zeros(shape, dtype=dtype), np.zeros(shape, dtype=dtype)]
+        self.index = 0
+
+    def max(self, frame):
+        self.index = 1 - self.index
+        maxed = self.maxed[self.index]
+        np.maximum(frame, self.previous, out=maxed)
+        np.copyto(self.previous, frame)
+        return maxed
+
+    def skip(self, frame):
+        """Keeps track of a frame whose maximum another FrameMaxer has computed."""
+        np.copyto(self.previous, frame)
+
+
+def max_frames(frame_maxers, frames):
+    """Returns the maxed frame of each agent. Agents that see the very same frame get the very same maxed frame, which
+    is only computed once."""
+    maxed_frames = {}
+    maxed_by_id = {}
+    for agent, frame in frames.items():
+        if id(frame) in maxed_by_id:
+            frame_maxers[agent].skip(frame)
+        else:
+            maxed_by_id[id(frame)] = frame_maxers[agent].max(frame)
+        maxed_frames[agent] = maxed_by_id[id(frame)]
+    return maxed_frames
+
+
 class MaxFrameAndRAMWrapper(MultiAgentEnvWrapper):
     """This wrapper takes the pixel-wise maximum of every two consecutive frames,
     which improves visual performance for end users.
-    Additionally, it stores the ALE RAM array into the info object for each agent every frame.
+    Additionally, it stores the ALE RAM (as a uint8 array) into the info object for each agent every frame.
     This version assumes that the observation is an image as a numpy array."""
 
     def __init__(self, env):
         MultiAgentEnvWrapper.__init__(self, env)
-        self.previous_frame = {agent: np.zeros(self.env.observation_space[agent].shape) for agent in env.list_of_agents}
+        self.frame_maxers = {
+            agent: FrameMaxer(self.env.observation_space[agent].shape, self.env.observation_space[agent].dtype)
+            for agent in env.list_of_agents
+        }
 
         self.processed_obs = {agent: {} for agent in env.list_of_agents}
 
     def reset(self, **kwargs):
         obs = self.env.reset(**kwargs)
-        for agent in obs:
-            maxed_frame = np.maximum(obs[agent], self.previous_frame[agent])
-            self.previous_frame[agent] = obs[agent]
-            self.processed_obs[agent] = obs[agent].copy()
-            self.processed_obs[agent] = maxed_frame
+        self.processed_obs = max_frames(self.frame_maxers, obs)
         return obs
 
     def step(self, ac):
         obs, reward, done, info = self.env.step(ac)
+        self.processed_obs = max_frames(self.frame_maxers, obs)
+        # One uint8 array shared by all agents. TrajectoryRecorder stores it only once, too.
+        ram = self.unwrapped.ale.getRAM()
         for agent in obs:
-            maxed_frame = np.maximum(obs[agent], self.previous_frame[agent])
-            self.previous_frame[agent] = obs[agent]
-            self.processed_obs[agent] = obs[agent].copy()
-            self.processed_obs[agent] = maxed_frame
-            info[agent]["RAM"] = self.unwrapped.ale.getRAM().tolist()
+            info[agent]["RAM"] = ram
         return obs, reward, done, info
 
     def crowdplay_render(self):
@@ -44,34 +77,39 @@ class MaxFrameAndRAMWrapper(MultiAgentEnvWrapper):
 class MaxFrameAndRAMWrapperMultiagent(MultiAgentEnvWrapper):
     """This wrapper takes the pixel-wise maximum of every two consecutive frames,
     which improves visual performance for end users.
-    Additionally, it stores the ALE RAM array into the info object for each agent every frame.
+    Additionally, it stores the ALE RAM (as a uint8 array) into the info object for each agent every frame.
     This version assumes that the observation is a dictionary. Pixel-wise maxing is done on the 'image' key."""
 
     def __init__(self, env):
         MultiAgentEnvWrapper.__init__(self, env)
-        self.previous_frame = {
-            agent: np.zeros(self.env.observation_space[agent]["image"].shape) for agent in env.list_of_agents
+        self.frame_maxers = {
+            agent: FrameMaxer(
+                self.env.observation_space[agent]["image"].shape, self.env.observation_space[agent]["image"].dtype
+            )
+            for agent in env.list_of_agents
         }
 
-        self.processed_obs = {agent: {} for agent in env.list_of_agents}
+        self.processed_obs = {agent: OrderedDict() for agent in env.list_of_agents}
+
+    def process_obs(self, obs):
+        maxed_frames = max_frames(self.frame_maxers, {agent: obs[agent]["image"] for agent in obs})
+        for agent in obs:
+            # Reuse each agent's dict, only the image changes.
+            self.processed_obs[agent].update(obs[agent])
+            self.processed_obs[agent]["image"] = maxed_frames[agent]
 
     def reset(self, **kwargs):
         obs = self.env.reset(**kwargs)
-        for agent in obs:
-            maxed_frame = np.maximum(obs[agent]["image"], self.previous_frame[agent])
-            self.previous_frame[agent] = obs[agent]["image"]
-            self.processed_obs[agent] = obs[agent].copy()
-            self.processed_obs[agent]["image"] = maxed_frame
+        self.process_obs(obs)
         return obs
 
     def step(self, ac):
         obs, reward, done, info = self.env.step(ac)
+        self.process_obs(obs)
+        # One uint8 array shared by all agents. TrajectoryRecorder stores it only once, too.
+        ram = self.unwrapped.ale.getRAM()
         for agent in obs:
-            maxed_frame = np.maximum(obs[agent]["image"], self.previous_frame[agent])
-            self.previous_frame[agent] = obs[agent]["image"]
-            self.processed_obs[agent] = obs[agent].copy()
-            self.processed_obs[agent]["image"] = maxed_frame
-            info[agent]["RAM"] = self.unwrapped.ale.getRAM().tolist()
+            info[agent]["RAM"] = ram
         return obs, reward, done, info
 
     def crowdplay_render(self):
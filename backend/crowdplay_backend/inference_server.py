@@ -0,0 +1,161 @@
+"""
+Processes that compute the actions of an AI policy for all instances, in batches.
+
+Without them, every EnvProcess loads its own copy of the policies of its task, and computes one action at a time. With
+Config.AI_INFERENCE_SERVERS set, EnvsManager starts one InferenceServer per AI policy instead, which loads the policy
+once. EnvProcesses then use a RemotePolicy, which has the same interface as the policies in ai_policy.py, and sends
+observations to the server's queue. The server takes all requests that are waiting (up to max_batch_size), computes
+their actions in one batch, and sends each action back on the pipe of the RemotePolicy that asked for it. A request
+that arrives while the server is idle is computed right away, as EnvWorkers run their instances one after another and
+would otherwise pay any wait for a batch once per AI agent every frame. Requests that arrive while a batch is being
+computed are waiting for the next one, so batches grow with the load.
+
+Loading a policy takes several seconds, so the server sets its ready event once it is loaded, and each RemotePolicy
+waits for it when it is created, in the EnvProcess's constructor like a policy loaded in the EnvProcess.
+
+Queues can only be shared with a process when it is started, so the servers have to be started before any EnvProcess
+or EnvWorker. Pipes can be sent over a queue though, so each RemotePolicy sends the server its own pipe to respond on.
+"""
+
+import multiprocessing
+import queue
+from uuid import uuid4
+
+from .exceptions import AiPolicyError
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+# How long the server blocks on its queue before checking the exit event.
+WAIT_TIMEOUT = 0.1
+
+# How long a RemotePolicy waits for an action before giving up.
+ACTION_TIMEOUT = 1.0
+
+# How long a RemotePolicy waits for the server to load its policy before giving up.
+READY_TIMEOUT = 60.0
+
+
+def collect_batch(request_queue, first_request, max_batch_size):
+    """Returns first_request and the requests that are already waiting, up to max_batch_size."""
+    batch = [first_request]
+    while len(batch) < max_batch_size:
+        try:
+            batch.append(request_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def compute_actions(policy_id, policy, observations):
+    """Computes actions for a batch of observations. If that fails, actions are computed one at a time, so that one
+    bad observation only fails its own request. Actions that can't be computed are None."""
+    try:
+        return policy.compute_actions(observations)
+    except Exception:
+        logger.exception(f"InferenceServer for AI policy {policy_id} failed on a batch of {len(observations)}.")
+    if len(observations) == 1:
+        return [None]
+    actions = []
+    for obs in observations:
+        try:
+            actions.append(policy.compute_actions([obs])[0])
+        except Exception:
+            logger.exception(f"InferenceServer for AI policy {policy_id} failed on an observation.")
+            actions.append(None)
+    return actions
+
+
+def run_inference_server(policy_id, make_policy, request_queue, ready_event, exit_event, max_batch_size):
+    logger.info(f"InferenceServer for AI policy {policy_id} starting.")
+    policy = make_policy()
+    ready_event.set()
+    logger.info(f"InferenceServer for AI policy {policy_id} ready.")
+    # Pipes to respond on, by client id.
+    clients = {}
+    while not exit_event.is_set():
+        try:
+            first_request = request_queue.get(timeout=WAIT_TIMEOUT)
+        except queue.Empty:
+            continue
+        observations = []
+        waiting = []
+        for message in collect_batch(request_queue, first_request, max_batch_size):
+            kind, client_id = message[0], message[1]
+            if kind == "connect":
+                clients[client_id] = message[2]
+            elif kind == "disconnect":
+                clients.pop(client_id, None)
+            elif kind == "act":
+                waiting.append((client_id, message[2]))
+                observations.append(message[3])
+        if len(observations) == 0:
+            continue
+        actions = compute_actions(policy_id, policy, observations)
+        for (client_id, request_id), action in zip(waiting, actions):
+            if client_id in clients:
+                try:
+                    clients[client_id].send((request_id, action))
+                except OSError:
+                    # The client's process has exited without disconnecting.
+                    del clients[client_id]
+    logger.info(f"InferenceServer for AI policy {policy_id} exiting.")
+
+
+class InferenceServer:
+    """Starts the inference server process of one AI policy."""
+
+    def __init__(self, policy_id, make_policy, max_batch_size):
+        """
+        Args:
+            make_policy: Creates the policy, e.g. a class in ai_policy.registered_ai_policies.
+        """
+        self.policy_id = policy_id
+        self.queue = multiprocessing.Queue()
+        # Set once the policy is loaded.
+        self.ready_event = multiprocessing.Event()
+        self.exit_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=run_inference_server,
+            args=(policy_id, make_policy, self.queue, self.ready_event, self.exit_event, max_batch_size),
+        )
+        self.process.start()
+
+    def close(self):
+        self.exit_event.set()
+        self.process.join()
+
+
+class RemotePolicy:
+    """Computes actions on an InferenceServer, with the same interface as the policies in ai_policy.py."""
+
+    def __init__(self, request_queue, ready_event):
+        """Waits until the server has loaded its policy.
+
+        Args:
+            request_queue, ready_event: The queue and ready event of the InferenceServer.
+        """
+        if not ready_event.wait(READY_TIMEOUT):
+            logger.error(f"InferenceServer not ready within {READY_TIMEOUT} seconds.")
+            raise AiPolicyError()
+        self.request_queue = request_queue
+        self.client_id = uuid4().hex
+        self.request_id = 0
+        self.response_recv, self.response_send = multiprocessing.Pipe(duplex=False)
+        self.request_queue.put(("connect", self.client_id, self.response_send))
+
+    def compute_action(self, obs):
+        self.request_id += 1
+        self.request_queue.put(("act", self.client_id, self.request_id, obs))
+        while self.response_recv.poll(ACTION_TIMEOUT):
+            request_id, action = self.response_recv.recv()
+            # Responses to earlier requests that timed out are dropped.
+            if request_id == self.request_id:
+                if action is None:
+                    raise AiPolicyError()
+                return action
+        logger.error(f"No action from InferenceServer within {ACTION_TIMEOUT} seconds.")
+        raise AiPolicyError()
+
+    def close(self):
+        self.request_queue.put(("disconnect", self.client_id))
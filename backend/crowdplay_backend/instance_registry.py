@@ -0,0 +1,114 @@
+"""
+Indexes of the agents of all running instances, for matching players to instances.
+
+EnvsManager needs to find instances of a task with a free agent for every new player, the instance and agent of a
+socket for every disconnect, and the agents of an assignment for every reconnect. Instead of scanning the agents of all
+EnvRunners each time, InstanceRegistry keeps a copy of each instance's agents (see EnvRunner.agents), and indexes them
+by what they are looked up by. EnvRunners report every change of their agents, so the indexes are always up to date.
+"""
+
+
+def is_open(assign_to):
+    """Whether an agent is free for a new player."""
+    return assign_to[0] is None
+
+
+def agent_sid(assign_to):
+    """Returns the sid an agent is connected as, or None."""
+    return assign_to[1] if len(assign_to) >= 2 else None
+
+
+def agent_assignment_id(assign_to):
+    """Returns the assignment id of a human agent, as a string, or None."""
+    return str(assign_to[2]) if assign_to[0] == 1 and len(assign_to) >= 3 else None
+
+
+class InstanceRegistry:
+    def __init__(self):
+        # Task id and agents of each instance, by instance id.
+        self.task_ids = {}
+        self.agents = {}
+        # Instances with at least one free agent, by task id, in the order they were opened.
+        self.open_instances = {}
+        # (instance_id, agent_key) of agents by sid and by (task_id, assignment_id).
+        self.by_sid = {}
+        self.by_assignment_id = {}
+
+    def add_instance(self, instance_id, task_id, agents):
+        self.task_ids[instance_id] = task_id
+        self.agents[instance_id] = {}
+        for agent_key, assign_to in agents.items():
+            self.agents[instance_id][agent_key] = assign_to
+            self._index_agent(instance_id, agent_key, assign_to)
+        self._update_open(instance_id)
+
+    def remove_instance(self, instance_id):
+        if instance_id not in self.agents:
+            return
+        for agent_key, assign_to in self.agents[instance_id].items():
+            self._unindex_agent(instance_id, agent_key, assign_to)
+        self.open_instances.get(self.task_ids[instance_id], {}).pop(instance_id, None)
+        del self.agents[instance_id]
+        del self.task_ids[instance_id]
+
+    def set_agent(self, instance_id, agent_key, assign_to):
+        """Updates the indexes after an agent of an instance was assigned. Instances that aren't added are ignored."""
+        if instance_id not in self.agents:
+            return
+        self._unindex_agent(instance_id, agent_key, self.agents[instance_id][agent_key])
+        self.agents[instance_id][agent_key] = assign_to
+        self._index_agent(instance_id, agent_key, assign_to)
+        self._update_open(instance_id)
+
+    def open_instance_ids(self, task_id):
+        """Instances of a task with at least one free agent, oldest first."""
+        return list(self.open_instances.get(task_id, {}))
+
+    def agents_to_assign(self, instance_id):
+        return [agent_key for agent_key, assign_to in self.agents[instance_id].items() if is_open(assign_to)]
+
+    def instance_ids_for_sid(self, sid):
+        return list(dict.fromkeys(instance_id for instance_id, _ in self.by_sid.get(sid, {})))
+
+    def agent_for_sid(self, instance_id, sid):
+        for sid_instance_id, agent_key in self.by_sid.get(sid, {}):
+            if sid_instance_id == instance_id:
+                return agent_key
+        return None
+
+    def agents_for_assignment_id(self, task_id, assignment_id):
+        """Human agents of a task's instances that were assigned to assignment_id, as [(instance_id, agent_key)]."""
+        return list(self.by_assignment_id.get((task_id, str(assignment_id)), {}))
+
+    def _index_agent(self, instance_id, agent_key, assign_to):
+        sid = agent_sid(assign_to)
+        if sid is not None:
+            self.by_sid.setdefault(sid, {})[(instance_id, agent_key)] = True
+        assignment_id = agent_assignment_id(assign_to)
+        if assignment_id is not None:
+            key = (self.task_ids[instance_id], assignment_id)
+            self.by_assignment_id.setdefault(key, {})[(instance_id, agent_key)] = True
+
+    def _unindex_agent(self, instance_id, agent_key, assign_to):
+        sid = agent_sid(assign_to)
+        if sid is not None:
+            remove_from_index(self.by_sid, sid, (instance_id, agent_key))
+        assignment_id = agent_assignment_id(assign_to)
+        if assignment_id is not None:
+            key = (self.task_ids[instance_id], assignment_id)
+            remove_from_index(self.by_assignment_id, key, (instance_id, agent_key))
+
+    def _update_open(self, instance_id):
+        open_instances = self.open_instances.setdefault(self.task_ids[instance_id], {})
+        if any(is_open(assign_to) for assign_to in self.agents[instance_id].values()):
+            open_instances.setdefault(instance_id, True)
+        else:
+            open_instances.pop(instance_id, None)
+
+
+def remove_from_index(index, key, value):
+    values = index.get(key)
+    if values is not None:
+        values.pop(value, None)
+        if not values:
+            del index[key]
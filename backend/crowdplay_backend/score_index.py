@@ -0,0 +1,196 @@
+"""
+In-memory index of the scores of all players of each task, for the score comparison shown at the end of a session.
+
+For each (task, callable), ScoreIndex keeps the total value of each player (session) and the value of each single
+game, in sorted lists. They are loaded from the DB on first use, and then updated by EnvRunner at every episode end,
+so rank, percentile and histogram are a few binary searches instead of fetching and sorting all rows of the task on
+every request. Since updates come straight from the episodes, they don't have to wait for the DB writer either.
+Indexes are reloaded from the DB every refresh_seconds, to pick up anything written by other processes.
+"""
+
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import timedelta
+
+import numpy as np
+
+from .config import Config
+
+# Scores of different types can't be compared, so each type is ranked separately. Durations are ranked in minutes.
+NUMBER = "number"
+DURATION = "duration"
+
+
+def score_sort_key(value):
+    """Returns (type, comparable value) of a score, or None for values that can't be ranked."""
+    if isinstance(value, timedelta):
+        return DURATION, value / timedelta(minutes=1)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return NUMBER, value
+    return None
+
+
+class SortedScores:
+    """Scores by key, e.g. (instance id, agent key), which are kept sorted by value."""
+
+    def __init__(self):
+        self.by_key = {}
+        self.sorted = {NUMBER: [], DURATION: []}
+
+    @classmethod
+    def from_values(cls, values):
+        scores = cls()
+        for key, value in enumerate(values):
+            scores.set(key, value)
+        return scores
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def get(self, key, default=None):
+        return self.by_key.get(key, default)
+
+    def set(self, key, value):
+        """Sets the score of key, replacing its previous score if it had one."""
+        previous = score_sort_key(self.by_key.get(key))
+        if previous is not None:
+            values = self.sorted[previous[0]]
+            del values[bisect_left(values, previous[1])]
+        self.by_key[key] = value
+        sort_key = score_sort_key(value)
+        if sort_key is not None:
+            insort(self.sorted[sort_key[0]], sort_key[1])
+
+    def sorted_values(self, score_type):
+        return self.sorted[score_type]
+
+
+class CallableScores:
+    """Total scores by (instance id, agent key), and single game scores by (instance id, game id, agent key)."""
+
+    def __init__(self):
+        self.totals = SortedScores()
+        self.episodes = SortedScores()
+        # Best single game by (instance id, agent key).
+        self.best_episodes = {}
+
+    def set_total(self, instance_id, agent_key, value):
+        self.totals.set((instance_id, agent_key), value)
+
+    def set_episode(self, instance_id, game_id, agent_key, value):
+        self.episodes.set((instance_id, game_id, agent_key), value)
+        sort_key = score_sort_key(value)
+        best_sort_key = score_sort_key(self.best_episodes.get((instance_id, agent_key)))
+        if best_sort_key is None or (sort_key is not None and sort_key > best_sort_key):
+            self.best_episodes[(instance_id, agent_key)] = value
+
+
+class ScoreIndex:
+    def __init__(self, refresh_seconds=600.0):
+        self.refresh_seconds = refresh_seconds
+        # CallableScores and the time they were loaded, by (task_id, callable).
+        self.scores = {}
+        self.loaded_at = {}
+        # Updates since each index was last loaded, which are applied again after reloading, by (task_id, callable).
+        # The DB might not have them yet. Each is kept as (time recorded, value), oldest first, for refresh_seconds.
+        self.recent_totals = {}
+        self.recent_episodes = {}
+
+    def record_episode(self, task_id, callable, instance_id, game_id, agent_key, total, episode, now=None):
+        """Records the total and single game value of a callable for one player at the end of a game."""
+        now = time.monotonic() if now is None else now
+        index_key = (task_id, callable)
+        recent_totals = self.recent_totals.setdefault(index_key, {})
+        recent_episodes = self.recent_episodes.setdefault(index_key, {})
+        self._add_recent(recent_totals, (instance_id, agent_key), total, now)
+        self._add_recent(recent_episodes, (instance_id, game_id, agent_key), episode, now)
+        if index_key in self.scores:
+            self.scores[index_key].set_total(instance_id, agent_key, total)
+            self.scores[index_key].set_episode(instance_id, game_id, agent_key, episode)
+
+    def _add_recent(self, recent, key, value, now):
+        """Adds an update to recent, and drops updates older than refresh_seconds, which the DB has by then."""
+        recent.pop(key, None)
+        recent[key] = (now, value)
+        while now - next(iter(recent.values()))[0] > self.refresh_seconds:
+            del recent[next(iter(recent))]
+
+    def get(self, task_id, callable, load_totals, load_episodes):
+        """Returns the CallableScores of a task's callable, loading them if needed.
+
+        Args:
+            load_totals: Returns [(instance_id, agent_key, value)] of all players of the task from the DB.
+            load_episodes: Returns [(instance_id, game_id, agent_key, value)] of all games of the task from the DB.
+        """
+        index_key = (task_id, callable)
+        now = time.monotonic()
+        if index_key not in self.scores or now - self.loaded_at[index_key] > self.refresh_seconds:
+            # Anything recorded while loading must be applied after loading.
+            recent_totals = self.recent_totals.pop(index_key, {})
+            recent_episodes = self.recent_episodes.pop(index_key, {})
+            scores = CallableScores()
+            for instance_id, agent_key, value in load_totals():
+                scores.set_total(instance_id, agent_key, value)
+            for instance_id, game_id, agent_key, value in load_episodes():
+                scores.set_episode(instance_id, game_id, agent_key, value)
+            for (instance_id, agent_key), (_, value) in recent_totals.items():
+                scores.set_total(instance_id, agent_key, value)
+            for (instance_id, game_id, agent_key), (_, value) in recent_episodes.items():
+                scores.set_episode(instance_id, game_id, agent_key, value)
+            self.scores[index_key] = scores
+            self.loaded_at[index_key] = now
+        return self.scores[index_key]
+
+
+def get_score_stats(metric, this_score, scores, n_bins=10):
+    """Returns the rank, percentile and histogram of this_score among scores (a SortedScores), for the score page.
+
+    this_score counts as one of the scores, even if it isn't in scores yet.
+    """
+    if isinstance(this_score, float):
+        this_score_string = f"{this_score:.2f}"
+    else:
+        this_score_string = str(this_score)
+    score_type, this_score = score_sort_key(this_score)
+    values = scores.sorted_values(score_type)
+    less = bisect_left(values, this_score)
+    not_greater = bisect_right(values, this_score)
+    # Count this_score in, if it isn't in values already.
+    missing = 1 if less == not_greater else 0
+    total_scores = len(values) + missing
+    low = min(values[0], this_score) if values else this_score
+    high = max(values[-1], this_score) if values else this_score
+    # We do one more bin that specified, because we do a half-sized bin on each end
+    bin_size = (high - low) / (n_bins)
+    if bin_size == 0:
+        bin_size = 1
+    # Same bins as np.histogram(values, bins=n_bins + 1, range=...), counted by binary search.
+    edges = np.linspace(low - (bin_size / 2), high + (bin_size / 2), n_bins + 2)
+    starts = [bisect_left(values, edge) for edge in edges[:-1]]
+    counts = [end - start for start, end in zip(starts, starts[1:] + [len(values)])]
+    if missing:
+        counts[min(bisect_right(edges, this_score) - 1, n_bins)] += 1
+    # We put the data into an x-y list, and also add a few additional data points
+    # below and above the actual data for nicer rendering.
+    additional_data_points = n_bins // 5
+    binned_data_processed = (
+        [{"x": float(low + i * bin_size), "y": 0.0} for i in range(-additional_data_points, 0)]
+        + [{"x": float(low + i * bin_size), "y": float(counts[i])} for i in range(len(counts))]
+        + [{"x": float(high + i * bin_size), "y": 0.0} for i in range(1, additional_data_points + 1)]
+    )
+    rank_lower = total_scores - less
+    rank = len(values) - not_greater + 1
+    percentile = 100 if total_scores == 1 else int(100 * (1 - rank_lower / total_scores))
+    return {
+        "metric": metric,
+        "your_score": this_score_string,
+        "your_score_raw": this_score,
+        "your_rank": rank,
+        "out_of": total_scores,
+        "percentile": percentile,
+        "histogram": binned_data_processed,
+    }
+
+
+# The index used by the web process.
+score_index = ScoreIndex(Config.SCORE_INDEX_REFRESH_SECONDS)
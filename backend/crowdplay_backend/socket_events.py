@@ -7,6 +7,7 @@ from .EnvsManager import EnvsManager
 from .exceptions import InstanceNotFound, WrongAction
 from .logger import getLogger
 from .socketio import socketio
+from .utils import negotiate_step_format
 
 logger = getLogger("socket_events")
 
@@ -69,7 +70,12 @@ class EnvNamespace(Namespace):
     def on_error_handler(self, err):
         logger.error("Socket error:", err)
 
-    def on_setup_user(self, instance_id, agent_key, assignment_id=None):
+    def on_setup_user(self, instance_id, agent_key, assignment_id=None, step_format=None):
+        """Registers a user as the agent agent_key in an instance.
+        parameters:
+            - step_format: optional, e.g. {"binary": True, "image_formats": ["webp", "jpeg"]} to request binary step
+                messages. If supported, the chosen format is sent back in a step_format message.
+                With "adaptive": True, the client must send a step_ack for each step it shows."""
         # TODO move some/all of this to EnvsManager similar to user disconnect?
         # 1. This user will be assigned to this specific room
         player_room = f"{instance_id}_{agent_key}"
@@ -88,6 +94,12 @@ class EnvNamespace(Namespace):
             assignment_id = envs_manager.env_runners[instance_id].agents[agent_key][2]
         envs_manager.assign_agent(instance_id, agent_key, (1, request.sid, assignment_id, "not_ready"))
 
+        # 3. Negotiate the step message format. Clients that don't ask for, or get, binary steps get the default format.
+        step_format = negotiate_step_format(step_format)
+        envs_manager.get_runner(instance_id).set_step_format(agent_key, step_format)
+        if step_format is not None:
+            self.emit("step_format", step_format, room=request.sid)
+
     def on_action(self, instance_id, agent_key, step_iter, action):
         """Sends an action to the environment.
         parameters:
@@ -109,6 +121,17 @@ class EnvNamespace(Namespace):
             logger.error("Error:", error)
             self.emit("error", jsonify(error=str(error)), room=player_room)
 
+    def on_step_ack(self, instance_id, agent_key, step_iter):
+        """Acknowledges that a client has shown a step, for clients that negotiated adaptive streaming.
+        parameters:
+            - step_iter: the step_iter of the step that was shown."""
+        envs_manager = EnvsManager.getInstance()
+        try:
+            envs_manager.get_runner(instance_id).ack_step(agent_key, step_iter)
+        except InstanceNotFound:
+            # Acks can arrive after an instance was closed.
+            pass
+
     def on_fps(self, instance_id, fps):
         envs_manager = EnvsManager.getInstance()
         instance_room = f"{instance_id}"
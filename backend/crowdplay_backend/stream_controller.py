@@ -0,0 +1,143 @@
+"""
+Adaptive per-client control of frame rate and image quality for streaming steps.
+
+The web process only ever sends the latest step (see frame_buffer.py), but emitting does not mean the client received
+it: on a slow link frames queue up in the socket, arrive late, and the client shows a slideshow while we keep encoding
+frames it will never display in time. Clients using binary steps with "adaptive" acknowledge each step once they have
+shown it (a step_ack message). StreamController measures how long emits take and how long clients take to acknowledge
+steps, and for each client picks a streaming level: image quality, resolution scale and the fraction of frames sent.
+
+While too many steps are unacknowledged, frames are not encoded or sent at all, so frames that would only queue up
+cost no CPU. When acknowledgements lag, the level is lowered; after a run of timely acknowledgements it is raised again.
+"""
+
+import time
+
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+# Streaming levels from best to cheapest: (image quality, resolution scale, send every n-th frame).
+# Quality is the JPEG/WebP quality, and scale applies to frames in all formats (see EnvRunner.binary_step()).
+LEVELS = [
+    (90, 1.0, 1),
+    (75, 1.0, 1),
+    (60, 1.0, 2),
+    (50, 0.75, 2),
+    (40, 0.5, 3),
+]
+
+
+class StreamController:
+    def __init__(self, target_lag=0.15, max_in_flight=3, upgrade_after=60, downgrade_after=10, ack_timeout=2.0):
+        """
+        Args:
+            target_lag: Lower the level when acknowledgements take longer than this (smoothed, in seconds).
+                Above half of this, the level is never raised.
+            max_in_flight: Don't send frames while this many sent steps are unacknowledged.
+            upgrade_after: Raise the level after this many consecutive timely acknowledgements.
+            downgrade_after: Wait for this many acknowledgements after a level change before lowering it again, so
+                that the effect of the last change is measured first.
+            ack_timeout: Consider steps lost if they haven't been acknowledged after this many seconds.
+        """
+        self.target_lag = target_lag
+        self.max_in_flight = max_in_flight
+        self.upgrade_after = upgrade_after
+        self.downgrade_after = downgrade_after
+        self.ack_timeout = ack_timeout
+        self.level = 0
+        # Smoothed emit latency and acknowledgement lag, in seconds.
+        self.emit_latency = 0.0
+        self.ack_lag = 0.0
+        # Send time of each unacknowledged step, by step_iter.
+        self.in_flight = {}
+        self.frames = 0
+        self.sent = 0
+        self.skipped = 0
+        self.lost = 0
+        self.level_changes = 0
+        self._timely_acks = 0
+        self._acks_since_change = 0
+
+    @property
+    def quality(self):
+        return LEVELS[self.level][0]
+
+    @property
+    def scale(self):
+        return LEVELS[self.level][1]
+
+    @property
+    def frame_skip(self):
+        return LEVELS[self.level][2]
+
+    def should_send(self, now=None):
+        """Returns whether the next frame should be sent at all. Called once for each frame available to send."""
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        expired = [step_iter for step_iter, sent in self.in_flight.items() if now - sent > self.ack_timeout]
+        for step_iter in expired:
+            del self.in_flight[step_iter]
+        if expired:
+            # Acknowledgements that never came mean the client can't keep up at all.
+            self.lost += len(expired)
+            self._change_level(self.level + 1, "acknowledgements lost")
+        if len(self.in_flight) >= self.max_in_flight or self.frames % self.frame_skip != 0:
+            self.skipped += 1
+            return False
+        return True
+
+    def on_sent(self, step_iter, emit_seconds, now=None):
+        """Records that the step step_iter was sent, and how long encoding and emitting it took."""
+        self.in_flight[step_iter] = time.monotonic() if now is None else now
+        self.emit_latency += 0.2 * (emit_seconds - self.emit_latency)
+        self.sent += 1
+
+    def on_ack(self, step_iter, now=None):
+        """Records that the client has shown the step step_iter, and adapts the level."""
+        now = time.monotonic() if now is None else now
+        if step_iter not in self.in_flight:
+            return
+        self.ack_lag += 0.2 * (now - self.in_flight[step_iter] - self.ack_lag)
+        # Clients only show the latest step, so older steps still in flight are not coming back.
+        for sent_step_iter in [s for s in self.in_flight if s <= step_iter]:
+            del self.in_flight[sent_step_iter]
+        self._acks_since_change += 1
+        if self.ack_lag > self.target_lag:
+            self._timely_acks = 0
+            if self._acks_since_change >= self.downgrade_after:
+                self._change_level(self.level + 1, f"acknowledgement lag {self.ack_lag * 1000:.0f}ms")
+        elif self.ack_lag < self.target_lag / 2:
+            self._timely_acks += 1
+            if self._timely_acks >= self.upgrade_after:
+                self._change_level(self.level - 1, f"acknowledgement lag {self.ack_lag * 1000:.0f}ms")
+
+    def _change_level(self, level, reason):
+        level = min(max(level, 0), len(LEVELS) - 1)
+        self._timely_acks = 0
+        self._acks_since_change = 0
+        if level != self.level:
+            logger.info(f"Streaming level {self.level} -> {level} ({reason}).")
+            self.level = level
+            self.level_changes += 1
+
+    def reset(self):
+        """Forgets steps in flight, e.g. at the end of an episode when step_iter starts over."""
+        self.in_flight = {}
+
+    def metrics(self):
+        """Returns the current decisions and measurements as a JSON-serialisable dict."""
+        return {
+            "level": self.level,
+            "quality": self.quality,
+            "scale": self.scale,
+            "frame_skip": self.frame_skip,
+            "emit_latency_ms": round(self.emit_latency * 1000, 1),
+            "ack_lag_ms": round(self.ack_lag * 1000, 1),
+            "in_flight": len(self.in_flight),
+            "frames": self.frames,
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "lost": self.lost,
+            "level_changes": self.level_changes,
+        }
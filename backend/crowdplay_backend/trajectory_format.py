@@ -0,0 +1,301 @@
+"""
+Columnar storage format for episode trajectories.
+
+A trajectory (a list of per-step dicts, as built in EnvProcess.run_episode) is flattened into one column per leaf
+of the nested step dict, e.g. "prev_obs/game_0>player_0/image" or "reward/game_0>player_0".
+Numeric leaves that are present in every step are stored as a single contiguous numpy array with the step index as
+the first axis (so all frames of one agent are one (T, 210, 160, 3) uint8 block, and RAM one (T, 128) block).
+Everything else (e.g. timedelta callable values, or info keys that are only present in some steps) is stored as a
+pickled object column, dense (list) or sparse ({step_index: value}).
+
+Layout of an encoded trajectory:
+    MAGIC (8 bytes) | header length (uint64, little endian) | JSON header | padding | column data ...
+Column data blocks are aligned to ALIGNMENT bytes, and offsets in the header are relative to the start of the data
+section. Columns stored with codec "raw" can be memory-mapped and sliced directly without decoding anything else.
+RGB frame columns can optionally be stored palette-indexed (version 2): the column then holds one uint8 palette index
+per pixel, and its header entry the palette as a list of [r, g, b] colours. This is lossless, and a third of the size.
+Columns can have aliases (version 3): leaves that hold the same values as another column in every step, e.g. the RAM in
+the info of each agent, are stored once, and listed in the header as {"name", "path", "target"} of that column.
+The reader for this format lives in crowdplay_datasets.columnar.
+"""
+
+import json
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+from .frame_codec import PaletteEncoder, palette_decode
+
+MAGIC = b"CPTRAJ01"
+FORMAT_VERSION = 3
+ALIGNMENT = 64
+CODECS = ("raw", "zlib")
+
+# How leaves are turned back into Python values when reconstructing step dicts.
+KIND_SCALAR = "scalar"
+KIND_LIST = "list"
+KIND_NDARRAY = "ndarray"
+
+
+def is_columnar(data):
+    """Checks if a bytes-like object is an encoded columnar trajectory."""
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def column_name(path):
+    return "/".join(str(p) for p in path)
+
+
+def flatten_step(step, prefix=()):
+    """Yields (path, value) pairs for all leaves of a nested step dict. Empty dicts are leaves too."""
+    for key, value in step.items():
+        path = prefix + (key,)
+        if isinstance(value, dict) and len(value) > 0:
+            yield from flatten_step(value, path)
+        else:
+            yield path, value
+
+
+def leaf_kind(value):
+    """Returns the kind of a leaf if it can be stored in a dense numeric column, or None otherwise."""
+    if isinstance(value, (bool, int, float, np.bool_, np.number)):
+        return KIND_SCALAR
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+        return KIND_NDARRAY
+    if isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(v, (int, float)) for v in value):
+        return KIND_LIST
+    return None
+
+
+def compact_dtype(array):
+    """Returns the smallest integer dtype that can hold all values of an integer array, or the array's own dtype."""
+    # Byte arrays, e.g. frames, can't get any smaller, so don't scan them.
+    if array.dtype.kind not in "iu" or array.dtype.itemsize == 1 or array.size == 0:
+        return array.dtype
+    low, high = int(array.min()), int(array.max())
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def trajectory_to_columns(trajectory):
+    """Converts a list of step dicts into dense numpy columns and pickleable object columns.
+
+    Returns:
+        A dict with keys "length", "columns", "objects" and "aliases". "columns" maps column names to
+        {"path", "kind", "array"}, "objects" maps column names to {"path", "values", "sparse"}, and "aliases" maps
+        column names to {"path", "target"}, where target is the name of the column holding their values.
+    """
+    length = len(trajectory)
+    leaves = {}
+    for i, step in enumerate(trajectory):
+        for path, value in flatten_step(step):
+            if path not in leaves:
+                leaves[path] = {}
+            leaves[path][i] = value
+
+    columns = {}
+    objects = {}
+    for path, values in leaves.items():
+        name = column_name(path)
+        kinds = set(leaf_kind(v) for v in values.values())
+        if len(values) == length and len(kinds) == 1 and None not in kinds:
+            kind = kinds.pop()
+            try:
+                array = np.stack([np.asarray(values[i]) for i in range(length)])
+            except ValueError:
+                # Shapes differ between steps, fall back to object storage.
+                array = None
+            if array is not None:
+                columns[name] = {"path": list(path), "kind": kind, "array": array.astype(compact_dtype(array))}
+                continue
+        if len(values) == length:
+            objects[name] = {"path": list(path), "values": [values[i] for i in range(length)], "sparse": False}
+        else:
+            objects[name] = {"path": list(path), "values": values, "sparse": True}
+
+    return {"length": length, "columns": columns, "objects": objects, "aliases": {}}
+
+
+def _compress(data, codec):
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.compress(data, 1)
+    raise ValueError(f"Unknown trajectory codec {codec}")
+
+
+def _decompress(data, codec):
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown trajectory codec {codec}")
+
+
+def _padding(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+def is_rgb_column(array):
+    """Checks if a column holds RGB frames, i.e. is a uint8 column of shape (T, ..., 3)."""
+    return array.dtype == np.uint8 and array.ndim >= 3 and array.shape[-1] == 3
+
+
+def encode_columns(columns, codec="zlib", meta=None, palette=False):
+    """Encodes the output of trajectory_to_columns() into bytes.
+
+    Args:
+        columns: Dict as returned by trajectory_to_columns().
+        codec: "raw" for uncompressed, memory-mappable columns, or "zlib" for per-column compression.
+        meta: Optional JSON-serialisable dict stored in the header.
+        palette: Store RGB frame columns as palette indices. Columns with more than 256 colours are stored as-is.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown trajectory codec {codec}")
+    header = {
+        "version": FORMAT_VERSION,
+        "length": columns["length"],
+        "meta": meta or {},
+        "columns": [],
+        "objects": [],
+        "aliases": [
+            {"name": name, "path": alias["path"], "target": alias["target"]}
+            for name, alias in columns.get("aliases", {}).items()
+        ],
+    }
+    blocks = []
+    offset = 0
+
+    def add_block(data):
+        nonlocal offset
+        block_offset = offset
+        blocks.append(data)
+        blocks.append(b"\0" * _padding(len(data)))
+        offset += len(data) + _padding(len(data))
+        return block_offset
+
+    for name, column in columns["columns"].items():
+        array = np.ascontiguousarray(column["array"])
+        entry = {
+            "name": name,
+            "path": column["path"],
+            "kind": column["kind"],
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "codec": codec,
+        }
+        if palette and is_rgb_column(array):
+            encoder = PaletteEncoder()
+            try:
+                array = encoder.encode(array)
+                entry["palette"] = encoder.palette.tolist()
+            except ValueError:
+                pass
+        data = _compress(array.tobytes(), codec)
+        entry["offset"] = add_block(data)
+        entry["nbytes"] = len(data)
+        header["columns"].append(entry)
+    for name, column in columns["objects"].items():
+        # Object columns are always compressed unless raw was requested; they are never memory-mapped anyway.
+        data = _compress(pickle.dumps(column["values"], protocol=pickle.HIGHEST_PROTOCOL), codec)
+        header["objects"].append(
+            {
+                "name": name,
+                "path": column["path"],
+                "sparse": column["sparse"],
+                "codec": codec,
+                "offset": add_block(data),
+                "nbytes": len(data),
+            }
+        )
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix = MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes
+    prefix += b"\0" * _padding(len(prefix))
+    return b"".join([prefix] + blocks)
+
+
+def encode_trajectory(trajectory, codec="zlib", meta=None, palette=False):
+    """Encodes a list of step dicts into the columnar format."""
+    return encode_columns(trajectory_to_columns(trajectory), codec=codec, meta=meta, palette=palette)
+
+
+def decode_header(data):
+    """Returns the header dict and the offset of the data section of an encoded trajectory."""
+    if not is_columnar(data):
+        raise ValueError("Not a columnar trajectory.")
+    (header_length,) = struct.unpack("<Q", bytes(data[len(MAGIC) : len(MAGIC) + 8]))
+    header_end = len(MAGIC) + 8 + header_length
+    header = json.loads(bytes(data[len(MAGIC) + 8 : header_end]).decode("utf-8"))
+    # Newer versions may store data this version would silently drop, e.g. aliases before version 3.
+    if header["version"] > FORMAT_VERSION:
+        raise ValueError(
+            f"Trajectory format version {header['version']} is newer than the supported version {FORMAT_VERSION}."
+        )
+    return header, header_end + _padding(header_end)
+
+
+def decode_columns(data):
+    """Decodes an encoded trajectory back into the structure returned by trajectory_to_columns()."""
+    header, data_offset = decode_header(data)
+    columns = {}
+    objects = {}
+    for column in header["columns"]:
+        start = data_offset + column["offset"]
+        raw = _decompress(bytes(data[start : start + column["nbytes"]]), column["codec"])
+        if "palette" in column:
+            indices = np.frombuffer(raw, dtype=np.uint8).reshape(column["shape"][:-1])
+            array = palette_decode(indices, column["palette"])
+        else:
+            array = np.frombuffer(raw, dtype=np.dtype(column["dtype"])).reshape(column["shape"])
+        columns[column["name"]] = {"path": column["path"], "kind": column["kind"], "array": array}
+    for column in header["objects"]:
+        start = data_offset + column["offset"]
+        raw = _decompress(bytes(data[start : start + column["nbytes"]]), column["codec"])
+        objects[column["name"]] = {"path": column["path"], "values": pickle.loads(raw), "sparse": column["sparse"]}
+    aliases = {alias["name"]: {"path": alias["path"], "target": alias["target"]} for alias in header.get("aliases", [])}
+    return {"length": header["length"], "columns": columns, "objects": objects, "aliases": aliases}
+
+
+def columns_to_trajectory(columns):
+    """Reconstructs the list of step dicts from the structure returned by trajectory_to_columns()."""
+    trajectory = [{} for _ in range(columns["length"])]
+
+    def set_leaf(step, path, value):
+        for key in path[:-1]:
+            step = step.setdefault(key, {})
+        step[path[-1]] = value
+
+    def set_column(path, column):
+        array = column["array"]
+        for i, step in enumerate(trajectory):
+            if column["kind"] == KIND_SCALAR:
+                value = array[i].item()
+            elif column["kind"] == KIND_LIST:
+                value = array[i].tolist()
+            else:
+                value = array[i]
+            set_leaf(step, path, value)
+
+    for column in columns["columns"].values():
+        set_column(column["path"], column)
+    for alias in columns.get("aliases", {}).values():
+        set_column(alias["path"], columns["columns"][alias["target"]])
+    for column in columns["objects"].values():
+        if column["sparse"]:
+            for i, value in column["values"].items():
+                set_leaf(trajectory[i], column["path"], value)
+        else:
+            for i, step in enumerate(trajectory):
+                set_leaf(step, column["path"], column["values"][i])
+    return trajectory
+
+
+def decode_trajectory(data):
+    """Decodes an encoded trajectory back into a list of step dicts."""
+    return columns_to_trajectory(decode_columns(data))
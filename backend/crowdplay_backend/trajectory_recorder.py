@@ -0,0 +1,174 @@
+"""
+Records episode trajectories into preallocated numpy buffers, instead of deep-copying every step dict.
+
+Every numeric leaf of the step dict (frames, actions, rewards, RAM, ...) is written into its own buffer with the step
+index as the first axis, so recording a step costs one array copy per leaf and creates no Python objects that have to
+be garbage collected later. Buffers start small and grow by doubling, so that an instance only holds as much memory as
+its current chunk needs. to_columns() hands the buffers out without copying them, and reset() lets go of them.
+Leaves that are not numeric, or that change shape or disappear between steps, are kept as (sparse) object columns.
+Array leaves that are the very same array object as an earlier leaf of the step, e.g. the ALE RAM that
+MaxFrameAndRAMWrapper puts into the info of every agent, are only recorded once, and stored as aliases of that column.
+The output of TrajectoryRecorder.to_columns() has the same structure as trajectory_format.trajectory_to_columns().
+"""
+
+import copy
+
+import numpy as np
+
+from .trajectory_format import KIND_LIST, KIND_NDARRAY, KIND_SCALAR, column_name, compact_dtype, flatten_step, leaf_kind
+
+
+class _DenseColumn:
+    """A growable buffer holding one numeric leaf of the step dict for every recorded step."""
+
+    def __init__(self, path, kind, value, capacity):
+        value = np.asarray(value)
+        self.path = path
+        self.kind = kind
+        self.shape = value.shape
+        self.buffer = np.empty((capacity,) + value.shape, dtype=value.dtype)
+
+    def fits(self, kind, value):
+        if kind != self.kind:
+            return False
+        return kind == KIND_SCALAR or np.shape(value) == self.shape
+
+    def write(self, index, value):
+        if index >= len(self.buffer):
+            self._resize(max(2 * len(self.buffer), index + 1), self.buffer.dtype)
+        # E.g. a reward or position that was an int so far turns out to be a float. Widen the buffer rather than
+        # truncate.
+        dtype = np.result_type(self.buffer.dtype, value if self.kind == KIND_SCALAR else np.asarray(value).dtype)
+        if dtype != self.buffer.dtype:
+            self._resize(len(self.buffer), dtype)
+        self.buffer[index] = value
+
+    def copy(self, path, length):
+        """Returns a new column for path, holding the first length values of this one."""
+        column = _DenseColumn(path, self.kind, self.buffer[0], len(self.buffer))
+        column.buffer[:length] = self.buffer[:length]
+        return column
+
+    def _resize(self, capacity, dtype):
+        buffer = np.empty((capacity,) + self.shape, dtype=dtype)
+        n = min(capacity, len(self.buffer))
+        buffer[:n] = self.buffer[:n]
+        self.buffer = buffer
+
+    def values(self, length):
+        """Returns the first length values as Python objects, as they were originally recorded."""
+        if self.kind == KIND_SCALAR:
+            return [v.item() for v in self.buffer[:length]]
+        if self.kind == KIND_LIST:
+            return [v.tolist() for v in self.buffer[:length]]
+        return [v.copy() for v in self.buffer[:length]]
+
+
+class TrajectoryRecorder:
+    def __init__(self, capacity=64):
+        """
+        Args:
+            capacity: Number of steps to preallocate buffers for. Buffers grow beyond this if needed.
+        """
+        self.capacity = capacity
+        self.length = 0
+        self._dense = {}
+        self._objects = {}
+        # Target path of array leaves that are the same array as another leaf in every step, by path.
+        self._aliases = {}
+
+    def __len__(self):
+        return self.length
+
+    def record(self, step):
+        """Records a single step dict. Nothing in step is referenced afterwards, so it is safe to mutate it later."""
+        index = self.length
+        seen = set()
+        # Paths of the arrays written to dense columns in this step, by id.
+        arrays = {}
+        for path, value in flatten_step(step):
+            seen.add(path)
+            if path in self._aliases:
+                if arrays.get(id(value)) == self._aliases[path]:
+                    continue
+                self._unalias(path)
+            column = self._dense.get(path)
+            if column is not None:
+                kind = leaf_kind(value)
+                if column.fits(kind, value):
+                    column.write(index, value)
+                    if kind == KIND_NDARRAY:
+                        arrays[id(value)] = path
+                    continue
+                self._demote(path)
+            elif path not in self._objects:
+                kind = leaf_kind(value)
+                if index == 0 and kind == KIND_NDARRAY and id(value) in arrays:
+                    self._aliases[path] = arrays[id(value)]
+                    continue
+                if index == 0 and kind is not None:
+                    self._dense[path] = _DenseColumn(path, kind, value, self.capacity)
+                    self._dense[path].write(index, value)
+                    if kind == KIND_NDARRAY:
+                        arrays[id(value)] = path
+                    continue
+                # Leaves that first appear mid-episode are stored as sparse object columns.
+                self._objects[path] = {}
+            if isinstance(value, (list, dict, set, np.ndarray)):
+                value = copy.copy(value)
+            self._objects[path][index] = value
+        if len(seen) != len(self._dense) + len(self._objects) + len(self._aliases):
+            # Dense columns need a value in every step, otherwise they are demoted to sparse object columns.
+            for path in [path for path in self._aliases if path not in seen]:
+                self._unalias(path)
+            for path in [path for path in self._dense if path not in seen]:
+                self._demote(path)
+        self.length += 1
+
+    def _unalias(self, path):
+        """Turns an alias into a column of its own, e.g. once its array is no longer the same as the target's."""
+        target = self._aliases.pop(path)
+        self._dense[path] = self._dense[target].copy(path, self.length)
+
+    def _demote(self, path):
+        for alias in [alias for alias, target in self._aliases.items() if target == path]:
+            self._unalias(alias)
+        column = self._dense.pop(path)
+        self._objects[path] = dict(enumerate(column.values(self.length)))
+
+    def to_columns(self):
+        """Returns all recorded steps, in the structure returned by trajectory_format.trajectory_to_columns().
+
+        The returned arrays are views of the recorder's buffers, which are never written to again at the indices they
+        cover. Call reset() to hand them off for good, the recorder then records into new buffers.
+        """
+        columns = {}
+        for path, column in self._dense.items():
+            array = column.buffer[: self.length]
+            columns[column_name(path)] = {
+                "path": list(path),
+                "kind": column.kind,
+                "array": array.astype(compact_dtype(array), copy=False),
+            }
+        objects = {}
+        for path, values in self._objects.items():
+            if len(values) == self.length:
+                objects[column_name(path)] = {
+                    "path": list(path),
+                    "values": [values[i] for i in range(self.length)],
+                    "sparse": False,
+                }
+            else:
+                objects[column_name(path)] = {"path": list(path), "values": dict(values), "sparse": True}
+        aliases = {
+            column_name(path): {"path": list(path), "target": column_name(target)}
+            for path, target in self._aliases.items()
+        }
+        return {"length": self.length, "columns": columns, "objects": objects, "aliases": aliases}
+
+    def reset(self):
+        """Forgets all recorded steps, and lets go of the buffers. The next steps are recorded into new buffers."""
+        self._dense = {}
+        self._objects = {}
+        self._aliases = {}
+        self.length = 0
@@ -2,7 +2,7 @@ import pickle
 from base64 import b64encode
 
 import cv2
-from numpy import ndarray
+from numpy import generic, ndarray
 
 from .config import Config
 
@@ -57,8 +57,47 @@ def space_to_dict(space, in_depth=False):
     return space_dict
 
 
-def rgb_array_to_bytes(rgb_array, ext=".jpg"):
-    _, buffer = cv2.imencode(ext, rgb_array[:, :, [2, 1, 0]])
+class EnvSpaces:
+    """Observation and action spaces and agents of an environment, which are the same for all instances of a task.
+    Spaces are serialised (see space_to_dict()) only once, the returned dicts are shared and must not be modified."""
+
+    def __init__(self, observation_space, action_space, list_of_agents):
+        self.observation_space = observation_space
+        self.action_space = action_space
+        self.list_of_agents = list(list_of_agents)
+        # Serialised spaces by (kind, agent_key, in_depth).
+        self.space_dicts = {}
+
+    @classmethod
+    def from_env(cls, env):
+        return cls(env.observation_space, env.action_space, env.list_of_agents)
+
+    def space_dict(self, kind, agent_key=None, in_depth=False):
+        """Returns the serialised "observation_space" or "action_space" of agent_key, or of all agents if None."""
+        key = (kind, agent_key, bool(in_depth))
+        if key not in self.space_dicts:
+            space = getattr(self, kind)
+            if agent_key is not None:
+                space = space[agent_key]
+            self.space_dicts[key] = space_to_dict(space, in_depth)
+        return self.space_dicts[key]
+
+
+# Image formats clients can negotiate for binary step messages: format -> OpenCV file extension.
+IMAGE_FORMATS = {"jpeg": ".jpg", "webp": ".webp", "png": ".png"}
+# Lossless palette-indexed frames, see frame_codec.PaletteEncoder. Not an image file format, so not in IMAGE_FORMATS.
+PALETTE_FORMAT = "palette"
+
+
+# OpenCV encoder parameters for the quality of lossy image formats, by file extension.
+IMAGE_QUALITY_PARAMS = {".jpg": cv2.IMWRITE_JPEG_QUALITY, ".webp": cv2.IMWRITE_WEBP_QUALITY}
+
+
+def rgb_array_to_bytes(rgb_array, ext=".jpg", quality=None):
+    params = []
+    if quality is not None and ext in IMAGE_QUALITY_PARAMS:
+        params = [IMAGE_QUALITY_PARAMS[ext], int(quality)]
+    _, buffer = cv2.imencode(ext, rgb_array[:, :, [2, 1, 0]], params)
     return buffer.tobytes()
 
 
@@ -68,6 +107,27 @@ def rgb_array_to_image_data(rgb_array, encoding="utf-8"):
     return "data:image/jpeg;base64," + b64_frame
 
 
+def scale_image(image, scale, interpolation=cv2.INTER_AREA):
+    """Returns the image resized by scale, or the image itself if scale is 1."""
+    if scale == 1.0:
+        return image
+    size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def encode_image_once(image, key, encode, encoded=None):
+    """Returns encode(image), encoding each image only once per key while the same encoded dict is passed in.
+
+    Images are told apart by identity, so the arrays must be kept alive as long as encoded is used. Observations that
+    all players of a game share are the same array, see SharedFrameBuffer.read().
+    """
+    if encoded is None:
+        return encode(image)
+    if (id(image), key) not in encoded:
+        encoded[(id(image), key)] = encode(image)
+    return encoded[(id(image), key)]
+
+
 def updatable_model(ClassModel):
     def update(self, **kwargs):
         for key, value in kwargs.items():
@@ -78,13 +138,20 @@ def updatable_model(ClassModel):
     return ClassModel
 
 
-def observation_to_serializable(obs, image_to="base64"):
+def observation_to_serializable(obs, image_to="base64", encoded=None):
+    """Returns a JSON serializable version of an observation.
+
+    Args:
+        encoded: Optional dict to share base64 images between calls, see encode_image_once().
+    """
 
     # TODO: might not be the best way to check this
     if type(obs) == dict:
         # Multiagent dictionary: { agent_key: Space },
         # in that case we turn it into a serializable dictionary:
-        return {agent_key: observation_to_serializable(agent_obs, image_to) for agent_key, agent_obs in obs.items()}
+        return {
+            agent_key: observation_to_serializable(agent_obs, image_to, encoded) for agent_key, agent_obs in obs.items()
+        }
 
     space_type = obs.__class__.__name__
 
@@ -95,7 +162,7 @@ def observation_to_serializable(obs, image_to="base64"):
     # TODO
     if isinstance(obs, ndarray) and len(obs.shape) == 3 and obs.shape[-1] == 3:
         if image_to == "base64":
-            return rgb_array_to_image_data(obs)
+            return encode_image_once(obs, "base64", rgb_array_to_image_data, encoded)
         elif image_to == "pickle":
             return pickle.dumps(obs)
         else:
@@ -109,20 +176,80 @@ def observation_to_serializable(obs, image_to="base64"):
             # TODO: this possibly depends on the game, Space Invaders?
             if isinstance(key, str) and key.startswith("image"):
                 if image_to == "base64":
-                    serializable_obs["image"] = rgb_array_to_image_data(value)
+                    serializable_obs["image"] = encode_image_once(value, "base64", rgb_array_to_image_data, encoded)
                 elif image_to == "pickle":
                     serializable_obs["image"] = pickle.dumps(value)
                 else:
                     serializable_obs["image"] = value.tolist()
             else:
-                serializable_obs[key] = value
+                serializable_obs[key] = observation_to_serializable(value, image_to, encoded)
 
         return serializable_obs
 
+    # Other arrays and numpy scalars, e.g. RAM or lives in dict observations.
+    if isinstance(obs, ndarray):
+        return obs.tolist()
+    if isinstance(obs, generic):
+        return obs.item()
+
     # Fallback: just return the plain observation
     return obs
 
 
+def is_image(obs):
+    return isinstance(obs, ndarray) and len(obs.shape) == 3 and obs.shape[-1] == 3
+
+
+def split_observation_image(obs):
+    """Splits a single agent's observation into its image, and the rest of the observation.
+
+    Returns:
+        A tuple (image, image_key, rest). image is the RGB image array, or None if the observation has no image.
+        image_key is the key of the image in a dict observation, or "" if the observation is the image itself.
+        rest is the rest of the observation, serialized as in observation_to_serializable().
+    """
+    if is_image(obs):
+        return obs, "", None
+    if isinstance(obs, dict):
+        for key, value in obs.items():
+            # TODO: this possibly depends on the game, Space Invaders?
+            if isinstance(key, str) and key.startswith("image"):
+                return value, key, observation_to_serializable({k: v for k, v in obs.items() if k != key})
+    return None, None, observation_to_serializable(obs)
+
+
+def observation_to_binary(obs, image_format="jpeg", quality=None, scale=1.0, encoded=None):
+    """Same as split_observation_image(), but returns the image encoded as bytes in the given format.
+    quality sets the quality of lossy formats, and scale < 1 downscales the image before encoding it.
+    encoded is an optional dict to share encoded images between calls, see encode_image_once()."""
+
+    def encode(image):
+        return rgb_array_to_bytes(scale_image(image, scale), IMAGE_FORMATS[image_format], quality)
+
+    image, image_key, rest = split_observation_image(obs)
+    if image is not None:
+        image = encode_image_once(image, (image_format, quality, scale), encode, encoded)
+    return image, image_key, rest
+
+
+def negotiate_step_format(requested):
+    """Returns the step format to use for a client, given the options it requested,
+    or None if the client should be sent the default (JSON with base64 images) step messages."""
+    if not requested or not requested.get("binary"):
+        return None
+    # Adaptive streaming (see stream_controller.py) needs clients to acknowledge steps, so it is opt-in.
+    adaptive = bool(requested.get("adaptive", False))
+    for image_format in requested.get("image_formats", ["jpeg"]):
+        if image_format == PALETTE_FORMAT:
+            # Palette frames are small enough on their own, and are not combined with delta frames.
+            return {"binary": True, "image_format": image_format, "delta": False, "adaptive": adaptive}
+        if image_format in IMAGE_FORMATS:
+            # Delta frames (see frame_codec.DeltaFrameEncoder) need a client side compositor, so they are opt-in.
+            delta = bool(requested.get("delta", False))
+            return {"binary": True, "image_format": image_format, "delta": delta, "adaptive": adaptive}
+    return None
+
+
 # This logic will be used more than once, hence the extraction
 # TODO this is used to set up a new player, essentially?
 def make_or_get_env_to_dict(envs_manager, env_id, hit_id=None, task_id="default", worker_id=None, assignment_id=None):
@@ -131,14 +258,13 @@ def make_or_get_env_to_dict(envs_manager, env_id, hit_id=None, task_id="default"
     )
     # agent_key = envs_manager.get_next_agent_key(instance_id)
 
-    action_space = envs_manager.action_space_for(instance_id)
-    observation_space = envs_manager.observation_space_for(instance_id)
+    spaces = envs_manager.spaces_for(instance_id)
 
     return {
         "id": env_id,
         "instance_id": instance_id,
-        "action_space": space_to_dict(action_space[agent_key], in_depth=False),
-        "observation_space": space_to_dict(observation_space[agent_key], in_depth=False),
+        "action_space": spaces.space_dict("action_space", agent_key),
+        "observation_space": spaces.space_dict("observation_space", agent_key),
         "agent_key": agent_key,
     }
 
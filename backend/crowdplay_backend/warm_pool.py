@@ -0,0 +1,85 @@
+"""
+Instances started ahead of time, so that new players don't have to wait for them.
+
+Starting an instance takes a while: the EnvProcess builds the environment, loads the ROM, and loads the AI policies of
+the task, which for TF policies takes several seconds. WarmPool keeps a number of started EnvRunners per task that
+aren't assigned to anyone yet. EnvsManager.make_runner() claims one whose EnvProcess has set its ready event if there is
+one, and the pool then starts a replacement in the background. Runners that are still loading stay in the pool. The
+number of instances kept per task is the task's "warm_pool_size", or Config.WARM_POOL_SIZE for tasks that don't set
+one. Pools are only filled once their task is first used, and EnvsManager.shutdown() stops the runners that are left.
+"""
+
+from flask import current_app
+
+from .config import Config
+from .environments import crowdplay_environments
+from .logger import getLogger
+from .socketio import socketio
+
+logger = getLogger(__name__)
+
+
+class WarmPool:
+    def __init__(self, start_runner):
+        """
+        Args:
+            start_runner: Starts a new EnvRunner for a task_id, see EnvsManager.start_runner().
+        """
+        self.start_runner = start_runner
+        # Started but unclaimed EnvRunners by task id, oldest first.
+        self.runners = {}
+        # Tasks whose pool is being filled.
+        self.filling = set()
+        # Set by close(), no more runners are started after that.
+        self.closed = False
+
+    def size(self, task_id):
+        return crowdplay_environments[task_id].get("warm_pool_size", Config.WARM_POOL_SIZE)
+
+    def claim(self, task_id):
+        """Returns a ready EnvRunner for the task, or None if there is none, and refills the pool."""
+        runners = self.runners.get(task_id, [])
+        env_runner = None
+        for candidate in list(runners):
+            if candidate.env_process_exit_event.is_set() or candidate.env_process_is_finished_event.is_set():
+                # The EnvProcess failed to start or died while waiting.
+                logger.warn(f"Warm instance {candidate.instance_id} of task {task_id} has exited, discarding it.")
+                runners.remove(candidate)
+                socketio.start_background_task(candidate.stop_runner)
+            elif candidate.env_process_ready_event.is_set():
+                runners.remove(candidate)
+                env_runner = candidate
+                break
+        if env_runner is not None:
+            env_runner.claim()
+            logger.info(f"Claimed warm instance {env_runner.instance_id} of task {task_id}.")
+        self.fill(task_id)
+        return env_runner
+
+    def fill(self, task_id):
+        """Starts EnvRunners in the background until the task's pool is full."""
+        if self.closed or task_id in self.filling or len(self.runners.get(task_id, [])) >= self.size(task_id):
+            return
+        self.filling.add(task_id)
+        socketio.start_background_task(self._fill_task, current_app._get_current_object(), task_id)
+
+    def _fill_task(self, app, task_id):
+        with app.app_context():
+            try:
+                runners = self.runners.setdefault(task_id, [])
+                while not self.closed and len(runners) < self.size(task_id):
+                    runners.append(self.start_runner(task_id))
+                    logger.info(f"Started warm instance {runners[-1].instance_id} of task {task_id}.")
+                    # Let everything else run in between.
+                    socketio.sleep(0)
+            except Exception:
+                logger.exception(f"Failed to start warm instance of task {task_id}.")
+            finally:
+                self.filling.discard(task_id)
+
+    def close(self):
+        """Stops all unclaimed EnvRunners."""
+        self.closed = True
+        for runners in self.runners.values():
+            while len(runners) > 0:
+                runners.pop().stop_runner()
@@ -0,0 +1,44 @@
+import unittest
+
+from crowdplay_backend.completion_counts import CompletionCounts
+
+
+class TestCompletionCounts(unittest.TestCase):
+    def test_loads_missing_tasks_in_one_query(self):
+        loads = []
+
+        def load(task_ids):
+            loads.append(list(task_ids))
+            return {"a": 2.0}
+
+        counts = CompletionCounts(ttl_seconds=600)
+        self.assertEqual(counts.get(["a", "b"], load), {"a": 2.0, "b": 0})
+        self.assertEqual(counts.get(["b", "a"], load), {"b": 0, "a": 2.0})
+        counts.get(["a", "c"], load)
+        self.assertEqual(loads, [["a", "b"], ["c"]])
+
+    def test_expired_counts_are_reloaded(self):
+        loads = []
+
+        def load(task_ids):
+            loads.append(list(task_ids))
+            return {}
+
+        counts = CompletionCounts(ttl_seconds=0)
+        counts.get(["a"], load)
+        counts.loaded_at["a"] -= 1
+        counts.get(["a"], load)
+        self.assertEqual(loads, [["a"], ["a"]])
+
+    def test_completions_update_counts(self):
+        counts = CompletionCounts(ttl_seconds=600)
+        counts.get(["a"], lambda task_ids: {"a": 1.0})
+        counts.record_completion("a", "i1", "game_0", 0.5)
+        counts.record_completion("a", "i1", "game_0", 1.0)
+        counts.record_completion("a", "i2", "game_0", 1.0)
+        # Not loaded yet, so nothing to update.
+        counts.record_completion("b", "i3", "game_0", 1.0)
+        self.assertEqual(counts.get(["a"], lambda task_ids: {}), {"a": 3.0})
+        self.assertNotIn("b", counts.counts)
+        counts.forget_instance("i1", ["game_0"])
+        self.assertNotIn(("i1", "game_0"), counts.completions)
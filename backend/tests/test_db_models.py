@@ -0,0 +1,85 @@
+import unittest
+
+from flask import Flask
+
+from crowdplay_backend.db import db
+from crowdplay_backend.db_models import (
+    EnvModel,
+    GameModel,
+    SessionModel,
+    StepModel,
+    get_completed_assignments_by_hit_id,
+)
+
+
+def session(visit_id, assignment_id, instance_id, hit_id="hit"):
+    return SessionModel(
+        visit_id=visit_id,
+        assignment_id=assignment_id,
+        worker_id=f"worker_{assignment_id}",
+        hit_id=hit_id,
+        task_id="task",
+        env_instance_id=instance_id,
+        agent_key="game_0",
+        user_type="human",
+    )
+
+
+def steps(game_id, rewards):
+    return [
+        StepModel(
+            game_id=game_id,
+            step_iter=step_iter,
+            agent_key="game_0",
+            prev_obs_extra="{}",
+            prev_obs_image=b"",
+            action="0",
+            reward=reward,
+            done=False,
+        )
+        for step_iter, reward in enumerate(rewards)
+    ]
+
+
+class TestGetCompletedAssignmentsByHitId(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        for instance_id in ("i1", "i2", "i3", "i4"):
+            db.session.add(EnvModel(instance_id=instance_id, env_id="env", task_id="task", hit_id="hit"))
+        # a1 played two games, 4 steps with a total reward of 3.
+        db.session.add(session("v1", "a1", "i1"))
+        db.session.add(GameModel(id="g1", env_instance_id="i1"))
+        db.session.add(GameModel(id="g2", env_instance_id="i1"))
+        db.session.add_all(steps("g1", [1, 1]) + steps("g2", [1, 0]))
+        # a2 played one game, 2 steps with a total reward of 5.
+        db.session.add(session("v2", "a2", "i2"))
+        db.session.add(GameModel(id="g3", env_instance_id="i2"))
+        db.session.add_all(steps("g3", [5, 0]))
+        # a3 never played.
+        db.session.add(session("v3", "a3", "i3"))
+        # a4 is in another HIT.
+        db.session.add(session("v4", "a4", "i4", hit_id="other"))
+        db.session.add(GameModel(id="g4", env_instance_id="i4"))
+        db.session.add_all(steps("g4", [9, 9, 9, 9]))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_counts_all_assignments_without_requirements(self):
+        self.assertEqual(get_completed_assignments_by_hit_id("hit", 0, 0), 3)
+
+    def test_requires_total_reward_and_steps(self):
+        self.assertEqual(get_completed_assignments_by_hit_id("hit", 3, 0), 2)
+        self.assertEqual(get_completed_assignments_by_hit_id("hit", 0, 4), 1)
+        self.assertEqual(get_completed_assignments_by_hit_id("hit", 4, 4), 0)
+        self.assertEqual(get_completed_assignments_by_hit_id("other", 36, 4), 1)
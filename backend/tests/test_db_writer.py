@@ -0,0 +1,131 @@
+import queue
+import unittest
+
+from crowdplay_backend.db_writer import TrajectoryEncoder, write_messages
+from crowdplay_backend.trajectory_recorder import TrajectoryRecorder
+
+
+class FakeEvent:
+    def __init__(self):
+        self.is_set = False
+
+    def set(self):
+        self.is_set = True
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def close(self):
+        pass
+
+    def execute(self, statement, values):
+        if self.connection.pool.fails(values):
+            raise ValueError("bad row")
+        self.connection.pending.append(values)
+
+    def executemany(self, statement, rows):
+        for row in rows:
+            self.execute(statement, row)
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.pool.commits.append(self.pending)
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    """Fails every statement with a value in bad_values, and the first failures_left statements."""
+
+    def __init__(self, bad_values=(), failures_left=0):
+        self.bad_values = set(bad_values)
+        self.failures_left = failures_left
+        self.commits = []
+
+    def fails(self, values):
+        if self.failures_left > 0:
+            self.failures_left -= 1
+            return True
+        return any(value in self.bad_values for value in values)
+
+    def get_connection(self):
+        return FakeConnection(self)
+
+
+def start(instance_id, game_id):
+    return ("episode_start", instance_id, game_id, "now")
+
+
+class TestWriteMessages(unittest.TestCase):
+    def test_writes_batch_in_one_transaction(self):
+        pool = FakePool()
+        events = [FakeEvent()]
+        write_messages(pool, [start("i1", "g1"), ("instance_closed", "i1", 0)], events)
+        self.assertEqual(len(pool.commits), 1)
+        self.assertTrue(events[0].is_set)
+
+    def test_retries_failed_batch(self):
+        pool = FakePool(failures_left=1)
+        events = [FakeEvent()]
+        write_messages(pool, [start("i1", "g1"), ("instance_closed", "i1", 0)], events)
+        self.assertEqual(len(pool.commits), 1)
+        self.assertTrue(events[0].is_set)
+
+    def test_bad_row_only_loses_that_row(self):
+        pool = FakePool(bad_values=["bad"])
+        events = [FakeEvent(), FakeEvent()]
+        messages = [
+            start("i1", "g1"),
+            start("i2", "bad"),
+            start("i2", "g2"),
+            ("instance_closed", "i1", 0),
+            ("instance_closed", "i2", 1),
+        ]
+        write_messages(pool, messages, events)
+        written = [values for commit in pool.commits for values in commit]
+        self.assertIn(["g1", "i1", "now"], written)
+        self.assertIn(["g2", "i2", "now"], written)
+        self.assertNotIn(["bad", "i2", "now"], written)
+        self.assertTrue(events[0].is_set)
+        self.assertTrue(events[1].is_set)
+
+    def test_event_not_set_if_close_is_not_written(self):
+        pool = FakePool(bad_values=["i1"])
+        events = [FakeEvent()]
+        write_messages(pool, [("instance_closed", "i1", 0)], events)
+        self.assertEqual(pool.commits, [])
+        self.assertFalse(events[0].is_set)
+
+
+class TestTrajectoryEncoder(unittest.TestCase):
+    def test_sends_encoded_chunks_before_close_returns(self):
+        database_queue = queue.Queue()
+        encoder = TrajectoryEncoder(database_queue)
+        for chunk_index in range(2):
+            recorder = TrajectoryRecorder()
+            recorder.record({"reward": chunk_index})
+            encoder.put("i1", "g1", chunk_index, recorder.to_columns())
+        encoder.close()
+        messages = [database_queue.get_nowait() for _ in range(2)]
+        self.assertEqual([message[:4] for message in messages], [("episode_to_db", "i1", "g1", i) for i in range(2)])
+        self.assertTrue(all(isinstance(message[4], bytes) for message in messages))
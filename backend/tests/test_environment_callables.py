@@ -0,0 +1,130 @@
+import unittest
+
+import numpy as np
+
+from crowdplay_backend.environment_callables import (
+    ActiveTimeCallable,
+    ConstantCallable,
+    RamFeatureCache,
+    RiverraidLeftRightCallable,
+    ScoreCallable,
+    SpaceInvadersAccuracy,
+    SpaceInvadersAliensCallable,
+    SpaceInvadersAliensHit,
+    SpaceInvadersInsideOut,
+    SpaceInvadersLeftRightCallable,
+    SpaceInvadersOutsideIn,
+    SpaceInvadersRamFeatures,
+    SpaceInvadersRows135,
+    SpaceInvadersRowsByRow,
+    TimeCallable,
+    space_invaders_ram_to_aliens,
+)
+
+AGENTS = ["game_0>player_0", "game_0>player_1"]
+
+
+def make_ram(aliens):
+    """Returns Space Invaders RAM with the given 6x6 alien grid."""
+    ram = np.zeros(128, dtype=np.uint8)
+    for i, row in enumerate(aliens):
+        ram[0x12 + i] = sum(1 << j for j, alien in enumerate(row) if alien)
+    return ram
+
+
+def make_callables():
+    return {
+        "constant": ConstantCallable({agent: 1 for agent in AGENTS}),
+        "time": TimeCallable(),
+        "active": ActiveTimeCallable(AGENTS, timeout=120, action_timeout=60),
+        "score": ScoreCallable(AGENTS),
+        "left": SpaceInvadersLeftRightCallable({agent: {"min": 0, "max": 0.5} for agent in AGENTS}),
+        "riverraid": RiverraidLeftRightCallable({agent: {"min": 0, "max": 40} for agent in AGENTS}),
+        "rows135": SpaceInvadersRows135(AGENTS),
+        "hit": SpaceInvadersAliensHit(AGENTS),
+        "accuracy": SpaceInvadersAccuracy(AGENTS),
+        "rowbyrow": SpaceInvadersRowsByRow(AGENTS),
+        "rowbyrow_count": SpaceInvadersRowsByRow(AGENTS, kind="count"),
+        "outsidein": SpaceInvadersOutsideIn(AGENTS),
+        "outsidein_count": SpaceInvadersOutsideIn(AGENTS, kind="count"),
+        "insideout": SpaceInvadersInsideOut(AGENTS),
+        "insideout_count": SpaceInvadersInsideOut(AGENTS, kind="count"),
+    }
+
+
+def make_episode(rng, length):
+    """Returns random steps of a two player Space Invaders episode, in which aliens are shot over time."""
+    aliens = rng.integers(0, 64, 6)
+    steps = []
+    for _ in range(length):
+        ram = rng.integers(0, 256, 128).astype(np.uint8)
+        aliens &= rng.integers(0, 64, 6) | rng.integers(0, 64, 6) | rng.integers(0, 64, 6)
+        ram[0x12:0x18] = aliens
+        # Frequent new shots.
+        ram[0x55] = 0x55 if rng.random() < 0.3 else ram[0x55]
+        ram[0x56] = 0x55 if rng.random() < 0.3 else ram[0x56]
+        steps.append(
+            {
+                "prev_obs": {agent: None for agent in AGENTS},
+                "action": {agent: {"game": int(rng.random() < 0.05)} for agent in AGENTS},
+                "reward": {agent: float(rng.choice([0, 5, -1], p=[0.9, 0.08, 0.02])) for agent in AGENTS},
+                "info": {agent: {"RAM": ram} for agent in AGENTS},
+            }
+        )
+    return steps
+
+
+def make_step(ram):
+    return {"reward": {agent: 0.0 for agent in AGENTS}, "info": {agent: {"RAM": ram} for agent in AGENTS}}
+
+
+class TestEnvironmentCallables(unittest.TestCase):
+    def test_features(self):
+        ram = np.random.default_rng(0).integers(0, 256, 128).astype(np.uint8)
+        features = SpaceInvadersRamFeatures(ram)
+        self.assertEqual(features.aliens.tolist(), [list(row) for row in space_invaders_ram_to_aliens(ram)])
+        self.assertEqual(features.player_x.tolist(), [ram[0x1C], ram[0x1D]])
+        # Old trajectories store RAM as lists.
+        np.testing.assert_array_equal(SpaceInvadersRamFeatures(ram.tolist()).aliens, features.aliens)
+
+    def test_cache(self):
+        cache = RamFeatureCache(SpaceInvadersRamFeatures)
+        ram = np.zeros(128, dtype=np.uint8)
+        self.assertIs(cache(ram), cache(ram))
+        self.assertIsNot(cache(ram.copy()), cache(ram))
+        self.assertIsNot(cache(ram.tolist()), cache(ram.tolist()))
+
+    def test_aliens_shot(self):
+        aliens = np.ones((6, 6), dtype=bool)
+        callables = {
+            "hit": SpaceInvadersAliensHit(AGENTS),
+            "rowbyrow": SpaceInvadersRowsByRow(AGENTS),
+            "outsidein": SpaceInvadersOutsideIn(AGENTS),
+            "insideout": SpaceInvadersInsideOut(AGENTS),
+        }
+        # Shoot an alien in the innermost column of the first row, then one in the outermost column of the second.
+        results = []
+        for i, j in ((0, 2), (1, 0)):
+            aliens[i, j] = False
+            step = make_step(make_ram(aliens))
+            results.append({name: callable(step)[AGENTS[0]] for name, callable in callables.items()})
+        self.assertEqual(results[0], {"hit": 1, "rowbyrow": 1.0, "outsidein": 0.0, "insideout": 1.0})
+        self.assertEqual(results[1], {"hit": 2, "rowbyrow": 0.5, "outsidein": 0.5, "insideout": 0.5})
+        with self.assertRaises(TypeError):
+            SpaceInvadersAliensCallable(AGENTS)
+
+    def test_evaluate_episode(self):
+        rng = np.random.default_rng(0)
+        for length in (1, 10, 500):
+            steps = make_episode(rng, length)
+            callables = make_callables()
+            for step in steps:
+                results = {name: callable(step) for name, callable in callables.items()}
+            episode = {
+                "length": length,
+                "ram": {agent: np.stack([step["info"][agent]["RAM"] for step in steps]) for agent in AGENTS},
+                "reward": {agent: np.array([step["reward"][agent] for step in steps]) for agent in AGENTS},
+                "action": {agent: np.array([step["action"][agent]["game"] for step in steps]) for agent in AGENTS},
+            }
+            for name, callable in make_callables().items():
+                self.assertEqual(callable.evaluate_episode(episode), results[name], name)
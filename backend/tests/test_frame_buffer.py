@@ -0,0 +1,61 @@
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+from crowdplay_backend.frame_buffer import SharedFrameBuffer
+
+
+def make_step_info(i):
+    return [
+        (
+            f"instance_game_0>player_{agent}",
+            {
+                "obs": OrderedDict({"image": np.full((210, 160, 3), i + agent, dtype=np.uint8)}),
+                "reward": float(i),
+                "step_iter": i,
+                "task_info": {"Score": i},
+            },
+        )
+        for agent in range(2)
+    ]
+
+
+class TestSharedFrameBuffer(unittest.TestCase):
+    def test_latest(self):
+        frame_buffer = SharedFrameBuffer(1024 * 1024)
+        self.assertIsNone(frame_buffer.read())
+        for i in range(5):
+            self.assertTrue(frame_buffer.write(make_step_info(i)))
+        sequence, step_info = frame_buffer.read()
+        self.assertEqual(sequence, 5)
+        expected = make_step_info(4)
+        for (room, data), (expected_room, expected_data) in zip(step_info, expected):
+            self.assertEqual(room, expected_room)
+            self.assertIsInstance(data["obs"], OrderedDict)
+            np.testing.assert_array_equal(data["obs"]["image"], expected_data["obs"]["image"])
+            self.assertEqual(data["task_info"], expected_data["task_info"])
+        # Nothing new since the last read.
+        self.assertIsNone(frame_buffer.read(since=sequence))
+        frame_buffer.write(make_step_info(5))
+        self.assertEqual(frame_buffer.read(since=sequence)[1][0][1]["step_iter"], 5)
+
+    def test_too_large(self):
+        frame_buffer = SharedFrameBuffer(64 * 1024)
+        frame_buffer.write([("room", {"step_iter": 0})])
+        self.assertFalse(frame_buffer.write(make_step_info(1)))
+        # The previous step is still available.
+        self.assertEqual(frame_buffer.read(), (1, [("room", {"step_iter": 0})]))
+
+    def test_shared_arrays(self):
+        # All players of a game see the same screen, which is only stored and read once.
+        frame = np.full((210, 160, 3), 7, dtype=np.uint8)
+        step_info = [(f"room_{agent}", {"obs": OrderedDict({"image": frame}), "step_iter": 1}) for agent in range(2)]
+        frame_buffer = SharedFrameBuffer(frame.nbytes + 4096)
+        self.assertTrue(frame_buffer.write(step_info))
+        _, read = frame_buffer.read()
+        self.assertIs(read[0][1]["obs"]["image"], read[1][1]["obs"]["image"])
+        np.testing.assert_array_equal(read[1][1]["obs"]["image"], frame)
+        # Equal but distinct arrays are stored separately.
+        step_info[1][1]["obs"]["image"] = frame.copy()
+        self.assertFalse(frame_buffer.write(step_info))
@@ -0,0 +1,92 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from crowdplay_backend.frame_codec import DeltaFrameEncoder, PaletteEncoder, palette_decode
+
+
+def decode(image):
+    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)[:, :, ::-1]
+
+
+def composite(canvas, image, tiles):
+    """Does the same as the client side compositor."""
+    if image is None:
+        return canvas
+    if tiles is None:
+        return decode(image).copy()
+    atlas = decode(image)
+    columns, size, positions = tiles[0], tiles[1], tiles[2:]
+    for i in range(len(positions) // 2):
+        x, y = positions[2 * i], positions[2 * i + 1]
+        ax, ay = (i % columns) * size, (i // columns) * size
+        target = canvas[y * size : (y + 1) * size, x * size : (x + 1) * size]
+        target[...] = atlas[ay : ay + target.shape[0], ax : ax + target.shape[1]]
+    return canvas
+
+
+class TestPaletteEncoder(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        colours = rng.integers(0, 256, (128, 3), dtype=np.uint8)
+        encoder = PaletteEncoder()
+        frames = colours[rng.integers(0, 64, (3, 210, 160))]
+        indices = encoder.encode(frames)
+        self.assertEqual(indices.shape, (3, 210, 160))
+        self.assertEqual(indices.dtype, np.uint8)
+        np.testing.assert_array_equal(palette_decode(indices, encoder.palette), frames)
+        # New colours are added, and colours seen before keep their index.
+        palette = encoder.palette
+        frame = colours[rng.integers(0, 128, (210, 160))]
+        np.testing.assert_array_equal(palette_decode(encoder.encode(frame), encoder.palette), frame)
+        np.testing.assert_array_equal(encoder.palette[: len(palette)], palette)
+        np.testing.assert_array_equal(palette_decode(indices, encoder.palette), frames)
+
+    def test_too_many_colours(self):
+        frame = np.zeros((300, 3), dtype=np.uint8)
+        frame[:, 0] = np.arange(300) // 256
+        frame[:, 1] = np.arange(300) % 256
+        with self.assertRaises(ValueError):
+            PaletteEncoder().encode(frame)
+
+
+class TestDeltaFrameEncoder(unittest.TestCase):
+    def test_delta_frames(self):
+        encoder = DeltaFrameEncoder(tile_size=16, keyframe_interval=10)
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (210, 160, 3), dtype=np.uint8)
+
+        image, tiles = encoder.encode(frame, ".png")
+        self.assertIsNone(tiles)
+        canvas = composite(None, image, tiles)
+        np.testing.assert_array_equal(canvas, frame)
+
+        # Identical frames are skipped.
+        self.assertEqual(encoder.encode(frame, ".png"), (None, []))
+
+        # Change a pixel in the last, partial, row of tiles, and a small block spanning two tiles.
+        frame = frame.copy()
+        frame[209, 0] = 0
+        frame[20:40, 30:34] = 255
+        image, tiles = encoder.encode(frame, ".png")
+        self.assertEqual(tiles[1], 16)
+        self.assertEqual(sorted(zip(tiles[2::2], tiles[3::2])), [(0, 13), (1, 1), (1, 2), (2, 1), (2, 2)])
+        canvas = composite(canvas, image, tiles)
+        np.testing.assert_array_equal(canvas, frame)
+
+    def test_keyframes(self):
+        encoder = DeltaFrameEncoder(keyframe_interval=3, max_changed_fraction=0.5)
+        frame = np.zeros((32, 32, 3), dtype=np.uint8)
+        self.assertIsNone(encoder.encode(frame, ".png")[1])
+        self.assertEqual(encoder.encode(frame, ".png")[1], [])
+        self.assertEqual(encoder.encode(frame, ".png")[1], [])
+        # Every third frame is a keyframe.
+        self.assertIsNone(encoder.encode(frame, ".png")[1])
+        # Too many changed tiles.
+        self.assertIsNone(encoder.encode(frame + 1, ".png")[1])
+        encoder.request_keyframe()
+        self.assertIsNone(encoder.encode(frame + 1, ".png")[1])
+        # Frames of a different size, e.g. when the stream is downscaled.
+        self.assertIsNone(encoder.encode(frame[:16, :16] + 1, ".png")[1])
+        self.assertEqual(encoder.encode(frame[:16, :16] + 1, ".png")[1], [])
@@ -0,0 +1,34 @@
+import time
+import unittest
+
+from crowdplay_backend.frame_scheduler import FrameScheduler
+
+
+class TestFrameScheduler(unittest.TestCase):
+    def test_regular_frames(self):
+        scheduler = FrameScheduler(100)
+        start = time.monotonic()
+        for _ in range(10):
+            self.assertEqual(scheduler.wait(), 0.0)
+        # 10 frames at 100 FPS, without drifting.
+        self.assertAlmostEqual(time.monotonic() - start, 0.1, delta=0.02)
+        self.assertEqual(scheduler.overruns, 0)
+
+    def test_overruns(self):
+        scheduler = FrameScheduler(100)
+        scheduler.wait()
+        time.sleep(0.05)
+        self.assertGreater(scheduler.wait(), 0.03)
+        self.assertEqual(scheduler.overruns, 1)
+        # Skips ahead instead of catching up with a burst of frames.
+        start = time.monotonic()
+        self.assertEqual(scheduler.wait(), 0.0)
+        self.assertGreater(time.monotonic() - start, 0.005)
+
+    def test_resync(self):
+        scheduler = FrameScheduler(100)
+        # Waiting for players isn't an overrun.
+        time.sleep(0.05)
+        scheduler.resync()
+        self.assertEqual(scheduler.wait(), 0.0)
+        self.assertEqual(scheduler.overruns, 0)
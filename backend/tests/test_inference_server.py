@@ -0,0 +1,74 @@
+import multiprocessing
+import queue
+import threading
+import unittest
+
+from crowdplay_backend.exceptions import AiPolicyError
+from crowdplay_backend.inference_server import InferenceServer, RemotePolicy, collect_batch, compute_actions
+
+
+class DoublingPolicy:
+    def compute_actions(self, observations):
+        if any(obs["x"] < 0 for obs in observations):
+            raise ValueError("negative observation")
+        return [{"game": obs["x"] * 2} for obs in observations]
+
+
+class TestInferenceServer(unittest.TestCase):
+    def test_collect_batch(self):
+        requests = queue.Queue()
+        for i in range(5):
+            requests.put(i)
+        self.assertEqual(collect_batch(requests, "first", 4), ["first", 0, 1, 2])
+        self.assertEqual(collect_batch(requests, "first", 4), ["first", 3, 4])
+        # Nothing waiting, so the first request doesn't wait for others.
+        self.assertEqual(collect_batch(requests, "first", 4), ["first"])
+
+    def test_failed_batch_is_computed_one_at_a_time(self):
+        actions = compute_actions("doubling", DoublingPolicy(), [{"x": 1}, {"x": -1}, {"x": 2}])
+        self.assertEqual(actions, [{"game": 2}, None, {"game": 4}])
+
+    def test_remote_policy_waits_until_ready(self):
+        ready_event = threading.Event()
+        requests = queue.Queue()
+        threading.Timer(0.05, ready_event.set).start()
+        RemotePolicy(requests, ready_event)
+        self.assertTrue(ready_event.is_set())
+        self.assertEqual(requests.get_nowait()[0], "connect")
+
+    def test_remote_policy(self):
+        server = InferenceServer("doubling", DoublingPolicy, max_batch_size=8)
+        try:
+            policy = RemotePolicy(server.queue, server.ready_event)
+            self.assertEqual(policy.compute_action({"x": 3}), {"game": 6})
+            self.assertEqual(policy.compute_action({"x": 4}), {"game": 8})
+            with self.assertRaises(AiPolicyError):
+                policy.compute_action({"x": -1})
+            self.assertEqual(policy.compute_action({"x": 5}), {"game": 10})
+            policy.close()
+        finally:
+            server.close()
+
+    def test_remote_policies_in_other_processes(self):
+        server = InferenceServer("doubling", DoublingPolicy, max_batch_size=8)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=compute_actions_in_process, args=(server.queue, server.ready_event, results, i)
+            )
+            for i in range(4)
+        ]
+        try:
+            for client in clients:
+                client.start()
+            self.assertEqual(sorted(results.get(timeout=10) for _ in clients), [(i, [i * 2] * 10) for i in range(4)])
+        finally:
+            for client in clients:
+                client.join()
+            server.close()
+
+
+def compute_actions_in_process(request_queue, ready_event, results, x):
+    policy = RemotePolicy(request_queue, ready_event)
+    results.put((x, [policy.compute_action({"x": x})["game"] for _ in range(10)]))
+    policy.close()
@@ -0,0 +1,42 @@
+import unittest
+
+from crowdplay_backend.instance_registry import InstanceRegistry
+
+
+class TestInstanceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = InstanceRegistry()
+        self.registry.add_instance("i1", "task", {"game_0": (None, None), "game_1": (2, "policy")})
+        self.registry.add_instance("i2", "task", {"game_0": (None, None), "game_1": (None, None)})
+        self.registry.add_instance("i3", "other", {"game_0": (None, None)})
+
+    def test_open_instances(self):
+        self.assertEqual(self.registry.open_instance_ids("task"), ["i1", "i2"])
+        self.registry.set_agent("i1", "game_0", (1, None, "a1"))
+        self.assertEqual(self.registry.open_instance_ids("task"), ["i2"])
+        self.assertEqual(self.registry.agents_to_assign("i2"), ["game_0", "game_1"])
+        self.registry.set_agent("i2", "game_0", (1, None, "a2"))
+        self.assertEqual(self.registry.agents_to_assign("i2"), ["game_1"])
+        self.registry.remove_instance("i2")
+        self.assertEqual(self.registry.open_instance_ids("task"), [])
+        self.assertEqual(self.registry.open_instance_ids("other"), ["i3"])
+
+    def test_sids(self):
+        self.registry.set_agent("i1", "game_0", (1, None, "a1"))
+        self.assertEqual(self.registry.instance_ids_for_sid(None), [])
+        self.registry.set_agent("i1", "game_0", (1, "sid", "a1", "not_ready"))
+        self.assertEqual(self.registry.instance_ids_for_sid("sid"), ["i1"])
+        self.assertEqual(self.registry.agent_for_sid("i1", "sid"), "game_0")
+        self.assertIsNone(self.registry.agent_for_sid("i2", "sid"))
+        self.registry.set_agent("i1", "game_0", (2, "policy"))
+        self.assertEqual(self.registry.instance_ids_for_sid("sid"), [])
+
+    def test_assignment_ids(self):
+        self.registry.set_agent("i1", "game_0", (1, None, 17))
+        self.registry.set_agent("i3", "game_0", (1, None, 17))
+        self.assertEqual(self.registry.agents_for_assignment_id("task", "17"), [("i1", "game_0")])
+        self.registry.remove_instance("i1")
+        self.assertEqual(self.registry.agents_for_assignment_id("task", 17), [])
+        self.assertEqual(self.registry.agents_for_assignment_id("other", 17), [("i3", "game_0")])
+        # Instances that were never added are ignored.
+        self.registry.set_agent("i4", "game_0", (1, None, 17))
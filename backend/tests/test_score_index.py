@@ -0,0 +1,104 @@
+import random
+import unittest
+from datetime import timedelta
+
+import numpy as np
+
+from crowdplay_backend.score_index import ScoreIndex, SortedScores, get_score_stats
+
+
+def sort_and_histogram(metric, this_score, all_scores):
+    """The score stats as computed before the score index, by sorting and histogramming all scores."""
+    this_score_string = f"{this_score:.2f}" if isinstance(this_score, float) else str(this_score)
+    if this_score not in all_scores:
+        all_scores.append(this_score)
+    if isinstance(this_score, timedelta):
+        this_score = this_score / timedelta(minutes=1)
+        all_scores = [score / timedelta(minutes=1) for score in all_scores if isinstance(score, timedelta)]
+    all_scores.sort()
+    low = all_scores[0]
+    high = all_scores[-1]
+    bin_size = (high - low) / 10 or 1
+    binned_data = np.histogram(all_scores, bins=11, range=(low - (bin_size / 2), high + (bin_size / 2)))
+    histogram = (
+        [{"x": float(low + i * bin_size), "y": 0.0} for i in range(-2, 0)]
+        + [{"x": float(low + i * bin_size), "y": float(binned_data[0][i])} for i in range(len(binned_data[0]))]
+        + [{"x": float(high + i * bin_size), "y": 0.0} for i in range(1, 3)]
+    )
+    rank_lower = len(all_scores) - all_scores.index(this_score)
+    all_scores.reverse()
+    rank = all_scores.index(this_score) + 1
+    total_scores = len(all_scores)
+    percentile = 100 if total_scores == 1 else int(100 * (1 - rank_lower / total_scores))
+    return {
+        "metric": metric,
+        "your_score": this_score_string,
+        "your_score_raw": this_score,
+        "your_rank": rank,
+        "out_of": total_scores,
+        "percentile": percentile,
+        "histogram": histogram,
+    }
+
+
+class TestScoreIndex(unittest.TestCase):
+    def test_same_stats_as_sorting_all_scores(self):
+        rng = random.Random(0)
+        for trial in range(200):
+            if trial % 3 == 0:
+                scores = [rng.randint(0, 20) for _ in range(rng.randint(0, 50))]
+                this_score = rng.randint(0, 25)
+            elif trial % 3 == 1:
+                scores = [rng.uniform(-5, 5) for _ in range(rng.randint(0, 50))]
+                this_score = rng.choice(scores) if scores and trial % 2 else rng.uniform(-5, 5)
+            else:
+                scores = [timedelta(seconds=rng.randint(0, 600)) for _ in range(rng.randint(0, 50))]
+                this_score = timedelta(seconds=rng.randint(0, 600))
+            self.assertEqual(
+                get_score_stats("m", this_score, SortedScores.from_values(scores)),
+                sort_and_histogram("m", this_score, list(scores)),
+            )
+
+    def test_updates(self):
+        scores = SortedScores()
+        scores.set("a", 3)
+        scores.set("b", 5)
+        scores.set("a", 7)
+        self.assertEqual(scores.sorted_values("number"), [5, 7])
+        stats = get_score_stats("m", 7, scores)
+        self.assertEqual((stats["your_rank"], stats["out_of"]), (1, 2))
+
+    def test_index(self):
+        index = ScoreIndex(refresh_seconds=600)
+        index.record_episode("task", "Score", "i1", "g1", "a", 10, 10)
+        loads = []
+
+        def load_totals():
+            loads.append("totals")
+            return [("i1", "a", 4), ("i2", "a", 8)]
+
+        def load_episodes():
+            return [("i1", "g0", "a", 4), ("i2", "g2", "a", 8)]
+
+        scores = index.get("task", "Score", load_totals, load_episodes)
+        # Recorded values are newer than what the DB has.
+        self.assertEqual(scores.totals.get(("i1", "a")), 10)
+        self.assertEqual(scores.totals.sorted_values("number"), [8, 10])
+        self.assertEqual(scores.episodes.sorted_values("number"), [4, 8, 10])
+        index.record_episode("task", "Score", "i1", "g3", "a", 12, 2)
+        self.assertEqual(scores.best_episodes[("i1", "a")], 10)
+        self.assertIs(index.get("task", "Score", load_totals, load_episodes), scores)
+        self.assertEqual(loads, ["totals"])
+        self.assertEqual(get_score_stats("m", 12, scores.totals)["your_rank"], 1)
+
+    def test_recent_updates_expire(self):
+        index = ScoreIndex(refresh_seconds=10)
+        index.record_episode("task", "Score", "i1", "g1", "a", 1, 1, now=0)
+        index.record_episode("task", "Score", "i2", "g2", "a", 2, 2, now=5)
+        index.record_episode("task", "Score", "i1", "g3", "a", 3, 2, now=8)
+        index.record_episode("task", "Score", "i3", "g4", "a", 4, 4, now=16)
+        # i1's total was updated at 8, but its first game and i2's updates are older than refresh_seconds.
+        self.assertEqual(list(index.recent_totals[("task", "Score")]), [("i1", "a"), ("i3", "a")])
+        self.assertEqual(list(index.recent_episodes[("task", "Score")]), [("i1", "g3", "a"), ("i3", "g4", "a")])
+        scores = index.get("task", "Score", lambda: [], lambda: [])
+        self.assertEqual(scores.totals.sorted_values("number"), [3, 4])
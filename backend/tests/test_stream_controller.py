@@ -0,0 +1,49 @@
+import unittest
+
+from crowdplay_backend.stream_controller import LEVELS, StreamController
+
+
+class TestStreamController(unittest.TestCase):
+    def send(self, controller, step_iter, now):
+        if controller.should_send(now=now):
+            controller.on_sent(step_iter, 0.001, now=now)
+            return True
+        return False
+
+    def test_backpressure(self):
+        controller = StreamController(max_in_flight=2)
+        self.assertTrue(self.send(controller, 1, 0.0))
+        self.assertTrue(self.send(controller, 2, 0.0))
+        # Nothing is encoded while too many steps are unacknowledged.
+        self.assertFalse(self.send(controller, 3, 0.0))
+        controller.on_ack(2, now=0.01)
+        self.assertEqual(controller.in_flight, {})
+        self.assertTrue(self.send(controller, 4, 0.02))
+        self.assertEqual(controller.metrics()["skipped"], 1)
+
+    def test_adapts_to_lag(self):
+        controller = StreamController(target_lag=0.1, upgrade_after=5, downgrade_after=3)
+        now = 0.0
+        step_iter = 0
+        # A slow client lowers the level step by step, down to the cheapest level.
+        while controller.level < len(LEVELS) - 1 and step_iter < 1000:
+            step_iter += 1
+            now += 0.5
+            if self.send(controller, step_iter, now):
+                controller.on_ack(step_iter, now=now + 0.3)
+        self.assertEqual(controller.level, len(LEVELS) - 1)
+        self.assertLess(controller.quality, LEVELS[0][0])
+        # A fast client raises it again.
+        while controller.level > 0 and step_iter < 2000:
+            step_iter += 1
+            now += 0.5
+            if self.send(controller, step_iter, now):
+                controller.on_ack(step_iter, now=now + 0.01)
+        self.assertEqual(controller.level, 0)
+
+    def test_lost_acks(self):
+        controller = StreamController(ack_timeout=1.0)
+        self.send(controller, 1, 0.0)
+        self.send(controller, 2, 2.0)
+        self.assertEqual(controller.level, 1)
+        self.assertEqual(controller.metrics()["lost"], 1)
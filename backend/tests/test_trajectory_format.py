@@ -0,0 +1,135 @@
+import unittest
+from datetime import timedelta
+
+import numpy as np
+
+from crowdplay_backend.trajectory_format import (
+    FORMAT_VERSION,
+    decode_columns,
+    decode_header,
+    decode_trajectory,
+    encode_columns,
+    encode_trajectory,
+    is_columnar,
+)
+from crowdplay_backend.trajectory_recorder import TrajectoryRecorder
+
+try:
+    from crowdplay_datasets import columnar
+except ImportError:
+    # The dataset package is not part of the backend image, see dataset/ in the repo.
+    columnar = None
+
+
+def make_trajectory(length=5):
+    agent = "game_0>player_0"
+    trajectory = []
+    for i in range(length):
+        step = {
+            "prev_obs": {agent: {"image": np.full((4, 3, 3), i, dtype=np.uint8)}},
+            "action": {agent: {"game": i % 3}},
+            "action_step_iter": {agent: i - 1},
+            "reward": {agent: float(i)},
+            "done": {agent: i == length - 1},
+            "info": {agent: {"RAM": [i] * 128, "ale.lives": 3}},
+            "step_iter": i + 1,
+            "user_type": {agent: 1},
+            "task_callables": {"Time played": {agent: timedelta(seconds=i)}},
+            "episode_callables": {},
+        }
+        if i == 2:
+            step["info"][agent]["sparse"] = "only here"
+        trajectory.append(step)
+    return trajectory
+
+
+def assert_steps_equal(test, step, expected):
+    test.assertEqual(set(step), set(expected))
+    for key, value in expected.items():
+        if isinstance(value, dict):
+            assert_steps_equal(test, step[key], value)
+        elif isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(np.asarray(step[key]), value)
+        else:
+            test.assertEqual(step[key], value)
+
+
+class TestTrajectoryFormat(unittest.TestCase):
+    def test_round_trip(self):
+        trajectory = make_trajectory()
+        for codec in ("raw", "zlib"):
+            data = encode_trajectory(trajectory, codec=codec)
+            self.assertTrue(is_columnar(data))
+            decoded = decode_trajectory(data)
+            self.assertEqual(len(decoded), len(trajectory))
+            for original, step in zip(trajectory, decoded):
+                agent = "game_0>player_0"
+                np.testing.assert_array_equal(step["prev_obs"][agent]["image"], original["prev_obs"][agent]["image"])
+                self.assertEqual(step["action"], original["action"])
+                self.assertEqual(step["reward"], original["reward"])
+                self.assertEqual(step["done"], original["done"])
+                self.assertEqual(step["info"], original["info"])
+                self.assertEqual(step["task_callables"], original["task_callables"])
+                self.assertEqual(step["episode_callables"], original["episode_callables"])
+
+    def test_columns(self):
+        columns = decode_columns(encode_trajectory(make_trajectory()))
+        ram = columns["columns"]["info/game_0>player_0/RAM"]["array"]
+        self.assertEqual(ram.shape, (5, 128))
+        self.assertEqual(ram.dtype, np.uint8)
+        frames = columns["columns"]["prev_obs/game_0>player_0/image"]["array"]
+        self.assertEqual(frames.shape, (5, 4, 3, 3))
+        self.assertTrue(columns["objects"]["info/game_0>player_0/sparse"]["sparse"])
+
+    def test_palette(self):
+        trajectory = make_trajectory()
+        data = encode_trajectory(trajectory, codec="raw", palette=True)
+        header, _ = decode_header(data)
+        column = [c for c in header["columns"] if c["name"] == "prev_obs/game_0>player_0/image"][0]
+        self.assertEqual(len(column["palette"]), 5)
+        # One byte per pixel instead of three.
+        self.assertEqual(column["nbytes"], 5 * 4 * 3)
+        frames = decode_columns(data)["columns"]["prev_obs/game_0>player_0/image"]["array"]
+        self.assertEqual(frames.shape, (5, 4, 3, 3))
+        for i, step in enumerate(trajectory):
+            np.testing.assert_array_equal(frames[i], step["prev_obs"]["game_0>player_0"]["image"])
+
+    def test_newer_version_is_rejected(self):
+        data = encode_trajectory(make_trajectory())
+        version = f'"version": {FORMAT_VERSION}'.encode()
+        self.assertIn(version, data)
+        # Same length, so the header length stays valid.
+        newer = data.replace(version, f'"version": {FORMAT_VERSION + 1}'.encode(), 1)
+        with self.assertRaisesRegex(ValueError, "newer than the supported version"):
+            decode_columns(newer)
+
+
+@unittest.skipIf(columnar is None, "crowdplay_datasets is not installed")
+class TestDatasetCompatibility(unittest.TestCase):
+    def test_dataset_reads_backend_trajectories(self):
+        # Recorded like in EnvProcess, with the RAM shared between two agents so that it is stored as an alias.
+        trajectory = make_trajectory()
+        recorder = TrajectoryRecorder()
+        for step in trajectory:
+            ram = np.asarray(step["info"]["game_0>player_0"]["RAM"], dtype=np.uint8)
+            step["info"]["game_0>player_0"]["RAM"] = ram
+            step["info"]["game_0>player_1"] = {"RAM": ram}
+            recorder.record(step)
+        columns = recorder.to_columns()
+        self.assertIn("info/game_0>player_1/RAM", columns["aliases"])
+        for codec in ("raw", "zlib"):
+            for palette in (False, True):
+                loaded = columnar.load_trajectory(encode_columns(columns, codec=codec, palette=palette))
+                self.assertEqual(len(loaded), len(trajectory))
+                for step, expected in zip(loaded, trajectory):
+                    assert_steps_equal(self, step, expected)
+                np.testing.assert_array_equal(loaded.ram("game_0>player_1"), loaded.ram("game_0>player_0"))
+                self.assertEqual(isinstance(loaded.frames("game_0>player_0"), columnar.PaletteFrames), palette)
+
+    def test_backend_reads_dataset_trajectories(self):
+        trajectory = make_trajectory()
+        for codec in ("raw", "zlib"):
+            for palette in (False, True):
+                decoded = decode_trajectory(columnar.encode_trajectory(trajectory, codec=codec, palette=palette))
+                for step, expected in zip(decoded, trajectory):
+                    assert_steps_equal(self, step, expected)
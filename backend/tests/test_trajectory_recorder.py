@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as np
+
+from crowdplay_backend.trajectory_format import columns_to_trajectory, decode_trajectory, encode_columns
+from crowdplay_backend.trajectory_recorder import TrajectoryRecorder
+
+from .test_trajectory_format import make_trajectory
+
+
+class TestTrajectoryRecorder(unittest.TestCase):
+    def assertTrajectoryEqual(self, decoded, trajectory):
+        self.assertEqual(len(decoded), len(trajectory))
+        agent = "game_0>player_0"
+        for original, step in zip(trajectory, decoded):
+            np.testing.assert_array_equal(step["prev_obs"][agent]["image"], original["prev_obs"][agent]["image"])
+            for key in ("action", "reward", "done", "info", "step_iter", "task_callables", "episode_callables"):
+                self.assertEqual(step[key], original[key])
+
+    def test_record(self):
+        trajectory = make_trajectory(length=7)
+        # A small capacity so that buffers have to grow.
+        recorder = TrajectoryRecorder(capacity=2)
+        for step in trajectory:
+            recorder.record(step)
+        self.assertEqual(len(recorder), 7)
+        columns = recorder.to_columns()
+        self.assertEqual(columns["columns"]["info/game_0>player_0/RAM"]["array"].dtype, np.uint8)
+        self.assertTrajectoryEqual(columns_to_trajectory(columns), trajectory)
+        self.assertTrajectoryEqual(decode_trajectory(encode_columns(columns)), trajectory)
+
+    def test_mutated_steps(self):
+        # EnvProcess reuses and mutates the same dicts between steps, which must not affect recorded steps.
+        agent = "game_0>player_0"
+        recorder = TrajectoryRecorder()
+        step = {"action": {agent: {"game": 0}}, "info": {agent: {"RAM": [0] * 128}}}
+        for i in range(3):
+            step["action"][agent]["game"] = i
+            step["info"][agent]["RAM"][0] = i
+            recorder.record(step)
+        decoded = columns_to_trajectory(recorder.to_columns())
+        self.assertEqual([s["action"][agent]["game"] for s in decoded], [0, 1, 2])
+        self.assertEqual([s["info"][agent]["RAM"][0] for s in decoded], [0, 1, 2])
+
+    def test_demote_and_reset(self):
+        recorder = TrajectoryRecorder()
+        recorder.record({"reward": 0, "info": {"lives": 3}})
+        recorder.record({"reward": 1.5, "info": {"lives": "none"}})
+        recorder.record({"reward": 2})
+        columns = recorder.to_columns()
+        self.assertEqual(columns["columns"]["reward"]["array"].tolist(), [0.0, 1.5, 2.0])
+        self.assertEqual(columns["objects"]["info/lives"]["values"], {0: 3, 1: "none"})
+        self.assertTrue(columns["objects"]["info/lives"]["sparse"])
+
+        buffer = recorder._dense[("reward",)].buffer
+        recorder.reset()
+        self.assertEqual(len(recorder), 0)
+        recorder.record({"reward": 5.0})
+        # Buffers are handed off with the columns, not reused.
+        self.assertIsNot(recorder._dense[("reward",)].buffer, buffer)
+        self.assertEqual(columns_to_trajectory(recorder.to_columns()), [{"reward": 5.0}])
+        self.assertEqual(columns["columns"]["reward"]["array"].tolist(), [0.0, 1.5, 2.0])
+
+    def test_widen_arrays(self):
+        recorder = TrajectoryRecorder()
+        recorder.record({"info": {"pos": [1, 2], "ram": np.zeros(2, dtype=np.uint8)}})
+        recorder.record({"info": {"pos": [1.5, 2.7], "ram": np.full(2, 300, dtype=np.int16)}})
+        columns = recorder.to_columns()
+        self.assertEqual(columns["columns"]["info/pos"]["array"].tolist(), [[1.0, 2.0], [1.5, 2.7]])
+        self.assertEqual(columns["columns"]["info/ram"]["array"].tolist(), [[0, 0], [300, 300]])
+        self.assertEqual(columns_to_trajectory(columns)[1]["info"]["pos"], [1.5, 2.7])
+
+    def test_shared_arrays(self):
+        # MaxFrameAndRAMWrapper puts the same RAM array into the info of every agent, which is stored only once.
+        agents = ("game_0>player_0", "game_0>player_1")
+        recorder = TrajectoryRecorder(capacity=2)
+        for i in range(4):
+            ram = np.full(128, i, dtype=np.uint8)
+            info = {agent: {"RAM": ram} for agent in agents}
+            if i == 3:
+                # No longer the same array, so the alias becomes a column of its own.
+                info[agents[1]]["RAM"] = np.full(128, 7, dtype=np.uint8)
+            recorder.record({"info": info})
+        columns = recorder.to_columns()
+        self.assertEqual(columns["aliases"], {})
+        self.assertEqual(columns["columns"]["info/game_0>player_1/RAM"]["array"][:, 0].tolist(), [0, 1, 2, 7])
+
+        recorder.reset()
+        for i in range(3):
+            ram = np.full(128, i, dtype=np.uint8)
+            recorder.record({"info": {agent: {"RAM": ram} for agent in agents}})
+        columns = recorder.to_columns()
+        self.assertEqual(list(columns["columns"]), ["info/game_0>player_0/RAM"])
+        self.assertEqual(columns["columns"]["info/game_0>player_0/RAM"]["array"].shape, (3, 128))
+        self.assertEqual(
+            columns["aliases"]["info/game_0>player_1/RAM"],
+            {"path": ["info", "game_0>player_1", "RAM"], "target": "info/game_0>player_0/RAM"},
+        )
+        for decoded in (columns_to_trajectory(columns), decode_trajectory(encode_columns(columns))):
+            for i, step in enumerate(decoded):
+                for agent in agents:
+                    np.testing.assert_array_equal(step["info"][agent]["RAM"], np.full(128, i, dtype=np.uint8))
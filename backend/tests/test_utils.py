@@ -1,6 +1,27 @@
 import unittest
+from collections import OrderedDict
 
-from crowdplay_backend.utils import consolidate_steps
+import cv2
+import numpy as np
+
+from crowdplay_backend.utils import (
+    EnvSpaces,
+    consolidate_steps,
+    negotiate_step_format,
+    observation_to_binary,
+    observation_to_serializable,
+    scale_image,
+    split_observation_image,
+)
+
+
+class Discrete:
+    """Stands in for gym.spaces.Discrete, which space_to_dict() recognises by name."""
+
+    dtype = np.dtype("int64")
+
+    def __init__(self, n):
+        self.n = n
 
 
 class TestUtils(unittest.TestCase):
@@ -37,3 +58,75 @@ class TestUtils(unittest.TestCase):
         self.assertDictEqual(consolidated_steps[0]["agents"]["agent_A"], {"reward": 0})
         self.assertDictEqual(consolidated_steps[1]["agents"]["agent_B"], {"reward": 1})
         self.assertDictEqual(consolidated_steps[2]["agents"]["agent_C"], {"reward": 5})
+
+    def test_negotiate_step_format(self):
+        self.assertIsNone(negotiate_step_format(None))
+        self.assertIsNone(negotiate_step_format({"binary": False}))
+        self.assertIsNone(negotiate_step_format({"binary": True, "image_formats": ["avif"]}))
+        self.assertDictEqual(
+            negotiate_step_format({"binary": True, "image_formats": ["avif", "webp", "jpeg"]}),
+            {"binary": True, "image_format": "webp", "delta": False, "adaptive": False},
+        )
+        self.assertTrue(negotiate_step_format({"binary": True, "delta": True})["delta"])
+        self.assertTrue(negotiate_step_format({"binary": True, "adaptive": True})["adaptive"])
+        self.assertDictEqual(
+            negotiate_step_format({"binary": True, "image_formats": ["palette", "jpeg"], "delta": True}),
+            {"binary": True, "image_format": "palette", "delta": False, "adaptive": False},
+        )
+
+    def test_observation_to_binary(self):
+        frame = np.zeros((210, 160, 3), dtype=np.uint8)
+        frame[:, :, 0] = 255
+
+        image, image_key, rest = observation_to_binary(OrderedDict({"image": frame, "lives": 3}), "png")
+        self.assertEqual(image_key, "image")
+        self.assertDictEqual(rest, {"lives": 3})
+        decoded = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        # Images are RGB, OpenCV decodes to BGR.
+        np.testing.assert_array_equal(decoded[:, :, ::-1], frame)
+
+        image, image_key, rest = observation_to_binary(frame, "jpeg")
+        self.assertEqual(image[:2], b"\xff\xd8")
+        self.assertEqual(image_key, "")
+
+        self.assertEqual(observation_to_binary("ansi text"), (None, None, "ansi text"))
+
+    def test_scale_image(self):
+        frame = np.zeros((210, 160, 3), dtype=np.uint8)
+        frame[::2, ::2] = [200, 72, 72]
+        self.assertIs(scale_image(frame, 1.0), frame)
+        self.assertEqual(scale_image(frame, 0.5).shape, (105, 80, 3))
+        # Nearest neighbour scaling only keeps existing colours, e.g. for palette frames.
+        colours = np.unique(scale_image(frame, 0.75, cv2.INTER_NEAREST).reshape(-1, 3), axis=0)
+        np.testing.assert_array_equal(colours, [[0, 0, 0], [200, 72, 72]])
+
+    def test_split_observation_image(self):
+        frame = np.zeros((210, 160, 3), dtype=np.uint8)
+        obs = OrderedDict({"image_rgb": frame, "lives": np.int64(3), "ram": np.arange(3, dtype=np.uint8)})
+        image, image_key, rest = split_observation_image(obs)
+        self.assertIs(image, frame)
+        self.assertEqual(image_key, "image_rgb")
+        self.assertEqual(rest, {"lives": 3, "ram": [0, 1, 2]})
+        self.assertIs(type(rest["lives"]), int)
+
+    def test_encode_once(self):
+        frame = np.zeros((210, 160, 3), dtype=np.uint8)
+        obs = {"game_0>player_0": OrderedDict({"image": frame}), "game_0>player_1": OrderedDict({"image": frame})}
+        encoded = {}
+        first, _, _ = observation_to_binary(obs["game_0>player_0"], "jpeg", encoded=encoded)
+        second, _, _ = observation_to_binary(obs["game_0>player_1"], "jpeg", encoded=encoded)
+        self.assertIs(first, second)
+        self.assertIsNot(observation_to_binary(frame, "jpeg", quality=50, encoded=encoded)[0], first)
+        self.assertEqual(len(encoded), 2)
+        serializable = observation_to_serializable(obs, encoded=encoded)
+        self.assertIs(serializable["game_0>player_0"]["image"], serializable["game_0>player_1"]["image"])
+        self.assertTrue(serializable["game_0>player_0"]["image"].startswith("data:image/jpeg;base64,"))
+
+    def test_env_spaces(self):
+        spaces = EnvSpaces({"agent_0": Discrete(3)}, {"agent_0": Discrete(6)}, ["agent_0"])
+        action_space = spaces.space_dict("action_space", "agent_0")
+        self.assertEqual(action_space, {"name": "Discrete", "dtype": "int64", "n": 6})
+        self.assertIs(spaces.space_dict("action_space", "agent_0"), action_space)
+        self.assertEqual(
+            spaces.space_dict("observation_space"), {"agent_0": {"name": "Discrete", "dtype": "int64", "n": 3}}
+        )
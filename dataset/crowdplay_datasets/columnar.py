@@ -0,0 +1,534 @@
+"""
+Reader and writer for the columnar trajectory format.
+
+This is the same format the CrowdPlay backend writes to the episode_trajectories table
+(see crowdplay_backend/trajectory_format.py for a description of the layout).
+In short, every leaf of the nested step dicts is stored as one column, e.g. "prev_obs/game_0>player_0/image"
+is a (T, 210, 160, 3) uint8 array and "info/game_0>player_0/RAM" a (T, 128) uint8 array.
+Columns written with codec "raw" are memory-mapped, so slicing a few frames out of an episode does not require
+reading or decoding the rest of the file.
+Frame columns may be stored palette-indexed, as one uint8 index per pixel. These are returned as PaletteFrames, which
+only look up the RGB values of the frames that are actually accessed.
+Columns that hold the same values for several agents, e.g. the RAM, may be stored once and aliased for the others.
+Aliases can be read like any other column.
+"""
+
+import bisect
+import bz2
+import gzip
+import json
+import os
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"CPTRAJ01"
+FORMAT_VERSION = 3
+ALIGNMENT = 64
+CODECS = ("raw", "zlib")
+COLUMNAR_EXTENSION = ".ctraj"
+
+KIND_SCALAR = "scalar"
+KIND_LIST = "list"
+KIND_NDARRAY = "ndarray"
+
+
+def chunk_basename(episode_id, chunk_index):
+    """Returns the filename (without extension) of one chunk of an episode that was stored in several chunks."""
+    return f"{episode_id}.{chunk_index:04d}"
+
+
+def is_columnar(data):
+    """Checks if a bytes-like object is an encoded columnar trajectory."""
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def column_name(path):
+    return "/".join(str(p) for p in path)
+
+
+def _flatten_step(step, prefix=()):
+    for key, value in step.items():
+        path = prefix + (key,)
+        if isinstance(value, dict) and len(value) > 0:
+            yield from _flatten_step(value, path)
+        else:
+            yield path, value
+
+
+def _leaf_kind(value):
+    if isinstance(value, (bool, int, float, np.bool_, np.number)):
+        return KIND_SCALAR
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+        return KIND_NDARRAY
+    if isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(v, (int, float)) for v in value):
+        return KIND_LIST
+    return None
+
+
+def _compact_dtype(array):
+    if array.dtype.kind not in "iu" or array.size == 0:
+        return array.dtype
+    low, high = int(array.min()), int(array.max())
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _compress(data, codec):
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.compress(data, 1)
+    raise ValueError(f"Unknown trajectory codec {codec}")
+
+
+def _decompress(data, codec):
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown trajectory codec {codec}")
+
+
+def _padding(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+def _palette_encode(array):
+    """Returns (indices, palette) for a uint8 (..., 3) RGB array, or None if it has more than 256 colours."""
+    pixels = array.reshape(-1, 3).astype(np.uint32)
+    keys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    palette_keys, indices = np.unique(keys, return_inverse=True)
+    if len(palette_keys) > 256:
+        return None
+    palette = np.stack([palette_keys >> 16, (palette_keys >> 8) & 255, palette_keys & 255], axis=1)
+    return indices.astype(np.uint8).reshape(array.shape[:-1]), palette.astype(np.uint8)
+
+
+class PaletteFrames:
+    """RGB frames stored as palette indices, which are only converted to RGB when indexed.
+
+    Behaves like the (T, H, W, 3) uint8 array it represents: trajectory.frames(agent)[1000:1100] only looks up the
+    colours of those 100 frames, and np.asarray() converts all of them. The indices and palette are available
+    directly, e.g. to train on palette indices or to build one-hot inputs.
+    """
+
+    def __init__(self, indices, palette):
+        self.indices = indices
+        self.palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+        self.shape = indices.shape + (3,)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.palette[self.indices[index]]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.palette[self.indices]
+        return array if dtype is None else array.astype(dtype)
+
+    def __repr__(self):
+        return f"<PaletteFrames(shape={self.shape}, colours={len(self.palette)})>"
+
+
+def _set_leaf(step, path, value):
+    for key in path[:-1]:
+        step = step.setdefault(key, {})
+    step[path[-1]] = value
+
+
+def encode_trajectory(trajectory, codec="raw", meta=None, palette=False):
+    """Encodes a trajectory (a list of step dicts, or a ColumnarTrajectory) into the columnar format.
+
+    Args:
+        trajectory: The trajectory to encode.
+        codec: "raw" for uncompressed, memory-mappable columns, or "zlib" for per-column compression.
+        meta: Optional JSON-serialisable dict stored in the header.
+        palette: Store RGB frame columns as palette indices. Columns with more than 256 colours are stored as-is.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown trajectory codec {codec}")
+    if isinstance(trajectory, ColumnarTrajectory):
+        trajectory = list(trajectory)
+    length = len(trajectory)
+    leaves = {}
+    for i, step in enumerate(trajectory):
+        for path, value in _flatten_step(step):
+            if path not in leaves:
+                leaves[path] = {}
+            leaves[path][i] = value
+
+    header = {"version": FORMAT_VERSION, "length": length, "meta": meta or {}, "columns": [], "objects": []}
+    blocks = []
+    offset = 0
+
+    def add_block(data):
+        nonlocal offset
+        block_offset = offset
+        blocks.append(data)
+        blocks.append(b"\0" * _padding(len(data)))
+        offset += len(data) + _padding(len(data))
+        return block_offset
+
+    for path, values in leaves.items():
+        kinds = set(_leaf_kind(v) for v in values.values())
+        if len(values) == length and len(kinds) == 1 and None not in kinds:
+            kind = kinds.pop()
+            try:
+                array = np.stack([np.asarray(values[i]) for i in range(length)])
+            except ValueError:
+                array = None
+            if array is not None:
+                array = np.ascontiguousarray(array.astype(_compact_dtype(array)))
+                entry = {
+                    "name": column_name(path),
+                    "path": list(path),
+                    "kind": kind,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "codec": codec,
+                }
+                encoded = None
+                if palette and array.dtype == np.uint8 and array.ndim >= 3 and array.shape[-1] == 3:
+                    encoded = _palette_encode(array)
+                if encoded is not None:
+                    array = encoded[0]
+                    entry["palette"] = encoded[1].tolist()
+                data = _compress(array.tobytes(), codec)
+                entry["offset"] = add_block(data)
+                entry["nbytes"] = len(data)
+                header["columns"].append(entry)
+                continue
+        sparse = len(values) != length
+        object_values = values if sparse else [values[i] for i in range(length)]
+        data = _compress(pickle.dumps(object_values, protocol=pickle.HIGHEST_PROTOCOL), codec)
+        header["objects"].append(
+            {
+                "name": column_name(path),
+                "path": list(path),
+                "sparse": sparse,
+                "codec": codec,
+                "offset": add_block(data),
+                "nbytes": len(data),
+            }
+        )
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix = MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes
+    prefix += b"\0" * _padding(len(prefix))
+    return b"".join([prefix] + blocks)
+
+
+class ColumnarTrajectory:
+    """A lazily decoded columnar trajectory.
+
+    This behaves like the list of step dicts that pickled trajectories decode to, i.e. len(), indexing and
+    iteration all work and return step dicts. In addition, whole columns can be accessed directly as numpy arrays,
+    which for "raw" encoded files are memory-mapped views:
+
+        trajectory.column("prev_obs/game_0>player_0/image")[1000:1100]
+        trajectory.frames("game_0>player_0")
+        trajectory.ram("game_0>player_0")
+    """
+
+    def __init__(self, source):
+        """
+        Args:
+            source: A filename (memory-mapped) or a bytes-like object holding an encoded trajectory.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            self._buffer = np.memmap(source, dtype=np.uint8, mode="r")
+            self.filename = str(source)
+        else:
+            self._buffer = np.frombuffer(source, dtype=np.uint8)
+            self.filename = None
+        if not is_columnar(self._buffer[: len(MAGIC)].tobytes()):
+            raise ValueError("Not a columnar trajectory.")
+        (header_length,) = struct.unpack("<Q", self._buffer[len(MAGIC) : len(MAGIC) + 8].tobytes())
+        header_end = len(MAGIC) + 8 + header_length
+        self.header = json.loads(self._buffer[len(MAGIC) + 8 : header_end].tobytes().decode("utf-8"))
+        # Newer versions may store data this version would silently drop, e.g. aliases before version 3.
+        if self.header["version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"Trajectory format version {self.header['version']} is newer than the supported version "
+                f"{FORMAT_VERSION}, please upgrade crowdplay_datasets."
+            )
+        self._data_offset = header_end + _padding(header_end)
+        self.length = self.header["length"]
+        self.meta = self.header["meta"]
+        self._columns = {column["name"]: column for column in self.header["columns"]}
+        self._objects = {column["name"]: column for column in self.header["objects"]}
+        # Aliases share their target's entry, with their own path. Their "name" stays the target's.
+        for alias in self.header.get("aliases", []):
+            self._columns[alias["name"]] = dict(self._columns[alias["target"]], path=alias["path"])
+        self._column_cache = {}
+        self._object_cache = {}
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Trajectory index out of range.")
+        step = {}
+        for name, column in self._columns.items():
+            _set_leaf(step, column["path"], self._column_value(name, index))
+        for name, column in self._objects.items():
+            values = self.objects(name)
+            if column["sparse"]:
+                if index in values:
+                    _set_leaf(step, column["path"], values[index])
+            else:
+                _set_leaf(step, column["path"], values[index])
+        return step
+
+    def _column_value(self, name, index):
+        value = self.column(name)[index]
+        kind = self._columns[name]["kind"]
+        if kind == KIND_SCALAR:
+            return value.item()
+        if kind == KIND_LIST:
+            return value.tolist()
+        return value
+
+    @property
+    def column_names(self):
+        """Names of all dense numeric columns."""
+        return list(self._columns)
+
+    @property
+    def object_names(self):
+        """Names of all object (pickled) columns."""
+        return list(self._objects)
+
+    def _block(self, column):
+        start = self._data_offset + column["offset"]
+        return self._buffer[start : start + column["nbytes"]]
+
+    def column(self, name):
+        """Returns a dense column as a numpy array with the step index as the first axis.
+
+        Palette-indexed frame columns are returned as PaletteFrames instead.
+        """
+        if self._columns[name]["name"] != name:
+            return self.column(self._columns[name]["name"])
+        if name not in self._column_cache:
+            column = self._columns[name]
+            block = self._block(column)
+            dtype = np.dtype(np.uint8) if "palette" in column else np.dtype(column["dtype"])
+            if column["codec"] == "raw":
+                array = block.view(dtype)
+            else:
+                array = np.frombuffer(_decompress(block.tobytes(), column["codec"]), dtype=dtype)
+            if "palette" in column:
+                self._column_cache[name] = PaletteFrames(array.reshape(column["shape"][:-1]), column["palette"])
+            else:
+                self._column_cache[name] = array.reshape(column["shape"])
+        return self._column_cache[name]
+
+    def objects(self, name):
+        """Returns an object column, as a list, or as a dict {step_index: value} for sparse columns."""
+        if name not in self._object_cache:
+            column = self._objects[name]
+            self._object_cache[name] = pickle.loads(_decompress(self._block(column).tobytes(), column["codec"]))
+        return self._object_cache[name]
+
+    def frames(self, agent, key="image"):
+        """Returns all observation frames of an agent as a (T, H, W, C) array."""
+        name = column_name(("prev_obs", agent, key))
+        if name not in self._columns:
+            name = column_name(("prev_obs", agent))
+        return self.column(name)
+
+    def ram(self, agent):
+        """Returns the ALE RAM of an agent as a (T, 128) array."""
+        return self.column(column_name(("info", agent, "RAM")))
+
+    def __repr__(self):
+        return f"<ColumnarTrajectory(length={self.length}, filename={self.filename})>"
+
+
+def _merge_palettes(palettes):
+    """Returns a palette containing the colours of all palettes, and for each palette an index mapping into it."""
+    keys = [(p[:, 0].astype(np.uint32) << 16) | (p[:, 1].astype(np.uint32) << 8) | p[:, 2] for p in palettes]
+    merged_keys = np.unique(np.concatenate(keys))
+    merged = np.stack([merged_keys >> 16, (merged_keys >> 8) & 255, merged_keys & 255], axis=1).astype(np.uint8)
+    # More than 256 colours in total can't happen for Atari frames, but would need wider indices.
+    index_dtype = np.uint8 if len(merged) <= 256 else np.uint16
+    return merged, [np.searchsorted(merged_keys, k).astype(index_dtype) for k in keys]
+
+
+class ChunkedTrajectory:
+    """A trajectory that was stored in several consecutive chunks, stitched back together.
+
+    Long episodes are written to the DB in chunks of a fixed number of steps (see Config.TRAJECTORY_CHUNK_STEPS in the
+    backend). This behaves exactly like a ColumnarTrajectory of the whole episode, except that columns are
+    concatenated copies of the chunks' columns rather than memory-mapped views.
+    Individual steps are still read lazily from the memory-mapped chunks.
+    """
+
+    def __init__(self, chunks):
+        """
+        Args:
+            chunks: List of ColumnarTrajectory, in order.
+        """
+        self.chunks = list(chunks)
+        self.offsets = [0]
+        for chunk in self.chunks:
+            self.offsets.append(self.offsets[-1] + len(chunk))
+        self.length = self.offsets[-1]
+        self._column_cache = {}
+        self._object_cache = {}
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Trajectory index out of range.")
+        chunk = bisect.bisect_right(self.offsets, index) - 1
+        return self.chunks[chunk][index - self.offsets[chunk]]
+
+    @property
+    def column_names(self):
+        """Names of columns that are dense numeric columns in all chunks."""
+        return [name for name in self.chunks[0].column_names if all(name in c._columns for c in self.chunks)]
+
+    @property
+    def object_names(self):
+        """Names of all other columns."""
+        column_names = set(self.column_names)
+        names = {}
+        for chunk in self.chunks:
+            names.update((name, None) for name in chunk.column_names + chunk.object_names if name not in column_names)
+        return list(names)
+
+    def column(self, name):
+        """Returns a dense column as a numpy array with the step index as the first axis."""
+        if name not in self._column_cache:
+            columns = [chunk.column(name) for chunk in self.chunks]
+            if all(isinstance(column, PaletteFrames) for column in columns):
+                # Keep palette-indexed frames lazy, by giving all chunks one shared palette.
+                palette, mappings = _merge_palettes([column.palette for column in columns])
+                indices = [mapping[column.indices] for mapping, column in zip(mappings, columns)]
+                self._column_cache[name] = PaletteFrames(np.concatenate(indices), palette)
+            else:
+                self._column_cache[name] = np.concatenate([np.asarray(column) for column in columns])
+        return self._column_cache[name]
+
+    def objects(self, name):
+        """Returns an object column, as a list, or as a dict {step_index: value} if it is missing in some steps."""
+        if name not in self._object_cache:
+            values = {}
+            for offset, chunk in zip(self.offsets, self.chunks):
+                if name in chunk._objects:
+                    chunk_values = chunk.objects(name)
+                    if isinstance(chunk_values, dict):
+                        values.update((offset + i, value) for i, value in chunk_values.items())
+                    else:
+                        values.update((offset + i, value) for i, value in enumerate(chunk_values))
+                elif name in chunk._columns:
+                    # A column can be dense in one chunk but not in another, e.g. if it is missing in some steps.
+                    values.update((offset + i, chunk._column_value(name, i)) for i in range(len(chunk)))
+            if len(values) == self.length:
+                values = [values[i] for i in range(self.length)]
+            self._object_cache[name] = values
+        return self._object_cache[name]
+
+    def frames(self, agent, key="image"):
+        """Returns all observation frames of an agent as a (T, H, W, C) array."""
+        name = column_name(("prev_obs", agent, key))
+        if name not in self.chunks[0]._columns:
+            name = column_name(("prev_obs", agent))
+        return self.column(name)
+
+    def ram(self, agent):
+        """Returns the ALE RAM of an agent as a (T, 128) array."""
+        return self.column(column_name(("info", agent, "RAM")))
+
+    def __repr__(self):
+        return f"<ChunkedTrajectory(length={self.length}, chunks={len(self.chunks)})>"
+
+
+def episode_arrays(trajectory):
+    """Returns the length, and the RAM, rewards and game actions of each agent of a trajectory as numpy arrays.
+
+    This is the input of the evaluate_episode() methods of the callables in crowdplay_backend.environment_callables:
+    {"length": T, "ram": {agent: (T, 128) array}, "reward": {agent: (T,) array}, "action": {agent: (T,) array}}.
+    Agents without RAM (or actions) in every step are left out of "ram" (or "action").
+
+    Args:
+        trajectory: A ColumnarTrajectory, ChunkedTrajectory, or list of step dicts.
+    """
+    if isinstance(trajectory, (ColumnarTrajectory, ChunkedTrajectory)):
+        agents = [name.split("/", 1)[1] for name in trajectory.column_names if name.startswith("reward/")]
+
+        def column(path):
+            name = column_name(path)
+            if name in trajectory.column_names:
+                return np.asarray(trajectory.column(name))
+            if name in trajectory.object_names and isinstance(trajectory.objects(name), list):
+                return np.asarray(trajectory.objects(name))
+            return None
+
+    else:
+        agents = list(trajectory[0]["reward"]) if len(trajectory) > 0 else []
+
+        def column(path):
+            values = []
+            for step in trajectory:
+                value = step
+                for key in path:
+                    if not isinstance(value, dict) or key not in value:
+                        return None
+                    value = value[key]
+                values.append(value)
+            return np.asarray(values)
+
+    episode = {"length": len(trajectory), "ram": {}, "reward": {}, "action": {}}
+    for agent in agents:
+        episode["reward"][agent] = column(("reward", agent))
+        ram = column(("info", agent, "RAM"))
+        if ram is not None:
+            episode["ram"][agent] = ram.astype(np.uint8, copy=False)
+        action = column(("action", agent, "game"))
+        if action is None:
+            action = column(("action", agent))
+        if action is not None:
+            episode["action"][agent] = action
+    return episode
+
+
+def load_trajectory(data):
+    """Returns a trajectory from raw bytes, which may be columnar, bzipped pickle, gzipped pickle or plain pickle."""
+    if is_columnar(data[: len(MAGIC)]):
+        return ColumnarTrajectory(data)
+    if data[:3] == b"BZh":
+        return pickle.loads(bz2.decompress(data))
+    if data[:2] == b"\x1f\x8b":
+        return pickle.loads(gzip.decompress(data))
+    return pickle.loads(data)
@@ -0,0 +1,80 @@
+"""
+Converts pickled trajectories (.pickle, .pickle.gz, .pickle.bz2) in a dataset directory into the columnar format.
+Columnar trajectories are memory-mapped when loaded, so loading them is not CPU-bound on decompression.
+"""
+
+import argparse
+import os
+
+from tqdm import tqdm
+
+from .columnar import COLUMNAR_EXTENSION, encode_trajectory, is_columnar, load_trajectory
+from .dataset import get_data_dir
+
+PICKLE_EXTENSIONS = (".pickle.bz2", ".pickle.gz", ".pickle")
+
+
+def convert_file(filename, codec="raw", delete=False, palette=False):
+    """Converts a single pickled trajectory file, and returns the filename of the columnar trajectory."""
+    for extension in PICKLE_EXTENSIONS:
+        if filename.endswith(extension):
+            target = filename[: -len(extension)] + COLUMNAR_EXTENSION
+            break
+    else:
+        raise ValueError(f"{filename} is not a pickled trajectory.")
+    if not os.path.isfile(target):
+        with open(filename, "rb") as file:
+            data = file.read()
+        trajectory = load_trajectory(data)
+        encoded = data if is_columnar(data) else encode_trajectory(trajectory, codec=codec, palette=palette)
+        # Write to a temporary file first so that an interrupted conversion never leaves a truncated trajectory.
+        with open(target + ".tmp", "wb") as file:
+            file.write(encoded)
+        os.replace(target + ".tmp", target)
+    if delete:
+        os.remove(filename)
+    return target
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="This converts an installed CrowdPlay dataset into the columnar trajectory format", add_help=True
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="crowdplay_atari-v0",
+        help="The dataset to convert, i.e. the subdirectory of the data directory.",
+    )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        default="raw",
+        choices=["raw", "zlib"],
+        help="raw (default) is uncompressed and can be memory-mapped, zlib is about 10x smaller but must be decoded.",
+    )
+    parser.add_argument(
+        "--palette",
+        action="store_true",
+        help="Store frames as palette indices, a third of the size. Frames are converted to RGB when accessed.",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete the pickled trajectory files after converting them.",
+    )
+
+    args = parser.parse_args()
+
+    dataset_dir = f"{get_data_dir()}/{args.dataset}"
+    filenames = sorted(
+        f"{dataset_dir}/{filename}"
+        for filename in os.listdir(dataset_dir)
+        if any(filename.endswith(extension) for extension in PICKLE_EXTENSIONS)
+    )
+
+    print(f"Converting {len(filenames)} trajectories in {dataset_dir}...")
+    for filename in tqdm(filenames):
+        convert_file(filename, codec=args.codec, delete=args.delete, palette=args.palette)
+    print("Done.")
@@ -2,6 +2,7 @@ import bz2
 import gzip
 import os
 import pickle
+import re
 import sys
 from functools import lru_cache
 from pathlib import Path
@@ -21,6 +22,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, reconstructor, relation, relationship, sessionmaker
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
+from .columnar import COLUMNAR_EXTENSION, ChunkedTrajectory, ColumnarTrajectory, chunk_basename, episode_arrays
 from .deepmind import MaxAndSkipAndWarpAndScaleAndStackFrameBuffer
 
 # Default agent key
@@ -57,8 +59,22 @@ def preprocess_obs_in_trajectory(
     rew = []
     term = []
     reward_this_obs = 0
+    if isinstance(trajectory, (ColumnarTrajectory, ChunkedTrajectory)):
+        # Read whole columns instead of reconstructing every step dict.
+        frames = trajectory.frames(agent)
+        rewards = trajectory.column(f"reward/{agent}")
+        actions = trajectory.column(f"action/{agent}/game")
+        dones = trajectory.column(f"done/{agent}")
     for i in range(len(trajectory)):
-        step = trajectory[i]
+        if isinstance(trajectory, (ColumnarTrajectory, ChunkedTrajectory)):
+            step = {
+                "prev_obs": {agent: {"image": frames[i]}},
+                "reward": {agent: rewards[i]},
+                "action": {agent: {"game": int(actions[i])}},
+                "done": {agent: dones[i]},
+            }
+        else:
+            step = trajectory[i]
 
         # Add obs to framebuffer every step
         framebuffer.add_obs(step["prev_obs"][agent])
@@ -148,10 +164,17 @@ class EpisodeModel(Base):
             self.keyword_data_list.append(kwmodel)
 
     def run_callable(self, callable, key):
-        """Runs an episode callable and stores the result as keyword metadata."""
+        """Runs an episode callable and stores the result as keyword metadata.
+
+        Callables with an evaluate_episode() method (the built-in ones in crowdplay_backend.environment_callables) are
+        evaluated on whole columns of the trajectory at once, all others step by step.
+        """
         trajectory = self.get_raw_trajectory()
-        for step in trajectory:
-            result = callable(step)
+        if hasattr(callable, "evaluate_episode"):
+            result = callable.evaluate_episode(episode_arrays(trajectory))
+        else:
+            for step in trajectory:
+                result = callable(step)
         for agent in result:
             self.update_kwdata(agent, key, result[agent])
 
@@ -226,8 +249,23 @@ def get_engine_and_session(dataset_id, create=False):
 
 @lru_cache(maxsize=4)
 def get_trajectory_by_id(id):
-    """Returns trajectory for given episode ID."""
-    filename = get_trajectory_filename_by_id(id)
+    """Returns trajectory for given episode ID.
+
+    Columnar trajectories are returned as a memory-mapped ColumnarTrajectory,
+    which can be used like the list of step dicts that pickled trajectories are loaded as.
+    Episodes stored in several chunks are stitched back together, as a ChunkedTrajectory if all chunks are columnar."""
+    chunks = [load_trajectory_file(filename) for filename in get_trajectory_filenames_by_id(id)]
+    if len(chunks) == 1:
+        return chunks[0]
+    if all(isinstance(chunk, ColumnarTrajectory) for chunk in chunks):
+        return ChunkedTrajectory(chunks)
+    return [step for chunk in chunks for step in chunk]
+
+
+def load_trajectory_file(filename):
+    """Loads a single trajectory file."""
+    if filename.endswith(COLUMNAR_EXTENSION):
+        return ColumnarTrajectory(filename)
     if filename.endswith(".pickle"):
         with open(filename, "rb") as file:
             data = pickle.load(file)
@@ -240,7 +278,7 @@ def get_trajectory_by_id(id):
         with bz2.open(filename, "rb") as file:
             data = pickle.load(file)
         return data
-    raise ValueError(f"Trajectory {id} not found.")
+    raise ValueError(f"{filename} is not a trajectory file.")
 
 
 def get_data_dir():
@@ -256,10 +294,38 @@ def get_trajectory_filename_by_id(id):
     # to get the correct subdirectory with certainty.
     for subdir in os.listdir(f"{Path(__file__).parent.parent}/data/"):
         if os.path.isdir(f"{Path(__file__).parent.parent}/data/{subdir}"):
-            if os.path.isfile(f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle"):
+            # Prefer columnar trajectories, they are much faster to load.
+            if os.path.isfile(f"{Path(__file__).parent.parent}/data/{subdir}/{id}{COLUMNAR_EXTENSION}"):
+                return f"{Path(__file__).parent.parent}/data/{subdir}/{id}{COLUMNAR_EXTENSION}"
+            elif os.path.isfile(f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle"):
                 return f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle"
             elif os.path.isfile(f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle.gz"):
                 return f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle.gz"
             elif os.path.isfile(f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle.bz2"):
                 return f"{Path(__file__).parent.parent}/data/{subdir}/{id}.pickle.bz2"
     raise ValueError(f"Trajectory {id} not found.")
+
+
+def get_trajectory_filenames_by_id(id):
+    """Returns the trajectory filename for given episode ID as a single-element list,
+    or the filenames of all of its chunks in order if the episode was stored in chunks."""
+    try:
+        return [get_trajectory_filename_by_id(id)]
+    except ValueError:
+        pass
+    chunk_pattern = re.compile(re.escape(id) + r"\.(\d{4})\.")
+    for subdir in os.listdir(f"{Path(__file__).parent.parent}/data/"):
+        if os.path.isdir(f"{Path(__file__).parent.parent}/data/{subdir}"):
+            chunk_indices = set()
+            for filename in os.listdir(f"{Path(__file__).parent.parent}/data/{subdir}"):
+                match = chunk_pattern.match(filename)
+                if match is not None:
+                    chunk_indices.add(int(match.group(1)))
+            if len(chunk_indices) > 0:
+                if chunk_indices != set(range(len(chunk_indices))):
+                    raise ValueError(f"Trajectory {id} is missing chunks.")
+                return [
+                    get_trajectory_filename_by_id(chunk_basename(id, chunk_index))
+                    for chunk_index in range(len(chunk_indices))
+                ]
+    raise ValueError(f"Trajectory {id} not found.")
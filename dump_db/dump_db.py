@@ -8,6 +8,7 @@ from io import BytesIO
 from pathlib import Path
 from zipfile import ZIP_DEFLATED, ZipFile
 
+from crowdplay_datasets.columnar import COLUMNAR_EXTENSION, chunk_basename, is_columnar
 from crowdplay_datasets.dataset import (
     Base,
     EnvironmentKeywordDataModel,
@@ -21,7 +22,7 @@ from crowdplay_backend import db_models
 from crowdplay_backend.api_routes import api_v1
 from crowdplay_backend.config import Config
 from crowdplay_backend.db import db
-from crowdplay_backend.db_models import value_to_appropriate_type
+from crowdplay_backend.db_models import stored_callable_value
 from crowdplay_backend.logger import setLoggerConfig
 from crowdplay_backend.socket_events import EnvNamespace
 from crowdplay_backend.socketio import socketio
@@ -164,16 +165,31 @@ if __name__ == "__main__":
                         is not None
                     ):
                         has_trajectories = True
-                        if not os.path.isfile(
-                            f"{Path(__file__).resolve().parent.parent}/dataset/data/{episode.id}.pickle.bz2"
+                        if not any(
+                            os.path.isfile(
+                                f"{Path(__file__).resolve().parent.parent}/dataset/data/{basename}{extension}"
+                            )
+                            for basename in (episode.id, chunk_basename(episode.id, 0))
+                            for extension in (".pickle.bz2", COLUMNAR_EXTENSION)
                         ):
                             print(f"Downloading episode {episode.id}")
-                            trajectory = db_models.TrajectoryModel.query.get(episode.id)
-                            with open(
-                                f"{Path(__file__).resolve().parent.parent}/dataset/data/{episode.id}.pickle.bz2", "wb"
-                            ) as f:
-                                f.write(trajectory.trajectory)
-                                f.close()
+                            chunks = (
+                                db_models.TrajectoryModel.query.filter_by(episode_id=episode.id)
+                                .order_by(db_models.TrajectoryModel.chunk_index)
+                                .all()
+                            )
+                            for chunk in chunks:
+                                # Trajectories are stored either columnar or as bzipped pickle, see Config.TRAJECTORY_FORMAT.
+                                extension = COLUMNAR_EXTENSION if is_columnar(chunk.trajectory) else ".pickle.bz2"
+                                # Long episodes are stored in several chunks, which the dataset loader stitches together.
+                                basename = (
+                                    episode.id if len(chunks) == 1 else chunk_basename(episode.id, chunk.chunk_index)
+                                )
+                                with open(
+                                    f"{Path(__file__).resolve().parent.parent}/dataset/data/{basename}{extension}", "wb"
+                                ) as f:
+                                    f.write(chunk.trajectory)
+                                    f.close()
                         else:
                             print(f"Already downloaded episode {episode.id}")
                         local_episode = EpisodeModel(episode_id=episode.id, environment_id=env_instance.instance_id)
@@ -189,7 +205,9 @@ if __name__ == "__main__":
                                 episode_id=episode.id,
                                 agent_id=keyword_data.agent_key,
                                 key=keyword_data.callable_key,
-                                value=value_to_appropriate_type(keyword_data.value_achieved),
+                                value=stored_callable_value(
+                                    keyword_data.value_numeric, keyword_data.value_kind, keyword_data.value_achieved
+                                ),
                                 # value_required=value_to_appropriate_type(
                                 #     keyword_data.value_required)
                             )
@@ -281,7 +299,9 @@ if __name__ == "__main__":
                             environment_id=env_instance.instance_id,
                             agent_id=keyword_data.agent_key,
                             key=keyword_data.callable_key,
-                            value=value_to_appropriate_type(keyword_data.value_achieved),
+                            value=stored_callable_value(
+                                keyword_data.value_numeric, keyword_data.value_kind, keyword_data.value_achieved
+                            ),
                             # value_required=value_to_appropriate_type(
                             #     keyword_data.value_required)
                         )
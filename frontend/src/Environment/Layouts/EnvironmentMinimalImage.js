@@ -1,10 +1,11 @@
 import React from 'react'
 import PropTypes from 'prop-types'
+import Frame from './Frame'
 
 export default function EnvironmentMinimalImage({ obsState }) {
   if (obsState.step_iter >= 0) {
     return (
-      <img src={obsState.obs} width="640px" height="320px" alt="obs" />
+      <Frame src={obsState.obs} width="640px" height="320px" alt="obs" />
     )
   }
   return null
@@ -1,6 +1,7 @@
 import React, { useCallback } from 'react'
 import PropTypes from 'prop-types'
 import { Joystick, JoystickShape } from 'react-joystick-component'
+import Frame from './Frame'
 import './EnvironmentPendulum.less'
 
 export default function EnvironmentPendulum(props) {
@@ -27,7 +28,7 @@ export default function EnvironmentPendulum(props) {
     return (
       <div className="EnvironmentPendulum">
         <div className="pendulum_image_container">
-          <img src={obsState.obs} alt="obs" className="pendulum_image" />
+          <Frame src={obsState.obs} alt="obs" className="pendulum_image" />
         </div>
         <div className="joystick_container">
           <span className="score">
@@ -0,0 +1,43 @@
+import { useEffect, useRef } from 'react'
+import PropTypes from 'prop-types'
+
+// Shows a frame, which is either an image URL, or a canvas when frames are sent as delta frames.
+export default function Frame({
+  src, width, height, style, ...props
+}) {
+  const canvasRef = useRef(null)
+  const isCanvas = src instanceof HTMLCanvasElement
+
+  useEffect(() => {
+    if (isCanvas && canvasRef.current) {
+      const canvas = canvasRef.current
+      if (canvas.width !== src.width || canvas.height !== src.height) {
+        canvas.width = src.width
+        canvas.height = src.height
+      }
+      canvas.getContext('2d').drawImage(src, 0, 0)
+    }
+  })
+
+  if (isCanvas) {
+    // A canvas' width and height attributes are its resolution, so display size goes into the style instead.
+    // eslint-disable-next-line react/jsx-props-no-spreading
+    return <canvas ref={canvasRef} style={{ width, height, ...style }} {...props} />
+  }
+  // eslint-disable-next-line react/jsx-props-no-spreading, jsx-a11y/alt-text
+  return <img src={src} width={width} height={height} style={style} {...props} />
+}
+
+Frame.propTypes = {
+  src: PropTypes.oneOfType([PropTypes.string, PropTypes.object]),
+  width: PropTypes.string,
+  height: PropTypes.string,
+  style: PropTypes.object,
+}
+
+Frame.defaultProps = {
+  src: undefined,
+  width: undefined,
+  height: undefined,
+  style: undefined,
+}
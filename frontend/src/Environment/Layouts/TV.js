@@ -6,6 +6,7 @@ import {
   Form,
 } from 'antd'
 import { EnvState } from '../../utils'
+import Frame from './Frame'
 
 export default function TV(props) {
   const {
@@ -33,7 +34,7 @@ export default function TV(props) {
         <div className="frame">
           <div className="viewport">
 
-            <img
+            <Frame
               alt="Game screen"
               className={state === EnvState.STARTED ? 'display-block' : ''}
               src={obsState?.obs?.image || obsState?.obs}
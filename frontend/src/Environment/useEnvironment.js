@@ -6,7 +6,7 @@ import {
   useContext,
 } from 'react'
 import debug from 'debug'
-import SocketEnv from '../models/SocketEnv'
+import SocketEnv, { supportedImageFormats } from '../models/SocketEnv'
 import { EnvState, emitter } from '../utils'
 import { wsUri } from '../config'
 import doorBellSound from '../assets/sounds/door-bell.wav'
@@ -44,7 +44,13 @@ export default function useEnvironment(env) {
     socketEnv.connect(wsUri)
 
     const onConnected = () => {
-      socketEnv.push('setup_user', instanceId, agentKey)
+      // Ask for binary step messages. Servers that don't support them keep sending the default format.
+      socketEnv.push('setup_user', instanceId, agentKey, null, {
+        binary: true,
+        image_formats: supportedImageFormats(),
+        delta: true,
+        adaptive: true,
+      })
     }
 
     const onForceDisconnected = (reason) => {
@@ -74,6 +80,8 @@ export default function useEnvironment(env) {
 
       setObsState(step)
       socketEnv.set_step_iter(step_iter)
+      // Acknowledge the step once it has been painted, so the server can adapt streaming to what we actually show.
+      requestAnimationFrame(() => socketEnv.ack_step(instanceId, agentKey, step_iter))
 
       if (task_complete >= 1) {
         emitter.emit('task_done_button')
@@ -0,0 +1,66 @@
+// Rebuilds frames sent as delta frames, see backend/crowdplay_backend/frame_codec.py.
+// Keyframes replace the whole canvas, delta frames are an atlas of changed tiles which are drawn onto the
+// previous frame at their positions.
+// Palette frames (see PaletteEncoder in the same file) are zlib compressed palette indices, one byte per pixel, which
+// are looked up in the palette and drawn directly.
+export default class FrameCompositor {
+  canvas = document.createElement('canvas')
+
+  context = this.canvas.getContext('2d')
+
+  // Frames are decoded asynchronously, but must be composited in order.
+  pending = Promise.resolve()
+
+  // Adds a frame, and resolves to the canvas once it has been composited.
+  add(image, tiles, mimeType) {
+    this.pending = this.pending.then(() => this.composite(image, tiles, mimeType))
+    return this.pending
+  }
+
+  // Adds a palette frame of the given [height, width], and resolves to the canvas once it has been drawn.
+  addIndexed(indices, size, palette) {
+    this.pending = this.pending.then(() => this.drawIndexed(indices, size, palette))
+    return this.pending
+  }
+
+  async drawIndexed(indices, [height, width], palette) {
+    const stream = new Blob([indices]).stream().pipeThrough(new DecompressionStream('deflate'))
+    const pixels = new Uint8Array(await new Response(stream).arrayBuffer())
+    if (this.canvas.width !== width || this.canvas.height !== height) {
+      this.canvas.width = width
+      this.canvas.height = height
+    }
+    const imageData = this.context.createImageData(width, height)
+    const { data } = imageData
+    for (let i = 0; i < pixels.length; i += 1) {
+      const [r, g, b] = palette[pixels[i]]
+      data[4 * i] = r
+      data[4 * i + 1] = g
+      data[4 * i + 2] = b
+      data[4 * i + 3] = 255
+    }
+    this.context.putImageData(imageData, 0, 0)
+    return this.canvas
+  }
+
+  async composite(image, tiles, mimeType) {
+    if (!image) return this.canvas
+    const bitmap = await createImageBitmap(new Blob([image], { type: mimeType }))
+    if (!tiles) {
+      this.canvas.width = bitmap.width
+      this.canvas.height = bitmap.height
+      this.context.drawImage(bitmap, 0, 0)
+    } else {
+      const [columns, size, ...positions] = tiles
+      for (let i = 0; i < positions.length / 2; i += 1) {
+        const x = positions[2 * i] * size
+        const y = positions[2 * i + 1] * size
+        const atlasX = (i % columns) * size
+        const atlasY = Math.floor(i / columns) * size
+        this.context.drawImage(bitmap, atlasX, atlasY, size, size, x, y, size, size)
+      }
+    }
+    bitmap.close()
+    return this.canvas
+  }
+}
@@ -2,9 +2,19 @@ import EventEmitter from 'events'
 import { io } from 'socket.io-client'
 import debug from 'debug'
 import { Deferred } from '../utils'
+import FrameCompositor from './FrameCompositor'
 
 const log = debug('atari:SocketEnv')
 
+// Image formats we can decode, in order of preference, for binary step messages.
+// Palette frames are lossless and usually smaller than JPEG, but need DecompressionStream to decode.
+export function supportedImageFormats() {
+  const canvas = document.createElement('canvas')
+  const webp = canvas.toDataURL('image/webp').startsWith('data:image/webp')
+  const formats = webp ? ['webp', 'jpeg'] : ['jpeg']
+  return typeof DecompressionStream !== 'undefined' ? ['palette', ...formats] : formats
+}
+
 export default class SocketEnv extends EventEmitter {
   connection = null
 
@@ -12,6 +22,21 @@ export default class SocketEnv extends EventEmitter {
 
   step_iter = 0
 
+  // Set once the server has agreed to send binary step messages, see onStepFormat.
+  imageMimeType = null
+
+  // Rarely changing step data, only sent with binary steps when it changes.
+  stepExtra = {}
+
+  // Object URLs of the most recent frames, revoked once they can no longer be displayed.
+  frameUrls = []
+
+  // Rebuilds frames if the server sends delta frames.
+  compositor = null
+
+  // Whether the server adapts streaming to how fast we show steps, in which case we acknowledge each step shown.
+  adaptive = false
+
   set_step_iter = (step_iter) => {
     this.step_iter = step_iter
   }
@@ -47,6 +72,53 @@ export default class SocketEnv extends EventEmitter {
     this.emit('step', stepInfo)
   }
 
+  onStepFormat = ({ image_format, delta, adaptive }) => {
+    log('Using binary steps with image format', image_format, delta ? 'and delta frames' : '')
+    this.imageMimeType = `image/${image_format}`
+    this.adaptive = Boolean(adaptive)
+    this.compositor = delta || image_format === 'palette' ? new FrameCompositor() : null
+  }
+
+  onStepBinary = ({
+    h, i, t, p, x,
+  }) => {
+    // Rebuild the same step object as sent in the default format, so that layouts don't need to care.
+    if (x) this.stepExtra = x
+    const [step_iter, reward, done, score] = h
+    const {
+      obs: obsRest, image_key, palette, ...extra
+    } = this.stepExtra
+    let obs = obsRest
+    if (p !== undefined && this.compositor) {
+      // Palette frames are drawn onto a canvas, like delta frames.
+      this.compositor.addIndexed(i, p, palette).then(canvas => {
+        this.emit('step', {
+          step_iter, reward, done, score, obs: image_key ? { ...obsRest, [image_key]: canvas } : canvas, ...extra,
+        })
+      })
+      return
+    }
+    if (t !== undefined && this.compositor) {
+      // Delta frames are shown as a canvas. Emit steps only once their frame is composited, which keeps them in order.
+      this.compositor.add(i, t, this.imageMimeType).then(canvas => {
+        this.emit('step', {
+          step_iter, reward, done, score, obs: image_key ? { ...obsRest, [image_key]: canvas } : canvas, ...extra,
+        })
+      })
+      return
+    }
+    if (i) {
+      const url = URL.createObjectURL(new Blob([i], { type: this.imageMimeType }))
+      // Keep the previous frame alive until the new one has been rendered.
+      this.frameUrls.push(url)
+      if (this.frameUrls.length > 2) URL.revokeObjectURL(this.frameUrls.shift())
+      obs = image_key ? { ...obsRest, [image_key]: url } : url
+    }
+    this.emit('step', {
+      step_iter, reward, done, score, obs, ...extra,
+    })
+  }
+
   // onStopped = () => {
   //   log('Env Stopped')
   //   this.emit('stopped')
@@ -105,6 +177,8 @@ export default class SocketEnv extends EventEmitter {
     this.socket.on('disconnect', this.onDisconnect)
     this.socket.on('connect_error', this.onConnectError)
     this.socket.on('step', this.onStep)
+    this.socket.on('step_format', this.onStepFormat)
+    this.socket.on('step_binary', this.onStepBinary)
     // this.socket.on('stopped', this.onStopped)
     this.socket.on('done', this.onDone)
     this.socket.on('error', this.onError)
@@ -125,6 +199,10 @@ export default class SocketEnv extends EventEmitter {
     this.socket.emit(event, ...args)
   }
 
+  ack_step(instanceId, agentKey, step_iter) {
+    if (this.adaptive) this.socket.emit('step_ack', instanceId, agentKey, step_iter)
+  }
+
   push_action(instanceId, agentKey, action) {
     this.socket.emit('action', instanceId, agentKey, this.step_iter, action)
   }
@@ -132,5 +210,7 @@ export default class SocketEnv extends EventEmitter {
   destroy() {
     this.uninstallHandlers()
     this.removeAllListeners()
+    this.frameUrls.forEach(url => URL.revokeObjectURL(url))
+    this.frameUrls = []
   }
 }
@@ -22,13 +22,19 @@ CREATE TABLE IF NOT EXISTS envs (
 );
 
 -- Tracks task callables per env
+-- value_achieved and value_required are stored as strings. Values that are numbers or durations are also stored typed,
+-- so they can be ranked and summed in SQL: value_numeric is the number, or the duration in seconds, and value_kind is
+-- "int", "float" or "duration". Both are NULL for other values. The same goes for the other callable tables.
 CREATE TABLE IF NOT EXISTS task_callable_per_env (
 	env_instance_id VARCHAR(32) NOT NULL,
 	agent_key VARCHAR(255) NOT NULL, 
 	callable_key VARCHAR(255) NOT NULL, 
 	value_achieved VARCHAR(255) NOT NULL,
 	value_required VARCHAR(255) NOT NULL,
+	value_numeric DOUBLE,
+	value_kind VARCHAR(16),
 	PRIMARY KEY (env_instance_id, agent_key, callable_key),
+	INDEX (callable_key, value_numeric),
 	FOREIGN KEY(env_instance_id) REFERENCES envs (instance_id)
 );
 
@@ -42,7 +48,10 @@ CREATE TABLE IF NOT EXISTS task_callable_per_game (
 	callable_key VARCHAR(255) NOT NULL, 
 	value_achieved VARCHAR(255) NOT NULL,
 	value_required VARCHAR(255) NOT NULL,
+	value_numeric DOUBLE,
+	value_kind VARCHAR(16),
 	PRIMARY KEY (env_instance_id, episode_id, agent_key, callable_key),
+	INDEX (callable_key, value_numeric),
 	FOREIGN KEY(env_instance_id) REFERENCES envs (instance_id)
 );
 
@@ -55,7 +64,10 @@ CREATE TABLE IF NOT EXISTS episode_callable (
 	callable_key VARCHAR(255) NOT NULL, 
 	value_achieved VARCHAR(255) NOT NULL,
 	value_required VARCHAR(255) NOT NULL,
+	value_numeric DOUBLE,
+	value_kind VARCHAR(16),
 	PRIMARY KEY (env_instance_id, episode_id, agent_key, callable_key),
+	INDEX (callable_key, value_numeric),
 	FOREIGN KEY(env_instance_id) REFERENCES envs (instance_id)
 );
 
@@ -123,11 +135,13 @@ CREATE TABLE IF NOT EXISTS games (
 -- Stores trajectories.
 -- TODO this will replace the steps table
 -- episode_id: id of the game / episode
--- trajectory: Pickled and bzipped trajectory
+-- chunk_index: long episodes are stored in several consecutive chunks, numbered from 0
+-- trajectory: Columnar trajectory (see trajectory_format.py), or pickled and bzipped trajectory in older rows
 CREATE TABLE IF NOT EXISTS episode_trajectories (
 	episode_id VARCHAR(32) NOT NULL, 
+	chunk_index INTEGER NOT NULL DEFAULT 0,
 	trajectory LONGBLOB NOT NULL,
-	PRIMARY KEY (episode_id), 
+	PRIMARY KEY (episode_id, chunk_index), 
 	FOREIGN KEY(episode_id) REFERENCES games (id)
 );
 
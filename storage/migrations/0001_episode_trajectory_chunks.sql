@@ -0,0 +1,9 @@
+-- Stores trajectories in several chunks per episode.
+-- crowdplaydb.sql already contains this for new databases, this is only needed to upgrade existing ones.
+-- Existing trajectories become chunk 0 of their episode.
+USE crowdplaydb;
+
+ALTER TABLE episode_trajectories
+	ADD COLUMN chunk_index INTEGER NOT NULL DEFAULT 0 AFTER episode_id,
+	DROP PRIMARY KEY,
+	ADD PRIMARY KEY (episode_id, chunk_index);
@@ -0,0 +1,42 @@
+-- Stores callable values that are numbers or durations typed, in value_numeric and value_kind.
+-- crowdplaydb.sql already contains this for new databases, this is only needed to upgrade existing ones.
+-- Existing values are converted the same way the backend used to parse them (see value_to_appropriate_type):
+-- "H:MM:SS" is a duration, stored in seconds, values with a "." are floats, and other numbers are ints.
+-- Values that are none of these keep NULL in both columns.
+USE crowdplaydb;
+
+ALTER TABLE task_callable_per_env
+	ADD COLUMN value_numeric DOUBLE AFTER value_required,
+	ADD COLUMN value_kind VARCHAR(16) AFTER value_numeric,
+	ADD INDEX (callable_key, value_numeric);
+
+ALTER TABLE task_callable_per_game
+	ADD COLUMN value_numeric DOUBLE AFTER value_required,
+	ADD COLUMN value_kind VARCHAR(16) AFTER value_numeric,
+	ADD INDEX (callable_key, value_numeric);
+
+ALTER TABLE episode_callable
+	ADD COLUMN value_numeric DOUBLE AFTER value_required,
+	ADD COLUMN value_kind VARCHAR(16) AFTER value_numeric,
+	ADD INDEX (callable_key, value_numeric);
+
+UPDATE task_callable_per_env SET value_numeric = TIME_TO_SEC(value_achieved), value_kind = 'duration'
+	WHERE value_achieved REGEXP '^[0-9]{1,2}:[0-9]{2}:[0-9]{2}$';
+UPDATE task_callable_per_env SET value_numeric = value_achieved + 0, value_kind = 'float'
+	WHERE value_achieved REGEXP '^-?[0-9]*\\.[0-9]+(e[-+]?[0-9]+)?$';
+UPDATE task_callable_per_env SET value_numeric = CAST(value_achieved AS SIGNED), value_kind = 'int'
+	WHERE value_achieved REGEXP '^-?[0-9]+$';
+
+UPDATE task_callable_per_game SET value_numeric = TIME_TO_SEC(value_achieved), value_kind = 'duration'
+	WHERE value_achieved REGEXP '^[0-9]{1,2}:[0-9]{2}:[0-9]{2}$';
+UPDATE task_callable_per_game SET value_numeric = value_achieved + 0, value_kind = 'float'
+	WHERE value_achieved REGEXP '^-?[0-9]*\\.[0-9]+(e[-+]?[0-9]+)?$';
+UPDATE task_callable_per_game SET value_numeric = CAST(value_achieved AS SIGNED), value_kind = 'int'
+	WHERE value_achieved REGEXP '^-?[0-9]+$';
+
+UPDATE episode_callable SET value_numeric = TIME_TO_SEC(value_achieved), value_kind = 'duration'
+	WHERE value_achieved REGEXP '^[0-9]{1,2}:[0-9]{2}:[0-9]{2}$';
+UPDATE episode_callable SET value_numeric = value_achieved + 0, value_kind = 'float'
+	WHERE value_achieved REGEXP '^-?[0-9]*\\.[0-9]+(e[-+]?[0-9]+)?$';
+UPDATE episode_callable SET value_numeric = CAST(value_achieved AS SIGNED), value_kind = 'int'
+	WHERE value_achieved REGEXP '^-?[0-9]+$';